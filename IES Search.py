@@ -16,16 +16,28 @@
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # ライブラリーのインポート
+import builtins                                                                 # 例外の種類名から例外クラスを引く
 import codecs                                                                   # codecsは、UnicodeDecodeErrorを避けるため
+import collections                                                              # 角度の格子の名前付きタプル
+import contextlib                                                               # アーカイブを読んでいる間、ロックを持つ
 import copy                                                                     # 複合オブジェクトの深いコピーのため
+import functools                                                                # 角度の格子とラベルのキャッシュ
 import glob
+import hashlib                                                                  # キャッシュのキー
+import http.server                                                              # ダウンロードの確認用のローカルサーバー
+try:
+    import inotify_simple                                                       # Linuxでのフォルダの監視、なければ定期的に確認
+except ImportError:
+    inotify_simple = None
 import itertools
 import json
 import math
 import matplotlib.pyplot as plt
+import multiprocessing                                                          # 並列処理
 import numpy   as np
 import pandas  as pd
 import os
+import queue                                                                    # 段階ごとの受け渡し
 import pandas  as pd
 from   pathlib import Path
 import quaternion
@@ -37,10 +49,13 @@ import sqlite3
 from   statistics import median, mean
 import string
 import sys
+import tarfile                                                                  # tarの中の配光データの読み込み
+import threading                                                                # ファイルの読み込みスレッド
 import time                                                                     # 処理速度の計測
 import traceback                                                                # 例外処理
 import types
 import urllib as ul
+import zipfile                                                                  # zipの中の配光データの読み込み
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 環境変数の設定
@@ -55,7 +70,7 @@ np.set_printoptions(suppress=True)
 #   |__ Database.sqlite         SQLITE_PATH
 #   |__ 1 Manufacturer/         MANUFACTURER_PATH
 #   |   |__ Manufacturer.csv
-#   |   |__ IES/                * 古いものはzipする
+#   |   |__ IES/                * 古いものはzipする、zipやtarのまま読み込める
 #   |   |__ Photos/
 #   |__ ...
 #   |__ 2 Cluster/              CLUSTER_PATH
@@ -66,6 +81,9 @@ np.set_printoptions(suppress=True)
 #   |__ 4 Plot/                 PLOT_PATH
 #   |   |__ Plot.ies
 #   |__ 5 Error Log/            ERROR_PATH
+#   |__ 6 Cache/                CACHE_PATH
+#   |__ 7 Grid/                 GRID_PATH
+#   |   |__ Manufacturer/       * 標準化した配光データ、ファイルの中身のハッシュごとの.npz
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # グローバル変数の設定
@@ -80,6 +98,13 @@ CLUSTER_GRAPH_PATH = '/Users/takeosugamata/Downloads/Funnel/2 Cluster/Graph/'
 QUERY_PATH         = '/Users/takeosugamata/Downloads/Funnel/3 Query/'
 PLOT_PATH          = '/Users/takeosugamata/Downloads/Funnel/4 Plot/'
 ERROR_PATH         = '/Users/takeosugamata/Downloads/Funnel/5 Error Log/'
+CACHE_PATH         = '/Users/takeosugamata/Downloads/Funnel/6 Cache/'
+GRID_PATH          = '/Users/takeosugamata/Downloads/Funnel/7 Grid/'
+
+# キャッシュの設定
+PIPELINE_VERSION   = 2                                                          # 標準化や特徴量の計算を変えたら、1つ上げる
+PARSER_VERSION     = 1                                                          # 読み込みを直したら、1つ上げ、revalidate_quarantineで隔離したファイルを再確認
+CACHE_SIZE_LIMIT   = 2 * 1024**3                                                # キャッシュの上限、2GB
 
 # SQliteへの接続
 con                = sqlite3.connect(SQLITE_PATH)
@@ -120,17 +145,8 @@ COLUMNS      = [
                 'Download URL',                                                 # 列31、ダウンロードURLのある親のページのURL
                ]
 
-IES_COLUMNS        = [str(i) +'-'+ str(j) 
-                      for i in list(range(0,361,10))                            # 列26-列1394の1369列
-                      for j in list(range(0,181,5))]
-DIFF_THETA_COLUMNS = ['theta_' + str(i) +'-'+ str(j)                            # 列1395-列2762の1368列
-                      for i in list(range(0,351,10)) 
-                      for j in list(range(0,186,5))]
-DIFF_PHI_COLUMNS   = ['phi_'   + str(i) +'-'+ str(j)                            # 列2763-列4057の1295列
-                       for i in list(range(0,361,10)) 
-                       for j in list(range(5,176,5))]
-
-DIFF_COLUMNS       = DIFF_THETA_COLUMNS + DIFF_PHI_COLUMNS
+# 光度と差分の列名("270-90"など)は、角度の格子(IES_GRID、DIFF_THETA_GRID、DIFF_PHI_GRID)から
+# データフレーム化する時にのみ作る(grid_labels)
 
 FILE_NAME         = 0
 CLUSTER_NO        = 1
@@ -198,6 +214,105 @@ def make_bulb():
                         index=phi_label,columns=theta_label)
     return bulb
     
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 配光データのバイト列の読み込み(zip、tarの中のファイルにも対応)
+
+# zipやtarの中のファイルは、アーカイブのパスに続けて、中のファイル名を書く
+# 例: .../1 Manufacturer/ACME/IES/2019.zip/IES/a.ies
+# 解凍せず、一時ファイルも作らない
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+PHOTOMETRIC_EXTENSIONS = ('.ies', '.ldt')
+ARCHIVE_CACHE_SIZE = 16                                                         # 開いたままにするアーカイブの最大数
+archives      = collections.OrderedDict()                                       # 開いたアーカイブ、(プロセスID, パス, 更新時刻, サイズ)がキー、使った順
+archives_lock = threading.RLock()                                               # 読み込みスレッドが同時に開き、閉じるため
+
+def split_archive_path(file_path):
+    
+    # アーカイブのパスと中のファイル名に分ける、アーカイブでなければ中のファイル名はNone
+    file_path = str(file_path)
+    match = re.match(r'(.+?\.(?:zip|tar|tar\.gz|tgz))/(.+)', file_path, re.I)   # 最初のアーカイブの拡張子で区切る
+    if match and os.path.isfile(match.group(1)):
+        return match.group(1), match.group(2)
+    
+    return file_path, None
+
+def open_archive(archive_path):
+    
+    # 子プロセスは親のファイルハンドルを共有しないよう、プロセスごとに開く
+    # 書き換えられたアーカイブは、更新時刻かサイズが変わるので開き直す
+    stat = os.stat(archive_path)
+    key  = (os.getpid(), archive_path, stat.st_mtime, stat.st_size)
+    
+    with archives_lock:
+        if key in archives:
+            archives.move_to_end(key)                                           # 最後に使ったもの
+            return archives[key]
+        
+        # 書き換えられる前に開いたものは閉じる
+        for old_key in [k for k in archives if k[:2] == key[:2]]:
+            archives.pop(old_key).close()
+        
+        if archive_path.lower().endswith('.zip'):
+            archives[key] = zipfile.ZipFile(archive_path)
+        else:
+            archives[key] = tarfile.open(archive_path)                          # 圧縮の有無は自動判定
+        
+        # 上限を超えたら、使った順の古いものから閉じる
+        while len(archives) > ARCHIVE_CACHE_SIZE:
+            archives.popitem(last=False)[1].close()
+        
+        return archives[key]
+
+def close_archives():
+    
+    # メーカーごとの処理の最後に、開いたアーカイブを全て閉じる
+    with archives_lock:
+        while archives:
+            archives.popitem()[1].close()
+
+def read_photometric_bytes(file_path):
+    
+    archive_path, member = split_archive_path(file_path)
+    
+    if member is None:                                                          # 通常のファイル
+        with open(archive_path, 'rb') as f:
+            return f.read()
+    
+    with archives_lock:                                                         # 読んでいる間に閉じられないよう、tarは同時に読めないため
+        archive = open_archive(archive_path)
+        if isinstance(archive, zipfile.ZipFile):
+            return archive.read(member)
+        else:
+            return archive.extractfile(member).read()
+
+def list_photometric_files(folder_path):
+    
+    # フォルダ内のiesとldt、およびzipとtarの中のiesとldtのパスのリスト、/**/で再起的に取得
+    file_paths = []
+    for path in sorted(glob.glob(folder_path+'/**/*', recursive=True)):
+        lower = path.lower()
+        if lower.endswith(PHOTOMETRIC_EXTENSIONS):
+            file_paths.append(path)
+        elif lower.endswith(ARCHIVE_EXTENSIONS) and os.path.isfile(path):
+            try:
+                with archives_lock:
+                    archive = open_archive(path)
+                    if isinstance(archive, zipfile.ZipFile):
+                        members = [m.filename for m in archive.infolist() if not m.is_dir()]
+                    else:
+                        members = [m.name for m in archive.getmembers() if m.isfile()]
+            except:                                                             # 壊れたアーカイブは除く
+                print('unreadable archive: ' + path)
+                continue
+            for member in members:
+                if member.startswith('__MACOSX/'):                              # macOSのzipに含まれる属性ファイルは除く
+                    continue
+                if member.lower().endswith(PHOTOMETRIC_EXTENSIONS):
+                    file_paths.append(path + '/' + member)                      # アーカイブのパス/中のファイル名
+    
+    return file_paths
+
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 配光データの読み込み
 
@@ -205,9 +320,9 @@ def read_ies_raw(file_path):
     
     # CSVの読み込み
     csv = []
-    with codecs.open(file_path,'r','utf-8','ignore') as f:
-        for line in f:                                                          # 一行ずつ読み込み
-            csv.append(line)                                                    # リストに追加する
+    text = read_photometric_bytes(file_path).decode('utf-8', 'ignore')          # zipやtarの中のファイルにも対応
+    for line in text.splitlines():                                              # 一行ずつ読み込み
+        csv.append(line)                                                        # リストに追加する
     csv = [c.strip() for c in csv]                                              # 文字列前後の空白を除く
     csv = [c for c in csv if c!='']                                             # 最後に空白行があると、データフレーム作成時、行ラベルと行数が合わない
     
@@ -302,6 +417,88 @@ def read_ies_raw(file_path):
     
     return manufac, lumcat, luminaire, lamp, wattage, ies_raw
 
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# IESのキーワードの読み込み
+
+def parse_ies_keywords(header):                                                 # 引数は、TILT行より前のバイト列
+    
+    header = header.decode('utf-8', 'ignore').splitlines()
+    keywords = {'[MANUFAC]':   None,                                            # メーカー名
+                '[LUMCAT]':    None,                                            # 照明器具カタログ情報
+                '[LUMINAIRE]': None,                                            # 照明器具情報
+                '[LAMP]':      None}                                            # 光源情報
+    for c in header:
+        c = c.strip()
+        for k in keywords:
+            if keywords[k] is None and c.startswith(k):                         # 最初に見つかったものだけ
+                keywords[k] = c[len(k):].strip()                                # [KEYWORD]の後の文字列、前後の空白を除く
+    manufac, lumcat, luminaire, lamp = [
+        '-' if (v is None or v == '') else v for v in keywords.values()]        # 空あるいは空文字なら、ハイフン
+    
+    return manufac, lumcat, luminaire, lamp
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 配光データの一括読み込み（行ごとのリストを作らない）
+
+def read_ies_raw_bulk(file_path, data=None):                                    # dataは、読み込み済みのバイト列
+    
+    # read_ies_rawと同じ返り値
+    # 行ごとにリスト化、小数化せず
+    # TILT行以降の数値を一度に配列化する
+    # 行の区切りは関係なくなるので、角度数が正確なら、改行位置の誤りにも対応
+    
+    # バイト列として一度だけ読み込む
+    if data is None:
+        data = read_photometric_bytes(file_path)                                # zipやtarの中のファイルにも対応
+    
+    # TILT=の行の検索
+    tilt = re.search(rb'^[ \t]*TILT=.*$', data, re.M)                           # TILT=で始まる最初の行、行頭の空白は許容
+    if tilt is None:
+        raise ValueError('TILT= not found: ' + str(file_path))
+    
+    # 基本情報の取得
+    # TILT行より前だけを文字列化する
+    manufac, lumcat, luminaire, lamp = parse_ies_keywords(data[:tilt.start()])
+    
+    # TILT行以降の数値の取得
+    # 定義によると、区切り文字は、カンマ、空白（複数可）、改行文字が可
+    tokens = data[tilt.end():].replace(b',', b' ').split()                      # 空白と改行で区切ったバイト列のリスト
+    
+    # TILT行に続く10項目と、器具消費電力の行の3項目
+    no_of_lamps      = int(float(tokens[0]))                                    # ランプの数、小数で書かれている場合もある
+    lumens_per_lamp  =     float(tokens[1])                                     # ランプ当たりのルーメン
+    multiplier       =     float(tokens[2])                                     # 掛け値
+    no_of_theta      = int(float(tokens[3]))                                    # 鉛直角度の数
+    no_of_phi        = int(float(tokens[4]))                                    # 水平角度の数
+    photometric_type = int(float(tokens[5]))                                    # 測光型、1=TypeC、2=TypeB、3=TypeA
+    
+    wattage = float(tokens[12])                                                 # 器具消費電力、13番目の要素
+    if wattage == 0:                                                            # 器具消費電力が0の場合
+        wattage = '?'                                                           # 不正確だと思われるので、?を代入
+    
+    # 鉛直角度ラベル、水平角度ラベル、配光データを一度に小数化
+    no_of_values = no_of_theta + no_of_phi + no_of_theta * no_of_phi            # 必要な数値の数
+    if len(tokens) < 13 + no_of_values:                                         # 数値が足りない場合
+        raise ValueError('not enough values: ' + str(file_path))
+    values = np.array(tokens[13 : 13 + no_of_values], dtype=np.float64)         # 一括で小数化、map関数よりも速い
+    
+    theta_label = values[:no_of_theta]                                          # 鉛直角度ラベル
+    phi_label   = values[no_of_theta : no_of_theta + no_of_phi]                 # 水平角度ラベル
+    ies_values  = values[no_of_theta + no_of_phi:].reshape(no_of_phi, no_of_theta) # 水平角度数 x 鉛直角度数 の配列
+    ies_values  = ies_values * multiplier                                       # 光度*掛け値、lm当たりの光度になってる場合があるため
+    
+    ies_raw = pd.DataFrame(ies_values, index=phi_label, columns=theta_label)
+    
+    # 角度数は切り出しで一致しているので、角度の範囲だけ確認
+    # SQliteに読み込まれ、後の計算でエラーを起こすことがある
+    if not (theta_label[0 ] in [-90, 0              ]
+       and  theta_label[-1] in [     0, 90, 180     ]
+       and  phi_label  [0 ] in [-90, 0              ]
+       and  phi_label  [-1] in [     0, 90, 180, 360]):
+       ies_raw = None                                                           # Noneを代入し、次の標準化でエラーを起こす
+    
+    return manufac, lumcat, luminaire, lamp, wattage, ies_raw
+
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 配光データの読み込み(LDT)
 
@@ -309,9 +506,9 @@ def read_ldt_raw(file_path):
     
     # CSVの読み込み
     csv = []
-    with codecs.open(file_path,'r','utf-8','ignore') as f:
-        for line in f:                                                          # 一行ずつ読み込み
-            csv.append(line)                                                    # リストに追加する
+    text = read_photometric_bytes(file_path).decode('utf-8', 'ignore')          # zipやtarの中のファイルにも対応
+    for line in text.splitlines():                                              # 一行ずつ読み込み
+        csv.append(line)                                                        # リストに追加する
     csv = [c.strip() for c in csv]                                              # 文字列前後の空白を除く、iesと異なり空白行は除かない
     
     # 照明器具メーカー、型名、型番
@@ -367,31 +564,93 @@ def read_ldt_raw(file_path):
     return manufac, lumcat, luminaire, lamp, wattage, ies_raw
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
-# 配光データの読み込み・標準化(IESとLDT)
+# 配光データの一括読み込み(LDT)、対称性の指標に従い、格納された面だけを読み込む
+
+def ldt_plane_index(isym, no_of_phi):
+    
+    # 全水平角度(C面)の番号 k に対し、格納された何番目の面を使うかを返す
+    # Isym 0:対称なし、1:鉛直軸対称、2:C0-C180面対称、3:C90-C270面対称、4:C0-C180とC90-C270面対称
+    k    = np.arange(no_of_phi)                                                 # C面の番号、0 ～ Mc-1
+    half = no_of_phi // 2                                                       # C180の番号
+    
+    if   isym == 0:                                                             # 対称なし
+         index = k
+    elif isym == 1:                                                             # 鉛直軸対称、C0のみ格納
+         index = np.zeros(no_of_phi, dtype=int)
+    elif isym == 2:                                                             # C0-C180面対称、C0 ～ C180を格納
+         index = np.where(k <= half, k, no_of_phi - k)                          # C180を超える面は、C0-C180面で折り返す
+    elif isym == 3:                                                             # C90-C270面対称、C270 ～ C0 ～ C90を格納
+         start = no_of_phi * 3 // 4                                             # C270の番号
+         k     = np.where((k > no_of_phi // 4) & (k < start), half - k, k)      # C90 ～ C270の間の面は、C90-C270面で折り返す
+         index = (k - start) % no_of_phi                                        # C270を0番目とした番号
+    elif isym == 4:                                                             # 両面対称、C0 ～ C90を格納
+         k     = np.where(k <= half, k, no_of_phi - k)                          # C0-C180面で折り返し
+         index = np.where(k <= half // 2, k, half - k)                          # C90-C270面で折り返し
+    else:
+         raise ValueError('unknown symmetry indicator: ' + str(isym))
+    
+    return index
 
-def read_ies(file_path):                                                        # read_ies_raw関数を使用
+def read_ldt_raw_bulk(file_path, data=None):                                    # dataは、読み込み済みのバイト列
     
-    # ファイルの種類で場合分け
-    file_extention = file_path[-4:]                                             # ファイルの拡張子を取得
+    # ファイル全体を一度に読み込み、行に分ける
+    if data is None:
+        data = read_photometric_bytes(file_path)                                # zipやtarの中のファイルにも対応
+    csv = data.decode('utf-8', 'ignore').splitlines()
+    csv = [c.strip() for c in csv]                                              # 文字列前後の空白を除く、iesと異なり空白行は除かない
     
-    if   file_extention == '.ies' or file_extention =='.IES':                   # ies ファイルなら
-         manufac, lumcat, luminaire, lamp, wattage, ies_raw = \
-         read_ies_raw(file_path)    # iesを読み込み、データフレーム化
-    elif file_extention == '.ldt' or file_extention =='.LDT':                   # ldt ファイルなら
-         manufac, lumcat, luminaire, lamp, wattage, ies_raw = \
-         read_ldt_raw(file_path)    # ldtを読み込み、データフレーム化
-        
-    else:                                                                       # 配光データでないなら
-         print('file is neither ies nor ldt')
+    # 照明器具メーカー、型名、型番
+    manufac         = csv[0]                                                    # 1行目、メーカー名
+    luminaire       = csv[8]                                                    # 8行目、型名
+    lumcat          = csv[9]                                                    # 9行目、型番
     
-    '''
-    # 稀に最後の値が0でない場合がある
-    # 0でないと、欠損値の補完が正しく行われない
-    for row in ies_raw.iterrows():                                              # 行ごとに繰り返す、返り値はタプル
-        if  row[1].values[-1]!=0:                                               # ２つ目の要素がシリーズ、稀に最後の値が0でない場合がある
-            ies_raw.loc[:,ies_raw.columns[-1]+0.5]=0                            # 0.5度次の列を作成し、0を入力
-            break
-    '''
+    # 対称性の指標、鉛直と水平角度の数
+    isym            = int(csv[2])                                               # 2行目、対称性の指標、整数化
+    no_of_phi       = int(csv[3])                                               # 3行目、水平角度の数、整数化、360度を含まない
+    no_of_theta     = int(csv[5])                                               # 5行目、鉛直角度の数、整数化
+    
+    n = int(csv[25])                                                            # 25行目、標準時のランプの数、整数化
+    lamp            = csv[26 + n]                                               # 26行目 + n行、複数の場合もあるが、ひとつ目のみ
+    
+    lumen   = np.array(csv[26 + (n*2) : 26 + (n*3)], dtype=np.float64).sum()    # 各ランプごとの光束の合計値
+    wattage = np.array(csv[26 + (n*5) : 26 + (n*6)], dtype=np.float64).sum()    # 各光源の消費電力の合計値
+    wattage = float(wattage)
+    multiplier = lumen / 1000                                                   # klmに変換
+    
+    # 水平角度ラベル、鉛直角度ラベル、格納された面の配光データを一度に小数化
+    index = ldt_plane_index(isym, no_of_phi)                                    # 全C面に対する、格納された面の番号
+    no_of_planes = index.max() + 1                                              # 格納された面の数
+    i = 25 + (n*6) + 10 + 1                                                     # 25行目 + n*6行 + 10行(DR)の次の行
+    block  = csv[i : i + no_of_phi + no_of_theta + no_of_planes * no_of_theta]
+    block  = [c for c in block if c != '']                                      # ファイル末尾の空白行を除く
+    values = np.array(block, dtype=np.float64)                                  # 一括で小数化、map関数よりも速い
+    
+    phi_label   = values[:no_of_phi]                                            # 水平角度ラベル
+    theta_label = values[no_of_phi : no_of_phi + no_of_theta]                   # 鉛直角度ラベル
+    stored      = values[no_of_phi + no_of_theta:]                              # 格納された面の配光データ
+    
+    no_of_stored = len(stored) // no_of_theta                                   # 実際に格納されていた面の数
+    stored = stored[:no_of_stored * no_of_theta].reshape(no_of_stored, no_of_theta)
+    if no_of_stored < no_of_planes:                                             # 面が足りない場合は、read_ldt_rawと同様にφ=0度の面で補う
+        stored = np.vstack([stored, np.repeat(stored[:1], no_of_planes - no_of_stored, axis=0)])
+    
+    # 対称性に従い、全C面に展開し、φ=0度の面をφ=360度の面として追加
+    ies_values = stored[np.append(index, index[0])]                             # 折り返しは番号の配列による取り出しのみ
+    ies_values = ies_values * multiplier                                        # 光度*掛け値、klm当たりの光度になってる
+    phi_label  = np.append(phi_label, 360)                                      # iesに合わせ、360度を追加
+    
+    ies_raw = pd.DataFrame(ies_values, index=phi_label, columns=theta_label)
+    
+    return manufac, lumcat, luminaire, lamp, wattage, ies_raw
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 配光データの標準化(配列)、データフレームを使わない
+
+def mirror_labels(phi_label, theta_label, values):
+    
+    phi_label   = np.asarray(phi_label,   dtype=np.float64)
+    theta_label = np.asarray(theta_label, dtype=np.float64)
+    values      = np.asarray(values,      dtype=np.float64)
     
     # 鉛直角度
     # TypeA 0度から90度 or -90度から90度
@@ -399,99 +658,352 @@ def read_ies(file_path):
     # TypeC 0度から90度 or  90度から180度 or 0度から180度
     # TypeCが一番多い
     
-    if  ies_raw.columns.min() == -90:                                           # 鉛直角度が-90度で始まる場合
-        ies_raw.columns = ies_raw.columns + 90                                  # 0度始まりにする
+    if  theta_label.min() == -90:                                               # 鉛直角度が-90度で始まる場合
+        theta_label = theta_label + 90                                          # 0度始まりにする
     
     # 水平角度
     # TypeA 0度から90度 or -90度から90度
     # TypeB 0度から90度 or -90度から90度
-    # TypeC 0度のみ or 0度から90度 or 0度から180度 or 0度から360度 
+    # TypeC 0度のみ or 0度から90度 or 0度から180度 or 0度から360度
     # TypeCが一番多い
     
-    if  ies_raw.index.min() == -90:                                             # 水平角度が-90度で始まる場合
-        ies_raw.index = ies_raw.index + 90                                      # 0度始まりにする
+    if  phi_label.min() == -90:                                                 # 水平角度が-90度で始まる場合
+        phi_label = phi_label + 90                                              # 0度始まりにする
     
-    # 水平角が0度で省略、1度から360度を補完
-    if  ies_raw.index.max() == 0: 
-        pass
+    # 水平角が0度で省略の場合は、次の補間で、0度の値が360度まで続く
     
     # 水平角が90度で省略、91度から180度を補完
-    if  ies_raw.index.max() == 90:                                              # 最大水平角度が90度の場合
-        ies_mirrored = ies_raw.iloc[:-1,:]                                      # 90度の行を除く        例: 0,1,,,89,90 >> 0,1,,,89
-        ies_mirrored = ies_mirrored[::-1]                                       # 行の順番を逆にする     例: 0,1,,,89 >> 89,,,1,0
-        ies_mirrored_index = 180 - ies_mirrored.index                           # 反転した行ラベルを作成、例: 180-89,,,180-0 >> 91,,,180
-        ies_mirrored.index = ies_mirrored_index                                 # 行ラベルを変更
-        ies_raw = ies_raw.append(ies_mirrored)
+    if  phi_label.max() == 90:                                                  # 最大水平角度が90度の場合
+        phi_label = np.append(phi_label, 180 - phi_label[-2::-1])               # 90度を除き逆順に、例: 0,1,,,89 >> 91,,,180
+        values    = np.vstack([values, values[-2::-1]])                         # 行も同じ順番で追加
     
     # 水平角が180度で省略、181度から360度を補完
-    if  ies_raw.index.max() == 180:                                             # 最大水平角度が180度の場合
-        ies_mirrored = ies_raw.iloc[:-1,:]                                      # 180度の行を除く       例: 0,1,,,179,180 >> 0,1,,,179
-        ies_mirrored = ies_mirrored[::-1]                                       # 行の順番を逆にする     例: 0,1,,,179 >> 179,,,1,0
-        ies_mirrored_index = 360 - ies_mirrored.index                           # 反転した行ラベルを作成、例: 360-179,,,360-0 >> 181,,,360
-        ies_mirrored.index = ies_mirrored_index                                 # 行ラベルを変更
-        ies_raw = ies_raw.append(ies_mirrored)
-        
-    # iesを代入する標準データフレームを作成
-    theta_label = np.arange(0,180.5,0.5)                                        # 列ラベルの作成、0.5度刻み、値は小数
-    phi_label   = np.arange(0,360.5,0.5)                                        # 行ラベルの作成、0.5度刻み、値は小数
-    ies = pd.DataFrame(0, columns=theta_label, index=phi_label)                 # 空のデータフレーム
+    if  phi_label.max() == 180:                                                 # 最大水平角度が180度の場合
+        phi_label = np.append(phi_label, 360 - phi_label[-2::-1])               # 180度を除き逆順に、例: 0,1,,,179 >> 181,,,360
+        values    = np.vstack([values, values[-2::-1]])
+    
+    return phi_label, theta_label, values
+
+def interp_table(source_label, target_label):
+    
+    # 線形補間の表、元の角度の何番目と何番目の間か、その距離
+    # 位置は0.5度刻みの番号、pandasのinterpolate(method='linear')と同じ計算になる
+    # 範囲より前は欠損(0)、範囲より後は最後の値が続く
+    
+    source = np.asarray(source_label, dtype=np.float64) * 2                     # 0.5度刻みの番号、0 ～ 720
+    target = np.asarray(target_label, dtype=np.float64) * 2
+    
+    hi = np.searchsorted(source, target, side='right')                          # targetより大きい最初の元の角度の番号
+    lo = hi - 1                                                                 # target以下の最後の元の角度の番号
+    before = lo < 0                                                             # 元の角度の範囲より前
+    after  = hi >= len(source)                                                  # 元の角度の範囲より後、最後の値を続ける
+    
+    lo = np.clip(lo, 0, len(source) - 1)
+    hi = np.where(after, lo, np.clip(hi, 0, len(source) - 1))
+    span   = np.where(after | before, 1, source[hi] - source[lo])               # 元の角度の間隔、0で割らないよう1に
+    offset = np.where(after | before, 0, target - source[lo])                   # 下側の元の角度からの距離
+    
+    # 元の角度が標準形の1度刻みと揃った等間隔の場合は、補間の表を使わない
+    # 0.5度、1度刻みは間引くだけ、2度以上の整数刻み(5度、10度...)は区間ごとに一度に補間
+    regular = None
+    step    = np.diff(source)
+    if (len(source) >= 2 and (step == step[0]).all()                            # 等間隔
+        and np.array_equal(target, np.arange(len(target)) * 2)                  # 目標は0度始まりの1度刻み
+        and source[0] % 2 == 0 and source[-1] % 2 == 0                          # 最初と最後が整数の角度
+        and source[-1] <= target[-1]):
+        n_before = int(source[0] // 2)                                          # 範囲より前の数
+        n_after  = int((target[-1] - source[-1]) // 2)                          # 範囲より後の数
+        if   step[0] in [1, 2]:                                                 # 0.5度、1度刻み
+             regular = ('slice', int(2 // step[0]), n_before, n_after)          # 間引き間隔
+        elif step[0] % 2 == 0:                                                  # 2度以上の整数刻み
+             regular = ('lerp',  int(step[0] // 2), n_before, n_after)          # 区間の度数
+    
+    return lo, hi, span, offset, before, regular
+
+def interp_apply(values, table, axis):
+    
+    # axis=-1:θ方向、axis=-2:φ方向、3次元の配列にも使える
+    lo, hi, span, offset, before, regular = table
+    
+    values = np.moveaxis(values, axis, -1)
+    
+    if regular is not None:                                                     # 等間隔の場合
+        return np.moveaxis(interp_regular(values, regular), -1, axis)
+    
+    lower  = values[..., lo]
+    slope  = (values[..., hi] - lower) / span                                   # np.interpと同じ順番で計算、誤差も一致
+    result = slope * offset + lower
+    result[..., before] = np.nan                                                # 範囲より前は欠損
+    
+    return np.moveaxis(result, -1, axis)
+
+def interp_regular(values, regular):
+    
+    # 最後の軸を、等間隔の元の角度から1度刻みに
+    # 計算の順番はinterp_applyと同じで、誤差も一致
+    mode, step, n_before, n_after = regular
+    
+    if mode == 'slice':                                                         # 0.5度、1度刻みは間引くだけ
+        middle = values[..., ::step]
+    else:                                                                       # 2度以上の整数刻み
+        lower  = values[..., :-1]
+        slope  = (values[..., 1:] - lower) / (2 * step)                         # 区間ごとの傾き
+        middle = slope[..., None] * (np.arange(step) * 2) + lower[..., None]    # 区間数 x 区間の度数
+        middle = middle.reshape(values.shape[:-1] + (-1,))                      # 1度刻みに並べる
+        middle = np.concatenate([middle, values[..., -1:]], axis=-1)            # 最後の角度を追加
+    
+    before = np.full(values.shape[:-1] + (n_before,), np.nan)                   # 範囲より前は欠損
+    after  = np.repeat(values[..., -1:], n_after, axis=-1)                      # 範囲より後は最後の値が続く
+    
+    return np.concatenate([before, middle, after], axis=-1)
+
+def select_labels(phi_label, theta_label, values):
+    
+    # 折り返した後、標準形にある角度ラベルと配光データのみ残す
+    phi_label, theta_label, values = mirror_labels(phi_label, theta_label, values)
     
     # θ方向は、2.5度刻みで測定したiesがある
     # φ方向は、22.5度刻みで測定したiesがある
-    # 標準形式の角度を1度刻みにすると
-    # 0度、5度...
     
     # θ方向は、0.1度刻みで測定したiesがある(例：カラーキネティクス)
-    # 標準形の0.5度刻みにない角度があると
-    # データフレームを合成時、721行 x 361列より大きくなり、エラー発生
-    # 標準形の角度と重複するもののみ抽出する
+    # 標準形の0.5度刻みにある角度のみ抽出する
     # 例えば、0.1度刻みなら、0度、0.5度、1度...
-    # 例えば、0.2度刻みなら、0度、1度...
-    # 0.2度はまだないが、0.4度と0.6度の情報は失われ、0.5度を再計算
+    # 0.4度と0.6度の情報は失われ、0.5度を再計算
+    
+    phi_label,   phi_index   = np.unique(phi_label,   return_index=True)        # 昇順、重複は最初のもの
+    theta_label, theta_index = np.unique(theta_label, return_index=True)
+    phi_mask   = np.isin(phi_label,   np.arange(0,360.5,0.5))                   # 標準形にある行のみ
+    theta_mask = np.isin(theta_label, np.arange(0,180.5,0.5))                   # 標準形にある列のみ
+    values = values[np.ix_(phi_index[phi_mask], theta_index[theta_mask])]
+    
+    return phi_label[phi_mask], theta_label[theta_mask], values
+
+def standardize_ies(phi_label, theta_label, values):
+    
+    # 元の角度ラベルと配光データから、1度刻みの361行 x 181列の配列を作成
+    phi_label, theta_label, values = select_labels(phi_label, theta_label, values)
+    
+    # θ方向の補間をしてから、φ方向の補間
+    ies = interp_apply(values, interp_table(theta_label, np.arange(181)), axis=-1)
+    ies = interp_apply(ies,    interp_table(phi_label,   np.arange(361)), axis=-2)
+    
+    ies[np.isnan(ies)] = 0                                                      # 欠損を0に
+    
+    # 361行 x 181列 の配列
+    #       0   1 ... 180
+    #   0   -   -   -   -
+    #   1   -   -   -   -
+    #   .   -   -   -   -
+    #   .   -   -   -   -
+    # 360   -   -   -   -
+    
+    return ies
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 配光データの読み込み(IESとLDT)
+
+def read_raw(file_path, parser='bulk', data=None):                              # 拡張子で、iesとldtの読み込みを切り替える、parserは'bulk'か'line'
+    
+    # ファイルの種類で場合分け
+    file_extention = str(file_path)[-4:]                                        # ファイルの拡張子を取得
+    
+    if   file_extention == '.ies' or file_extention =='.IES':                   # ies ファイルなら
+         if parser == 'bulk':
+             try:
+                 manufac, lumcat, luminaire, lamp, wattage, ies_raw = \
+                 read_ies_raw_bulk(file_path, data)                             # iesを一括で読み込み、データフレーム化
+             except Exception:                                                  # 一括で読めない場合は、行ごとの読み込みで再度試す
+                 manufac, lumcat, luminaire, lamp, wattage, ies_raw = \
+                 read_ies_raw(file_path)
+         else:
+             manufac, lumcat, luminaire, lamp, wattage, ies_raw = \
+             read_ies_raw(file_path)    # iesを読み込み、データフレーム化
+    elif file_extention == '.ldt' or file_extention =='.LDT':                   # ldt ファイルなら
+         if parser == 'bulk':
+             try:
+                 manufac, lumcat, luminaire, lamp, wattage, ies_raw = \
+                 read_ldt_raw_bulk(file_path, data)                             # ldtを一括で読み込み、対称性に従い展開
+             except Exception:                                                  # 一括で読めない場合は、行ごとの読み込みで再度試す
+                 manufac, lumcat, luminaire, lamp, wattage, ies_raw = \
+                 read_ldt_raw(file_path)
+         else:
+             manufac, lumcat, luminaire, lamp, wattage, ies_raw = \
+             read_ldt_raw(file_path)    # ldtを読み込み、データフレーム化
+        
+    else:                                                                       # 配光データでないなら
+         print('file is neither ies nor ldt')
+    
+    '''
+    # 稀に最後の値が0でない場合がある
+    # 0でないと、欠損値の補完が正しく行われない
+    for row in ies_raw.iterrows():                                              # 行ごとに繰り返す、返り値はタプル
+        if  row[1].values[-1]!=0:                                               # ２つ目の要素がシリーズ、稀に最後の値が0でない場合がある
+            ies_raw.loc[:,ies_raw.columns[-1]+0.5]=0                            # 0.5度次の列を作成し、0を入力
+            break
+    '''
+    
+    return manufac, lumcat, luminaire, lamp, wattage, ies_raw
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 角度の格子(φとθの開始角度・終了角度・間隔)
+
+# 光度の配列と一次元化したベクトルに付け、一次元と二次元の変換を、reshapeのみにする
+# 以前は、two_to_oneのたびに"270-90"のような文字列のラベルを65341個作り、one_to_twoで分解していた
+# 文字列のラベルは、データフレームに書き出す時のみ作る(grid_labels)
+# 変更できず、ハッシュ化できるので、辞書のキーやキャッシュの引数に使える
+
+class AngularGrid(collections.namedtuple('AngularGrid', ['phi_start',   'phi_stop',   'phi_step',
+                                                         'theta_start', 'theta_stop', 'theta_step'])):
+    
+    __slots__ = ()                                                              # 属性を追加せず、タプルのまま
     
-    ies_raw = ies_raw.loc[np.intersect1d(ies_raw.index, phi_label),
-                          np.intersect1d(ies_raw.columns, theta_label)]         # 標準形にある列と行のみ抽出、intersect1dは重複要素の抽出
+    @property
+    def phi(self):                                                              # 行の角度ラベル、終了角度を含む
+        return range(self.phi_start, self.phi_stop + 1, self.phi_step)
     
-    # iesを代入し、欠損値処理
-    ies = ies + ies_raw                                                         # 配光データを標準化。データのある部分は数字、ない部分はNan
+    @property
+    def theta(self):                                                            # 列の角度ラベル、終了角度を含む
+        return range(self.theta_start, self.theta_stop + 1, self.theta_step)
     
-    # 721行 x 361列 のデータフレーム
-    #       0.0   0.5   1.0   ... 179.5 180.0
-    #   0.0   -     -     -     -     -     -
-    #   0.5   -     -     -     -     -     -
-    #   1.0   -     -     -     -     -     -
-    #   .     -     -     -     -     -     -
-    #   .     -     -     -     -     -     -
-    # 359.5   -     -     -     -     -     -
-    # 360.0   -     -     -     -     -     -
+    @property
+    def shape(self):
+        return len(self.phi), len(self.theta)
     
-    ies = ies.interpolate(method='linear',axis=1)                               # θ方向の欠損地を埋める、inplaceも試すが、速度変わらず
-    ies = ies.iloc[:,range(0,361,2)]                                            # θ方向の次元の削減、0.5度から、1度刻みに
+    @property
+    def size(self):
+        return len(self.phi) * len(self.theta)
     
-    # θ方向の次元削減してから、
-    # φ方向の欠損値処理
-    # 約2割速い
+    def sub(self, phi_slice, theta_slice):                                      # 行と列の位置のスライスから、部分の格子
+        return grid_from_labels(self.phi[phi_slice], self.theta[theta_slice])
+
+@functools.lru_cache(maxsize=None)
+def angular_grid(phi_start, phi_stop, phi_step,                                 # 解像度ごとに一つだけ作る
+                 theta_start, theta_stop, theta_step):
+    return AngularGrid(phi_start, phi_stop, phi_step, theta_start, theta_stop, theta_step)
+
+def grid_from_labels(phi_label, theta_label):                                   # 引数は、等間隔の整数の角度ラベル、rangeかリスト
+    
+    ranges = []
+    for label in (phi_label, theta_label):
+        if not isinstance(label, range):
+            label = [float(a) for a in label]                                   # データフレームの行名、列名は、小数の場合もある
+            step  = label[1] - label[0] if len(label) > 1 else 1
+            if not all(a.is_integer() for a in label) or \
+               [a - label[0] for a in label] != [k * step for k in range(len(label))]:
+                raise ValueError('angle labels are not evenly spaced integers: ' + str(label[:3]) + '...')
+            label = range(int(label[0]), int(label[-1]) + 1, int(step))
+        ranges.append(label)
+    phi_label, theta_label = ranges
+    
+    return angular_grid(phi_label[0],   phi_label[-1],   phi_label.step,
+                        theta_label[0], theta_label[-1], theta_label.step)
+
+@functools.lru_cache(maxsize=None)
+def grid_labels(grid, prefix=''):                                               # データフレームの列名、例: 'theta_' + '270-90'、格子ごとに一度だけ作る
+    return tuple(prefix + str(i) + '-' + str(j) for i in grid.phi for j in grid.theta)
+
+def grid_from_size(size):                                                       # 要素数から、既知の格子を探す、なければNone
+    return KNOWN_GRIDS.get(size)
+
+FULL_GRID       = angular_grid(0, 360,  1, 0, 180, 1)                           # 361行 x 181列、65341要素
+IES_GRID        = angular_grid(0, 360, 10, 0, 180, 5)                           # 列2の光度、37行 x 37列、1369要素
+DIFF_THETA_GRID = angular_grid(0, 350, 10, 0, 185, 5)                           # 列3の前半、θ方向の差分、36行 x 38列、1368要素
+DIFF_PHI_GRID   = angular_grid(0, 360, 10, 5, 175, 5)                           # 列3の後半、φ方向の差分、37行 x 35列、1295要素
+KNOWN_GRIDS     = {grid.size: grid for grid in (FULL_GRID, IES_GRID)}           # 要素数が重ならない光度の格子
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 配光データの配列と角度ラベル
+
+# 特徴量の計算では、データフレームを使わない
+# .iloc、.shift、.appendなどは、そのたびに新しいデータフレームを作り、1照明器具で数十ミリ秒かかる
+# 光度は連続した配列、φ(行)とθ(列)の角度ラベルは角度の格子(AngularGrid)で、変更しない
+# index、columns、values、shapeは、データフレームと同じ名前なので、two_to_oneなどはそのまま使える
+# データフレームにするのは、描画や書き出しの時のみ(to_df)
+
+class Photometry:
+    
+    __slots__ = ('values', 'grid')
+    
+    def __init__(self, values, grid=None):                                      # 格子を省くと、0始まりの1度刻み
+        self.values = np.ascontiguousarray(values)
+        if grid is None:
+            grid = angular_grid(0, self.values.shape[0] - 1, 1, 0, self.values.shape[1] - 1, 1)
+        self.grid   = grid
+    
+    @property
+    def phi(self):
+        return self.grid.phi
+    
+    @property
+    def theta(self):
+        return self.grid.theta
+    
+    @property
+    def index(self):                                                            # データフレームの行名と同じ
+        return self.grid.phi
     
-    ies = ies.interpolate(method='linear',axis=0)                               # φ方向の欠損地を埋める、inplaceも試すが、速度変わらず
-    ies = ies.iloc[range(0,721,2),:]                                            # φ方向の次元の削減、0.5度から、1度刻みに
+    @property
+    def columns(self):                                                          # データフレームの列名と同じ
+        return self.grid.theta
     
-    # φ方向の次元削減してから、
-    # 欠損値処理
+    @property
+    def shape(self):
+        return self.values.shape
     
-    ies.fillna(0, inplace=True)                                                 # Nanを0に変換、fillnaは、再代入より、inplaceの方が速い
+    def at(self, phi, theta):                                                   # 角度ラベルで値を参照、ies.loc[phi, theta]と同じ
+        return self.values[self.phi.index(phi), self.theta.index(theta)]
     
-    # 361行 x 181列 のデータフレーム
-    #       0.0   1.0   ... 180.0
-    #   0.0   -     -     -     -
-    #   1.0   -     -     -     -
-    #   .     -     -     -     -
-    #   .     -     -     -     -
-    # 360.0   -     -     -     -
+    def copy(self):
+        return Photometry(self.values.copy(), self.grid)
     
-    ies.index   = [int(i) for i in ies.index  ]                                 # 水平角ラベルを整数化
-    ies.columns = [int(c) for c in ies.columns]                                 # 鉛直角ラベルを整数化
+    def to_df(self):
+        return pd.DataFrame(self.values, index=list(self.phi), columns=list(self.theta))
     
-    # 361行 x 181列 のデータフレーム
+    def __repr__(self):
+        return ('Photometry(' + str(self.shape[0]) + ' x ' + str(self.shape[1]) + ', phi '
+                + str(self.grid.phi_start) + '-' + str(self.grid.phi_stop) + ', theta '
+                + str(self.grid.theta_start) + '-' + str(self.grid.theta_stop) + ')')
+
+class PhotometryVector:
+    
+    # two_to_oneの返り値、一次元化した光度と、元の角度の格子
+    # one_to_twoは、格子の形にreshapeするだけ、コピーなし
+    __slots__ = ('values', 'grid')
+    
+    def __init__(self, values, grid):
+        self.values = np.ascontiguousarray(values).ravel()
+        self.grid   = grid
+    
+    @property
+    def index(self):                                                            # シリーズの行名と同じ、使う時にのみ作る
+        return grid_labels(self.grid)
+    
+    def __len__(self):
+        return self.values.size
+    
+    def to_series(self):
+        return pd.Series(self.values, index=grid_labels(self.grid))
+    
+    def __repr__(self):
+        return 'PhotometryVector(' + str(self.values.size) + ', ' + repr(self.grid) + ')'
+
+def as_photometry(ies):                                                         # 引数は、Photometry、データフレーム、361行 x 181列の配列
+    
+    if isinstance(ies, Photometry):
+        return ies
+    if isinstance(ies, pd.DataFrame):
+        return Photometry(ies.values, grid_from_labels(ies.index, ies.columns))
+    
+    return Photometry(ies)                                                      # 整数の角度ラベル
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 配光データの照射方向の調整
+
+def orient_ies(ies):
+    
+    ies = as_photometry(ies)                                                    # 整数の角度ラベル
+    
+    # 361行 x 181列 の配列
     #       0   1 ... 180
     #   0   -   -   -   -
     #   1   -   -   -   -
@@ -503,63 +1015,272 @@ def read_ies(file_path):
     rotation_angle = cal_direction(ies) * -1                                    # 照射方向を0度にするので、-1を掛ける
     ies = rotate_ies(ies, rotation_angle)                                       # 水平照射方向の回転
     
+    return ies
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 配光データの読み込み・標準化(IESとLDT)
+
+def read_ies(file_path, parser='bulk', cache=True, data=None, orient=True, file_hash=None): # read_raw関数を使用、parserは'bulk'か'line'、dataは読み込み済みのバイト列、file_hashはその中身のハッシュ
+    
+    # orient=Falseなら、照射方向を調整せず、標準化した361行 x 181列の配列を返す
+    
+    # make_lightで作ったキャッシュがあれば、読み込みと標準化を省く
+    if cache and orient:
+        if data is None and file_hash is None:                                  # キャッシュがなければ読み込みにも使うので、一度だけ読む
+            data = read_photometric_bytes(file_path)
+        cached = load_cache(file_path, file_hash, data)
+        if cached is not None:
+            return tuple(cached[:6])                                            # メーカー名, 型番, 型名, 光源, 消費電力, 配光データ
+    
+    manufac, lumcat, luminaire, lamp, wattage, ies_raw = read_raw(file_path, parser, data)
+    
+    # 配列のまま、1度刻みの361行 x 181列に標準化
+    # 721行 x 361列のデータフレームは作らない
+    ies = standardize_ies(ies_raw.index.values, ies_raw.columns.values, ies_raw.values)
+    if orient:
+        ies = orient_ies(ies)
+    
     return manufac, lumcat, luminaire, lamp, wattage, ies
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
-# 天頂と天底の重複を削除
+# 配光データの一括読み込み・標準化、角度ラベルが同じファイルをまとめて補間
 
-def remove_duplicates(ies):
+def read_ies_batch(file_paths, parser='bulk', orient=True, datas=None,
+                   errors=None):                                                # 引数は、iesとldtへのパスのリスト、datasはファイルパスごとの読み込み済みのバイト列、errorsは読めなかったファイルのトレースバックを入れる辞書
+    
+    # 同じメーカーのフォルダでは、数百のファイルが同じ角度ラベルを持つ
+    # 例: θ 0 ～ 90度 2.5度刻み、φ 0 ～ 360度 22.5度刻み
+    # 角度ラベルの組でグループ分けし、配光データを3次元に重ね、
+    # グループごとに一度だけ作った補間の表で、まとめて補間する
+    
+    raws   = {}                                                                 # ファイルパスごとの基本情報
+    groups = {}                                                                 # 角度ラベルの組ごとのファイルパスと配光データ
+    for file_path in file_paths:
+        try:
+            data = datas.get(file_path) if datas else None
+            manufac, lumcat, luminaire, lamp, wattage, ies_raw = read_raw(file_path, parser, data)
+            phi_label, theta_label, values = select_labels(ies_raw.index.values, ies_raw.columns.values, ies_raw.values)
+        except:                                                                 # 読めないファイルは除く、エラー内容はerrorsに
+            if errors is not None:
+                errors[file_path] = traceback.format_exc()
+            continue
+        
+        signature = (tuple(phi_label), tuple(theta_label))                      # 角度ラベルの組
+        raws[file_path] = (manufac, lumcat, luminaire, lamp, wattage)
+        groups.setdefault(signature, []).append((file_path, values))
+    
+    # グループごとにまとめて補間
+    ies_data = {}
+    for (phi_label, theta_label), members in groups.items():
+        theta_table = interp_table(theta_label, np.arange(181))                 # グループで一度だけ作る
+        phi_table   = interp_table(phi_label,   np.arange(361))
+        
+        # 一度に重ねる数が多すぎると、中間の配列が大きくなり、かえって遅い
+        for k in range(0, len(members), 16):                                    # 16ファイルずつ重ねる
+            chunk = members[k : k+16]
+            stack = np.stack([values for file_path, values in chunk])           # ファイル数 x φ x θ の3次元配列
+            stack = interp_apply(stack, theta_table, axis=-1)                   # θ方向の補間
+            stack = interp_apply(stack, phi_table,   axis=-2)                   # φ方向の補間
+            stack[np.isnan(stack)] = 0                                          # 欠損を0に
+            
+            for (file_path, values), ies in zip(chunk, stack):
+                ies_data[file_path] = raws[file_path] + ((orient_ies(ies) if orient else ies),)
     
-    # 次元の削減に対応
-    # θとφの間隔を取得し
-    # 代入には、ilocではなく、locを使用
+    # 引数の順番に並べ直す、読めなかったファイルは含まない
+    ies_data = {file_path: ies_data[file_path] for file_path in file_paths if file_path in ies_data}
     
-    theta_interval, phi_interval = theta_phi_interval(ies) 
-    ies.loc[phi_interval:,[0,180]] = 0                                          # θ=0度と180度の重複する値を0に
+    return ies_data                                                             # 返り値は、ファイルパスをキー、read_iesと同じタプルを値とする辞書
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
-# 天頂と天底の重複を復元
+# 配光データのヘッダーのみの読み込み、配光データは使う時に読み込む
+
+# メーカー名、型番、光源、消費電力、ランプ光束、角度数のみ必要な場合
+# 例: カタログの一覧、光束の範囲による絞り込み、重複の確認
+# 光度の数値は読まず、小数化もしない
+
+class LazyLight:
+    
+    # 光度の配列は、ies属性に初めて触れた時にread_iesで読み込む
+    __slots__ = ('file_path', 'file_name', 'manufac', 'lumcat', 'luminaire', 'lamp',
+                 'wattage', 'lamp_lumens', 'no_of_theta', 'no_of_phi', '_ies')
+    
+    def __init__(self, file_path, manufac, lumcat, luminaire, lamp,
+                 wattage, lamp_lumens, no_of_theta, no_of_phi):
+        self.file_path   = file_path
+        self.file_name   = os.path.basename(file_path)[0:-4]                    # 拡張子を除く
+        self.manufac     = manufac
+        self.lumcat      = lumcat
+        self.luminaire   = luminaire
+        self.lamp        = lamp
+        self.wattage     = wattage
+        self.lamp_lumens = lamp_lumens                                          # ランプ光束の合計、絶対測光はNone
+        self.no_of_theta = no_of_theta
+        self.no_of_phi   = no_of_phi
+        self._ies        = None
+    
+    @property
+    def ies(self):
+        if self._ies is None:                                                   # 初めて触れた時のみ読み込む
+            self._ies = read_ies(self.file_path)[5]
+        return self._ies
+    
+    def __repr__(self):
+        return ('LazyLight(' + self.file_name + ', ' + str(self.manufac) + ', '
+                + str(self.lumcat) + ', ' + str(self.lamp_lumens) + ' lm)')
+
+@contextlib.contextmanager
+def open_photometric_file(file_path):
+    
+    # ファイル全体を読まず、先頭から読むためのファイルオブジェクト、withで使う
+    archive_path, member = split_archive_path(file_path)
+    
+    if member is None:                                                          # 通常のファイル
+        with open(archive_path, 'rb') as f:
+            yield f
+        return
+    
+    with archives_lock:                                                         # read_photometric_bytesと同じく、読み終わるまで閉じられないよう
+        archive = open_archive(archive_path)
+        if isinstance(archive, zipfile.ZipFile):
+            f = archive.open(member)
+        else:
+            f = archive.extractfile(member)
+        with f:
+            yield f
+
+def read_ies_header(file_path, chunk_size=4096):
+    
+    # TILT行と、続く13個の数値まで読んだら止める
+    data = b''
+    with open_photometric_file(file_path) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            data += chunk
+            tilt = re.search(rb'^[ \t]*TILT=.*$', data, re.M)                   # TILT=で始まる最初の行
+            if tilt is not None:
+                tokens = data[tilt.end():].replace(b',', b' ').split()
+                if len(tokens) > 13 or not chunk:                               # 13個目の数値が途中で切れていない
+                    break
+            if not chunk:                                                       # ファイルの最後
+                break
+    
+    if tilt is None:
+        raise ValueError('TILT= not found: ' + str(file_path))
+    if len(tokens) < 13:
+        raise ValueError('not enough values: ' + str(file_path))
+    
+    manufac, lumcat, luminaire, lamp = parse_ies_keywords(data[:tilt.start()])
+    
+    no_of_lamps      = int(float(tokens[0]))                                    # ランプの数
+    lumens_per_lamp  =     float(tokens[1])                                     # ランプ当たりのルーメン、絶対測光は-1
+    no_of_theta      = int(float(tokens[3]))                                    # 鉛直角度の数
+    no_of_phi        = int(float(tokens[4]))                                    # 水平角度の数
+    wattage          =     float(tokens[12])                                    # 器具消費電力
+    if wattage == 0:                                                            # read_ies_raw_bulkと同じく、0なら?
+        wattage = '?'
+    lamp_lumens = None if lumens_per_lamp < 0 else no_of_lamps * lumens_per_lamp
+    
+    return LazyLight(file_path, manufac, lumcat, luminaire, lamp,
+                     wattage, lamp_lumens, no_of_theta, no_of_phi)
+
+def read_ldt_header(file_path, chunk_size=4096):
+    
+    # 26行目 + n*6行、ランプの情報まで読んだら止める
+    data = b''
+    with open_photometric_file(file_path) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            data += chunk
+            csv = data.decode('utf-8', 'ignore').splitlines()
+            if len(csv) > 26:
+                n = int(csv[25])                                                # 標準時のランプの数
+                if len(csv) > 26 + (n*6):                                       # 最後の行が途中で切れていない
+                    break
+            if not chunk:
+                break
+    
+    csv = [c.strip() for c in csv]
+    n   = int(csv[25])
+    
+    manufac     = csv[0]                                                        # 1行目、メーカー名
+    luminaire   = csv[8]                                                        # 8行目、型名
+    lumcat      = csv[9]                                                        # 9行目、型番
+    no_of_phi   = int(csv[3])                                                   # 3行目、水平角度の数
+    no_of_theta = int(csv[5])                                                   # 5行目、鉛直角度の数
+    lamp        = csv[26 + n]                                                   # ひとつ目の光源
+    lamp_lumens = sum(map(float, csv[26 + (n*2) : 26 + (n*3)]))                 # 各ランプごとの光束の合計値
+    wattage     = sum(map(float, csv[26 + (n*5) : 26 + (n*6)]))                 # 各光源の消費電力の合計値
+    
+    return LazyLight(file_path, manufac, lumcat, luminaire, lamp,
+                     wattage, lamp_lumens, no_of_theta, no_of_phi)
+
+def read_header(file_path):
+    
+    file_extention = str(file_path)[-4:].lower()                                # ファイルの拡張子を取得
+    
+    if   file_extention == '.ies':
+         return read_ies_header(file_path)
+    elif file_extention == '.ldt':
+         return read_ldt_header(file_path)
+    else:
+         raise ValueError('file is neither ies nor ldt: ' + str(file_path))
 
-def restore_duplicates(ies):
+def read_headers(folder_path):                                                  # 引数は、メーカーなどのフォルダ
+    
+    start_time = time.time()
     
-    # 次元の削減に対応
-    # θとφの間隔を取得し
-    # 代入には、ilocではなく、locを使用
+    file_paths = list_photometric_files(folder_path)                            # zipやtarの中のファイルも含む
     
-    theta_interval, phi_interval = theta_phi_interval(ies)
-    ies.loc[phi_interval:,0  ] = ies.loc[0,0  ]                                 # θ=0度の0にした値を元に戻す
-    ies.loc[phi_interval:,180] = ies.loc[0,180]                                 # θ=180度の0にした値を元に戻す
+    headers          = []
+    unreadable_files = []
+    for file_path in file_paths:
+        try:
+            headers.append(read_header(file_path))
+        except:                                                                 # ヘッダーが壊れている可能性も
+            unreadable_files.append(os.path.basename(file_path))
+    
+    close_archives()                                                            # 開いたアーカイブを閉じる
+    
+    end_time = time.time()
+    elapse_time = round((end_time - start_time), 5)
+    print('read headers:   ', len(headers), ' files, ', len(unreadable_files), ' unreadable, ', elapse_time, ' sec')
+    
+    return headers                                                              # 返り値はLazyLightのリスト
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 配光データの一次元配列化(データフレームからシリーズ、次元削減に対応済み)
 
 def two_to_one(ies):
-    angle_label = [str(i)+'-'+str(j) for i in ies.index for j in ies.columns]   # 水平角度-鉛直角度を組み合わせたラベル、例: 270-90
-    ies_flat = ies.values.ravel()                                               # データフレームを配列化、一次元化
-    ies_1D   = pd.Series(ies_flat, index = angle_label)                         # シリーズ化
+    ies    = as_photometry(ies)
+    ies_1D = PhotometryVector(ies.values.ravel(), ies.grid)                     # 配列を一次元化し、角度の格子を付ける、文字列のラベルは作らない
     return ies_1D
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
-# 配光データの二次元配列化(シリーズからデータフレーム、次元削減に対応済み)
+# 配光データの二次元配列化(一次元からPhotometry、次元削減に対応済み)
 
-def one_to_two(ies_1D):
-    
-    phi_max        = int(float(re.split('-',ies_1D.index[-1])[0]))              # 最後の行ラベルの-より前が最大水平角度、小数化し整数化
-    theta_max      = int(float(re.split('-',ies_1D.index[-1])[1]))              # 最後の行ラベルの-より後が最大鉛直角度、小数化し整数化
-    theta_interval = int(float(re.split('-',ies_1D.index[1])[1]))               # 2番目の行ラベルの-より後が鉛直角度間隔、小数化し整数化
-    n = int(theta_max / theta_interval+1)                                       # 列の数、整数化、次元削減してなければ、n=181
-    phi_interval   = int(float(re.split('-',ies_1D.index[(n+1)])[0]))           # 次の水平角度の行ラベルの-より前が間隔、小数化し整数化
+def one_to_two(ies_1D, grid=None):                                              # 引数は、two_to_oneの返り値、シリーズ、配列、配列の場合はgridも
     
-    # 例:
-    # 鉛直角度最大値が90度で、鉛直角度間隔が10度の場合
-    # [0-10,0-20,0-30,0,40,0-50,0-60,0-70,0-80,0-90,10-0,...]
-    # nは9で、次の水平角度は10番目から
+    if grid is None:
+        grid = getattr(ies_1D, 'grid', None)                                    # two_to_oneの返り値は、格子を持つ
+    if grid is None:
+        grid = grid_from_size(len(ies_1D))                                      # to_df_iesの行など、要素数で既知の格子を探す
+    if grid is None:
+        
+        # 既知でない場合のみ、シリーズの行名から格子を求める
+        # 例:
+        # 鉛直角度最大値が90度で、鉛直角度間隔が10度の場合
+        # [0-0,0-10,0-20,...,0-90,10-0,...]
+        # 次の水平角度は10番目から
+        
+        last_label  = ies_1D.index[-1].split('-')                               # 最後の行ラベル、最大水平角度と最大鉛直角度
+        theta_max   = int(float(last_label[1]))
+        theta_step  = int(float(ies_1D.index[1].split('-')[1]))                 # 2番目の行ラベルの-より後が鉛直角度間隔
+        n           = theta_max // theta_step + 1                               # 列の数
+        phi_step    = int(float(ies_1D.index[n].split('-')[0]))                 # 次の水平角度の行ラベルの-より前が間隔
+        grid = angular_grid(0, int(float(last_label[0])), phi_step, 0, theta_max, theta_step)
     
-    phi_label   = list(range(0, phi_max+1,   phi_interval))                     # 次元削減してなければ、[0,1,,,360]
-    theta_label = list(range(0, theta_max+1, theta_interval))                   # 次元削減してなければ、[0,1,,,180]
-    m = len(phi_label)                                                          # 行の数、次元削減してなければ、n=361
-    ies = ies_1D.values.reshape(m,n)                                            # m x n の配列化
-    ies = pd.DataFrame(ies, index=phi_label, columns=theta_label)               # データフレーム化
+    values = np.asarray(getattr(ies_1D, 'values', ies_1D))                      # シリーズ、PhotometryVectorの値、配列
+    ies = Photometry(values.reshape(grid.shape), grid)                          # 格子の形にreshape、連続した配列ならコピーなし
     
     return ies
 
@@ -569,46 +1290,75 @@ def one_to_two(ies_1D):
 # 引数のiesは、361行x181列、鉛直角度は0-180度まで1度刻み、水平角度は0-360度まで1度刻み
 def reduce_dimensions(ies, theta_interval=1, phi_interval=1,                    # 引数のiesは、361行x181列
                            theta_max=180,    phi_max=360   ):                   # 鉛直角度0-180度まで1度刻み、水平角度0-360度まで1度刻み
-    theta_label = range(0, theta_max + 1 , theta_interval)                      # 抽出する水平角度のインデックスのリスト
-    phi_label   = range(0, phi_max + 1 , phi_interval)                          # 抽出する鉛直角度のインデックスのリスト
-    ies_small = ies.iloc[phi_label, theta_label]                                # データの抽出
+    ies = as_photometry(ies)
+    theta_label = slice(0, theta_max + 1 , theta_interval)                      # 抽出する鉛直角度の位置
+    phi_label   = slice(0, phi_max + 1 , phi_interval)                          # 抽出する水平角度の位置
+    ies_small = Photometry(ies.values[phi_label, theta_label],                  # データの抽出
+                           ies.grid.sub(phi_label, theta_label))
     return ies_small
 
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 次元の削減の索引表（1度刻みの65341要素の何番目を抽出するか）
+
+# 以前は、呼び出しのたびにwhileで索引のリストを作っていた
+# 間隔と最大角度の組ごとに一度だけ作り、変更できない配列で使い回す
+
+@functools.lru_cache(maxsize=None)
+def sub_grid_index(theta_interval=1, phi_interval=1, theta_max=180, phi_max=360):
+    
+    if not (0 <= theta_max <= 180 and 0 <= phi_max <= 360):
+        raise ValueError('sub grid exceeds 361 x 181: ' + str((theta_max, phi_max)))
+    
+    # 計算例:
+    # 0-0,  0-45,   0-90,  0-135、  0-180、 1-0,    1-45,...
+    # と鉛直角度45度、水平角度1度ごとに抽出する場合
+    # 0番目, 45番目, 90番目, 135番目, 180番目, 181番目, 226番目,...
+    # のindexを抽出することになる
+    # 一定間隔ではないので、φごとの先頭の番号とθの番号の和
+    
+    phi_id   = np.arange(0, phi_max+1,   phi_interval)                          # 抽出する水平角度の行の番号
+    theta_id = np.arange(0, theta_max+1, theta_interval)                        # 抽出する鉛直角度の列の番号
+    index    = (phi_id[:, None]*181 + theta_id).ravel()                         # 行の先頭の番号 + 列の番号、φ順
+    index.flags.writeable = False                                               # キャッシュを書き換えない
+    
+    return index
+
+@functools.lru_cache(maxsize=None)
+def sub_grid(theta_interval=1, phi_interval=1, theta_max=180, phi_max=360):     # 抽出後の角度の格子
+    return FULL_GRID.sub(slice(0, phi_max + 1, phi_interval), slice(0, theta_max + 1, theta_interval))
+
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 次元の削減（1度刻みの1x65341シリーズ用）
     
-def reduce_dimensions_series(ies_1D, theta_interval=1, phi_interval=1,
+def reduce_dimensions_series(ies_1D, theta_interval=1, phi_interval=1,          # 引数は、two_to_oneの返り値、シリーズ、配列
                                      theta_max=180,    phi_max=360   ):
-    # 一次元の値の列から何番目を抽出するか
-    index_to_extract = []                                                       # 抽出するindexを格納するための空のリスト
-    i = 0
-    while i <= phi_max:                                                         # 水平角度の最大値まで繰り返す、これ以降iは水平角度
-        index_each_phi = list(range(181*i, 181*i+theta_max+1, theta_interval))  # 各水平角度ごとの抽出するindex、stopの値は含まれない
-        # 計算例:
-        # 0-0,  0-45,   0-90,  0-135、  0-180、 1-0,    1-45,...
-        # と鉛直角度45度、水平角度1度ごとに抽出する場合
-        # 0番目, 45番目, 90番目, 135番目, 180番目, 181番目, 226番目,...
-        # のindexを抽出することになる
-        # 一定間隔ではないことに注意
-        index_to_extract += index_each_phi
-        i += phi_interval                                                       # 次の水平角度へ
-    
-    ies_small = ies_1D[index_to_extract]                                        # 抽出するインデックスのリストを与える
+    
+    index = sub_grid_index(theta_interval, phi_interval, theta_max, phi_max)    # 一次元の値の列から何番目を抽出するか
+    
+    if isinstance(ies_1D, PhotometryVector):
+        return PhotometryVector(ies_1D.values[index],
+                                sub_grid(theta_interval, phi_interval, theta_max, phi_max))
+    if isinstance(ies_1D, pd.Series):
+        return ies_1D.iloc[index]                                               # 抽出する位置の配列を与える
+    
+    ies_small = np.asarray(ies_1D)[index]
     
     return ies_small
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 次元の削減（1度刻みの1(複数行）x65341データフレーム用）
 
-def reduce_dimensions_df(ies_1D, theta_interval=1, phi_interval=1,
+def reduce_dimensions_df(ies_1D, theta_interval=1, phi_interval=1,              # 引数は、n行 x 65341列のデータフレームか配列
                                  theta_max=180,    phi_max=360):
-    index_to_extract = np.array([])                                             # 抽出するindexを格納するための空のリスト
-    i = 0
-    while i <= phi_max:                                                         # 水平角度の最大値まで繰り返す、これ以降iは水平角度
-        index_each_phi = list(range(181*i,181*i+theta_max+1,theta_interval))    # 各水平角度ごとの抽出するindex、stopの値は含まれない
-        index_to_extract += index_each_phi
-        i += phi_interval                                                       # 次の水平角度へ
-    ies_small = ies_1D.iloc[:,index_to_extract]                                 # # 抽出するインデックスのリストを与える
+    
+    # n行をまとめて、一度の抽出で粗い格子に
+    index = sub_grid_index(theta_interval, phi_interval, theta_max, phi_max)
+    
+    if isinstance(ies_1D, pd.DataFrame):
+        return ies_1D.iloc[:, index]                                            # 抽出する位置の配列を与える
+    
+    ies_small = np.take(np.asarray(ies_1D), index, axis=-1)                     # n行 x 抽出数の配列、一度の抽出
+    
     return ies_small
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
@@ -638,12 +1388,11 @@ def cal_cd_max(ies):
     # そのうちの一つしか抽出できない
     # 測定誤差の影響を受ける可能性がある
     
-    remove_duplicates(ies)                                                      # 最大光度が、天頂と天底の場合、φが重複するため
+    ies_small = reduce_dimensions(ies, 5, 5, 180, 360).values                   # 誤差の影響を減らすため、θ・φともに5度刻みに
+    ies_small = ies_small[:-1].copy()                                           # φ=0度と重複するφ=360度を削除、元の配列は書き換えない
+    ies_small[1:, [0,-1]] = 0                                                   # 最大光度が、天頂と天底の場合、φが重複するため、θ=0度と180度の重複する値を0に
     
-    ies_small = reduce_dimensions(ies, 5, 5, 180, 360)                          # 誤差の影響を減らすため、θ・φともに5度刻みに
-    ies_small = ies_small[:-1]                                                  # φ=0度と重複するφ=360度を削除
-    
-    cd_max = ies_small.values.max()                                             # 配列化し、最大値を取得
+    cd_max = ies_small.max()                                                    # 最大値を取得
     cd_max = int(round(cd_max, 0))                                              # 四捨五入し、整数化
     
     cd_max_id  = np.where(ies_small==cd_max)                                    # 最大光度のindex、φとθの２次元配列
@@ -652,7 +1401,6 @@ def cal_cd_max(ies):
     # 例: (array([0,180]), array([0,0]))
     cd_max_id  = list(zip(*cd_max_angles))                                      # 引数に*を付けると、展開して引数に渡せる
     # 例: [(0,0),(0,180)]
-    restore_duplicates(ies)                                                     # 天頂と天底の値を戻す
     
     return cd_max, cd_max_id
 
@@ -671,16 +1419,16 @@ def cal_direction(ies):
     # 360度を削除
     
     # φ方向1/4の合計を算出
-    ies_quarter_sums = []
-    for i in range(0,360):                                                      # 0-359度まで繰り返す、360度は0度と重複
-        ies_quarter_id = list(range(i-45, i+46))                                # [i,...,i+90]の91度分、奇数:-45度分+照射角度+45度分
-        ies_quarter_id = [i % 360 for i in ies_quarter_id]                      # 360度以上で0から、例:i=300 [300..359,0,1...30]
-        ies_quarter_sum = ies.iloc[ies_quarter_id, :].values.sum()              # i度から91度分を合計
-        ies_quarter_sums.append(ies_quarter_sum)
+    # φごとの合計を、前後45度分つなげて累積和を取り、91度分ずつの差を取る
+    ies_phi_sums = as_photometry(ies).values[0:360].sum(axis=1)                 # 0-359度、360度は0度と重複
+    ies_phi_sums = np.concatenate([ies_phi_sums[-45:], ies_phi_sums, ies_phi_sums[:45]])
+    ies_cumsums  = np.concatenate([[0], np.cumsum(ies_phi_sums)])
+    ies_quarter_sums = ies_cumsums[91:] - ies_cumsums[:-91]                     # i度を中心に-45度から+45度の91度分を合計、360要素
     
     # φ方向1/4の合計の最大値を算出
-    ies_quarter_sums = np.array(ies_quarter_sums)                               # 配列化、np.whereを使用するため
-    directions = np.where(ies_quarter_sums == ies_quarter_sums.max())[0]        # 最大値の角度のリスト
+    # 対称な配光の最大値は、合計の順番で誤差が出て、一致しないことがあるので、相対誤差1e-9まで同じとする
+    directions = np.where(np.isclose(ies_quarter_sums, ies_quarter_sums.max(),
+                                     rtol=1e-9, atol=0))[0]                     # 最大値の角度のリスト
     
     # 最大値の数で場合分け
     if   len(directions) >= 3:                                                  # 最大値が３つ以上の場合
@@ -712,6 +1460,8 @@ def cal_direction(ies):
 
 def plot_direction(ies):
     
+    ies = as_photometry(ies).to_df()                                            # 描画用に、データフレーム化
+    
     # φ方向1/4の合計を算出
     ies_quarter_sums = []
     for i in range(0,360):                                                      # 0-359度まで繰り返す、360度は0度と重複
@@ -759,23 +1509,22 @@ def rotate_ies(ies, rotation_angle):
         # 単に360で割った余り分移動するだけでは、
         # ひとつ足りない
     
-    ies1 = ies.shift(rotation_angle).fillna(0)                                  # 行方向に回転角度分だけ半時計回りにずらし、欠損値に0代入
-    ies2 = ies.shift(rotation_angle - 361).fillna(0)                            # 上記の操作で失われた行を埋めるようにずらす、欠損値に0代入   
-    # 正の場合と負の場合で、ies1とies2が入れ替わる
-    # 回転角度 362度の場合、ies1は2度ずらし、ies2は-359度ずらす
-    # 回転角度-362度の場合、ies1は359度ずらし、ies2は-2度ずらす
-    
-    ies = ies1 + ies2
+    # 行方向に回転角度分だけ半時計回りにずらし、はみ出した行は先頭に戻す
+    # 361行で回すので、φ=0度と360度の重複も、データフレームのshiftを2回使っていた時と同じ
+    ies = as_photometry(ies)
+    ies = Photometry(np.roll(ies.values, int(rotation_angle), axis=0), ies.grid)
     
     return ies
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # ピーク範囲の分類
 
-def cal_peak_zone(ies):
+def cal_peak_zone(ies, peak_angle=None, peak_values=None):                      # 計算済みのピークの座標と値があれば、再計算しない
     
-    peak_angle  = cal_peak_angle(ies)                                           # 光度のピークの座標のリスト
-    peak_values = cal_peak_value(ies)                                           # 光度のピークの値のリスト
+    if peak_angle is None:
+        peak_angle  = cal_peak_angle(ies)                                       # 光度のピークの座標のリスト
+    if peak_values is None:
+        peak_values = cal_peak_value(ies, peak_angle)                           # 光度のピークの値のリスト、座標は使い回す
     
     if peak_angle.size == 0:                                                    # ピークがない場合
         peak_zone = 'Diffuse'                                                   # 一様な配光であると判断
@@ -828,9 +1577,11 @@ def cal_peak_zone(ies):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # ピークの分類(データベースには入れないが、ビーム角の算出で利用)
 
-def cal_peaks(ies):
+def cal_peaks(ies, peak_angle=None):
             
-    peak_phi_angle, peak_theta_angle = cal_peak_angle(ies)                      # 光度のピークの座標のリスト
+    if peak_angle is None:
+        peak_angle = cal_peak_angle(ies)                                        # 光度のピークの座標のリスト
+    peak_phi_angle, peak_theta_angle = peak_angle
     
     no_of_peaks_up   = len([p for p in peak_theta_angle if 120 <= p])           # 天頂から±60度以内にあるピークの数
     no_of_peaks_side = len([p for p in peak_theta_angle if 60 < p < 120])       # 水平方向±30度にあるピークの数
@@ -841,15 +1592,17 @@ def cal_peaks(ies):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 設置面の判定
 
-def cal_mounting_surface(ies):
+def cal_mounting_surface(ies, ies_lm=None):                                     # 計算済みのcd_to_lmの返り値があれば、再計算しない
+    
+    # 光度から光束に変換
+    ies = as_photometry(ies)
+    if ies_lm is None:
+        ies_lm = cd_to_lm(ies)                                                  # 光度から光束に変換、配列
     
     # 誤差の影響が大きいので
     # 1カンデラ以下を0にする
-    ies = ies[ies>=1]
-    ies = ies.fillna(0)
-    
-    # 光度から光束に変換
-    ies_lm = cd_to_lm(ies)                                                      # 光度から光束に変換、データフレーム
+    # 光束は光度に立体角を掛けただけなので、変換後に0にしても同じ値
+    ies_lm = np.where(ies.values[:-1]>=1, ies_lm, 0)                            # 光束と同じく、最後のφを除く
     
     # m行 x n列 の配列
     # array([[-, - ... -],
@@ -893,10 +1646,11 @@ def cal_mounting_surface(ies):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 上方光束比の算出
 
-def cal_upper_light_ratio(ies):
+def cal_upper_light_ratio(ies, ies_lm=None):                                    # 計算済みのcd_to_lmの返り値があれば、再計算しない
     
     # 光度から光束に変換
-    ies_lm = cd_to_lm(ies)                                                      # 光度から光束に変換、データフレーム
+    if ies_lm is None:
+        ies_lm = cd_to_lm(ies)                                                  # 光度から光束に変換、配列
     
     # m行 x n列 の配列
     # array([[-, - ... -],
@@ -917,9 +1671,10 @@ def cal_upper_light_ratio(ies):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 上方光束比による分類
     
-def cal_upper_light_ratio_type(ies):
+def cal_upper_light_ratio_type(ies, upper_light_ratio=None):
     
-    upper_light_ratio = cal_upper_light_ratio(ies)
+    if upper_light_ratio is None:
+        upper_light_ratio = cal_upper_light_ratio(ies)
     
     # 上方光束比による分類分け
     
@@ -961,35 +1716,31 @@ def cal_upper_light_ratio_type(ies):
 
 def cal_symmetry(ies):
     
-    ies_np = ies.values                                                         # 計算速度を速めるため、配列化
+    ies_np = as_photometry(ies).values
     ies_theta_sum = ies_np.sum(axis=1)                                          # θ方向の合計値
     ies_theta_sum_average = ies_theta_sum.mean()                                # θ方向の合計値の平均
     ies_theta_sum_std = np.std(ies_theta_sum)                                   # θ方向の合計値の標準偏差
     
     # 4つの軸に対称な値の差
-    differences_x_axis = []                                                     # φ0-180軸
-    differences_y_axis = []                                                     # φ90-270軸
-    differences_v_axis = []                                                     # φ45-225軸、vは斜め軸
-    differences_w_axis = []                                                     # φ135-315軸、wは斜め軸
-    
-    for i in range(181):                                                        #181度分繰り返す
-        # X軸 - 水平角度0-180度軸で対称な値どうしの差
-        differences_x_axis.append(ies_theta_sum[i]                              #   0,  1,  2,...178,179,180度と
-                                - ies_theta_sum[360 - i])                       # 360,359,358,...182,181,180度の比較
-                              
-        # Y軸 - 水平角度90-270度軸で対称な値どうしの差
-        differences_y_axis.append(ies_theta_sum[(90 - i) % 360]                 # 90, 89, 88,...   1,  0,359,...272,271,270度と
-                                - ies_theta_sum[ 90 + i])                       # 90, 91, 92,...,179,180,181,...268,269,270度の比較
-        
-        # V軸 - 水平角度45-225度軸で対称な値どうしの差
-        differences_v_axis.append(ies_theta_sum[(45 - i) % 360]                 #  45, 44, 43,...  1,  0,359,...227,226,225度と
-                                - ies_theta_sum[ 45 + i])                       # 135,136,137,... 89, 90, 91,...223,224,225度の比較
-        
-        # W軸 - 水平角度135-315度軸で対称な値どうしの差
-        differences_w_axis.append(ies_theta_sum[(135 - i) % 360]                # 135,134,133,...  1,  0,359,...317,316,315度と
-                                - ies_theta_sum[ 135 + i])                      # 135,136,137,...269,270,271,...313,314,315度の比較
+    i = np.arange(181)                                                          # 181度分
     
-    std_dev_x_axis = np.std(differences_x_axis)                                 # 水平角度  0-180度軸に対称な値の差の標準偏差
+    # X軸 - 水平角度0-180度軸で対称な値どうしの差
+    differences_x_axis = (ies_theta_sum[i]                                      #   0,  1,  2,...178,179,180度と
+                        - ies_theta_sum[360 - i])                               # 360,359,358,...182,181,180度の比較
+    
+    # Y軸 - 水平角度90-270度軸で対称な値どうしの差
+    differences_y_axis = (ies_theta_sum[(90 - i) % 360]                         # 90, 89, 88,...   1,  0,359,...272,271,270度と
+                        - ies_theta_sum[ 90 + i])                               # 90, 91, 92,...,179,180,181,...268,269,270度の比較
+    
+    # V軸 - 水平角度45-225度軸で対称な値どうしの差
+    differences_v_axis = (ies_theta_sum[(45 - i) % 360]                         #  45, 44, 43,...  1,  0,359,...227,226,225度と
+                        - ies_theta_sum[ 45 + i])                               # 135,136,137,... 89, 90, 91,...223,224,225度の比較
+    
+    # W軸 - 水平角度135-315度軸で対称な値どうしの差
+    differences_w_axis = (ies_theta_sum[(135 - i) % 360]                        # 135,134,133,...  1,  0,359,...317,316,315度と
+                        - ies_theta_sum[ 135 + i])                              # 135,136,137,...269,270,271,...313,314,315度の比較
+    
+    std_dev_x_axis = np.std(differences_x_axis)                                 # 水平角度  0-180度軸に対称な値の差の標準偏差
     std_dev_y_axis = np.std(differences_y_axis)                                 # 水平角度 90-270度軸に対称な値の差の標準偏差
     std_dev_v_axis = np.std(differences_v_axis)                                 # 水平角度 45-225度軸に対称な値の差の標準偏差
     std_dev_w_axis = np.std(differences_w_axis)                                 # 水平角度135-315度軸に対称な値の差の標準偏差
@@ -1025,6 +1776,8 @@ def cal_symmetry(ies):
 
 def plot_symmetry(ies):
     
+    ies = as_photometry(ies).to_df()                                            # 描画用に、データフレーム化
+    
     # 合計の算出
     ies_np = ies.values  
     ies_theta_sum = ies_np.sum(axis=1)                                          # θ方向の合計値
@@ -1064,13 +1817,18 @@ def plot_symmetry(ies):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 1/2ビーム角の算出
 
-def cal_beam(ies):
+def cal_beam(ies, symmetry=None, up_down_side=None, cd_max=None):               # 計算済みの対称性、ピークの分類、最大光度があれば、再計算しない
     
-    symmetry     = cal_symmetry(ies)                                            # 対称性の確認
-    up_down_side = cal_peaks(ies)                                               # 上下横の確認
+    ies = as_photometry(ies).to_df()                                            # 未完成のため、データフレームのまま
+    
+    if symmetry is None:
+        symmetry     = cal_symmetry(ies)                                        # 対称性の確認
+    if up_down_side is None:
+        up_down_side = cal_peaks(ies)                                           # 上下横の確認
     
     if  symmetry == 'Symmetry' or symmetry == 'XY Axis Symmetry':               # 配光が点対称(ビーム)か2軸対称(スプレッド)なら
-        cd_max   = cal_cd_max(ies)[0]
+        if cd_max is None:
+            cd_max = cal_cd_max(ies)[0]
         cd_half  = cd_max/2
         ies_half = ies[ies <= cd_half]                                          # 最大光度の半分以下になるデータを抽出、半分以上はNaN
         
@@ -1284,28 +2042,21 @@ def tilt(x, y, z, phi):
 def cd_to_lm(ies):                                                              # 引数はデータフレーム、次元の削減に対応済み
     
     # θとφの間隔を取得
+    ies = as_photometry(ies)
     theta_interval, phi_interval = theta_phi_interval(ies)
-    theta_label = ies.columns                                                   # 0から180までのθの配列
-    phi_label   = ies.index[0:-1]                                               # 0から359までのφの配列、360度を除く
-    
-    # ΔθとΔφの区画の立体角を算出
-    solid_angle_list = []                                                       # 空の立体角のリストの作成
-    solid_angle_array = []                                                      # 空の立体角のリストのリストの作成
-    for i in range(int(180 / theta_interval + 1)):                              # θごとに繰り返す
-        theta1 = max(0,  (theta_label[i] - theta_interval / 2)) * np.pi / 180   # 積分開始θ、弧度法からラジアンに、最初の値は0度
-        theta2 = min(180,(theta_label[i] + theta_interval / 2)) * np.pi / 180   # 積分終了θ、弧度法からラジアンに、最後の値は180度
-        phi1 =  phi_label[0]                 * np.pi / 180                      # 積分開始φ、弧度法からラジアンに
-        phi2 = (phi_label[0] + phi_interval) * np.pi / 180                      # 積分終了φ、弧度法からラジアンに、0.5度ごとの場合
-        solid_angle = (np.cos(theta1)-np.cos(theta2)) * (phi2-phi1)             # 立体角、dw = sinθdθdφ の積分
-        # 一応計算しているが、Δφ = φ2-φ1は常に一定で、φ間隔に等しい
-        solid_angle_list.append(solid_angle)
-    for j in range(int(360 / phi_interval)):                                    # φごとに繰り返す
-        solid_angle_array.append(solid_angle_list)
-    solid_angle_array = np.array(solid_angle_array)                             # 配列化
+    theta_label = np.array(ies.theta, dtype=np.float64)                         # 0から180までのθの配列
+    phi_label   = ies.phi[0:-1]                                                 # 0から359までのφの配列、360度を除く
+    
+    # ΔθとΔφの区画の立体角を算出、θごとの配列
+    theta1 = np.maximum(0,  (theta_label - theta_interval / 2)) * np.pi / 180   # 積分開始θ、弧度法からラジアンに、最初の値は0度
+    theta2 = np.minimum(180,(theta_label + theta_interval / 2)) * np.pi / 180   # 積分終了θ、弧度法からラジアンに、最後の値は180度
+    phi1 =  phi_label[0]                 * np.pi / 180                          # 積分開始φ、弧度法からラジアンに
+    phi2 = (phi_label[0] + phi_interval) * np.pi / 180                          # 積分終了φ、弧度法からラジアンに、0.5度ごとの場合
+    solid_angle = (np.cos(theta1)-np.cos(theta2)) * (phi2-phi1)                 # 立体角、dw = sinθdθdφ の積分
+    # 一応計算しているが、Δφ = φ2-φ1は常に一定で、φ間隔に等しい
     
     # 光束を算出
-    ies_np   = ies.values                                                       # 配列化
-    ies_lm = ies_np[0:-1,:] * solid_angle_array                                 # 光束 = 光度 * 立体角、0度と重複するため、最後のφを除く
+    ies_lm = ies.values[0:-1,:] * solid_angle                                   # 光束 = 光度 * 立体角、0度と重複するため、最後のφを除く、各φに同じ立体角
     
     # 返り値は配列
     # array([[-, - ... -],
@@ -1342,8 +2093,9 @@ def cd_to_lm(ies):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 光束の算出
 
-def cal_lm(ies):
-    ies_lm = cd_to_lm(ies)                                                      # 光度を光束に変更
+def cal_lm(ies, ies_lm=None):
+    if ies_lm is None:
+        ies_lm = cd_to_lm(ies)                                                  # 光度を光束に変更
     lumen  = ies_lm.ravel().sum()
     lumen  = int(round(lumen,0))
     return lumen
@@ -1357,10 +2109,11 @@ def for_diff(ies):
     # データベースを作成する時: φ=1度、θ=1度
     # クラスター平均を更新する時: φ=5度、θ=10度
     
+    ies = as_photometry(ies)
     if ies.shape == (361, 181):
         ies_for_diff = reduce_dimensions(ies, 5, 10, 180, 360)                  # 誤差の影響を減らすため、θ=5度・φ=10度刻みに
     else:
-        ies_for_diff = ies.copy()                                               # copyにしないと、SettingWithCopyWarning警告
+        ies_for_diff = ies
     theta_interval, phi_interval = theta_phi_interval(ies_for_diff)             # θ=5度・φ=10度刻みだが、今後の変更のため、変数で
     
     # 何度刻みがいいのかは要検討
@@ -1377,7 +2130,7 @@ def for_diff(ies):
     # 350   -   -   -   -   -
     # 360   -   -   -   -   -
     
-    ies_for_diff = ies_for_diff.iloc[:-1]                                       # φ=0度と重複するφ=360度は削除、後に追加
+    values = ies_for_diff.values[:-1]                                           # φ=0度と重複するφ=360度は削除、後に追加
     
     # 36行 x 37列
     #       0   5 ... 175 180
@@ -1392,29 +2145,16 @@ def for_diff(ies):
     # 天頂と天底で差分を取るため
     # 先頭と末尾に列を加える
     # その際、上半分と下半分を入れ替える
-    # 先頭は差分後に削除
     
     # 入れ替えのためのインデックス作成
-    no_of_phi      =  len(ies_for_diff)                                         # 行を上下二分割するため、行数を取得
+    no_of_phi      =  len(values)                                               # 行を上下二分割するため、行数を取得
     half_no_of_phi =  int(no_of_phi/2)                                          # 半分の行数をrange関数のため整数化
-    id_to_extract =  list(range(half_no_of_phi, no_of_phi))                     # 下半分のインデックスが先
-    id_to_extract += list(range(half_no_of_phi))                                # 上半分のインデックスが後
+    id_to_extract  =  np.roll(np.arange(no_of_phi), -half_no_of_phi)            # 下半分のインデックスが先、上半分のインデックスが後
     
-    ies_left  = ies_for_diff.iloc[:, 1]                                         # 最後の次の列を抽出、シリーズ、5度を抽出
-    ies_right = ies_for_diff.iloc[:,-2]                                         # 最初の次の列を抽出、シリーズ、175度を抽出
+    ies_left  = values[id_to_extract,  1]                                       # 最初の次の列を上下半分を入れ替えて抽出、5度を抽出
+    ies_right = values[id_to_extract, -2]                                       # 最後の次の列を上下半分を入れ替えて抽出、175度を抽出
     
-    ies_left  = ies_left.iloc[id_to_extract]                                    # 上下半分を入れ替え
-    ies_right = ies_right.iloc[id_to_extract]                                   # 上下半分を入れ替え
-    
-    ies_left.index  = [i * phi_interval for i in range(no_of_phi)]              # 該当indexに追加されるよう変更、[0,10...340,350]
-    ies_right.index = [i * phi_interval for i in range(no_of_phi)]              # 該当indexに追加されるよう変更、[0,10...340,350]
-    
-    ies_left_column  = theta_interval * -1                                      # 列名はθ間隔を負にしたもの、-5度
-    ies_right_column = theta_interval + 180                                     # 列名はθ間隔に180を加えたもの、185度
-    
-    ies_for_diff[ies_left_column]  = ies_left                                   # 先頭列前にies_leftを追加
-    ies_for_diff[ies_right_column] = ies_right                                  # 末尾列後にies_rightを追加
-    ies_for_diff = ies_for_diff.sort_index(axis=1, ascending=True)              # 列名で並び替え
+    values = np.hstack([ies_left[:, None], values, ies_right[:, None]])         # 先頭列前にies_left、末尾列後にies_rightを追加
     
     # 36行 x 39列
     #      -5   0   5 ... 175 180 185
@@ -1430,17 +2170,14 @@ def for_diff(ies):
     
     # φ方向の処理
     # 差分を取るため
-    # 先頭に行を加える
-    
-    ies_above = ies_for_diff.iloc[-1]                                           # 最後から２番目の行を抽出、シリーズ、350度を抽出
-    ies_below = ies_for_diff.iloc[0]                                            # 最初の行を抽出、シリーズ、0度を抽出
+    # 先頭に最後の行(350度)、末尾に最初の行(0度)を加える
     
-    ies_above.name = phi_interval * -1                                          # 行名はφ間隔を負にしたもの、-10度
-    ies_below.name = phi_interval + 350                                         # 行名はφ間隔を350を加えたもの、360度
+    values = np.vstack([values[-1:], values, values[:1]])
     
-    ies_for_diff = ies_for_diff.append(ies_above)                               # 先頭行を末尾に追加
-    ies_for_diff = ies_for_diff.append(ies_below)                               # 末尾行を末尾に追加
-    ies_for_diff = ies_for_diff.sort_index(ascending=True)                      # 行名で並び替え
+    # 行名はφ間隔を負にしたもの、-10度と、φ間隔に350を加えたもの、360度
+    # 列名はθ間隔を負にしたもの、-5度と、θ間隔に180を加えたもの、185度
+    ies_for_diff = Photometry(values, angular_grid(phi_interval * -1,   phi_interval + 350,   phi_interval,
+                                                   theta_interval * -1, theta_interval + 180, theta_interval))
     
     # 38行 x 39列
     #      -5   0   5 ... 180 185
@@ -1458,26 +2195,27 @@ def for_diff(ies):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # θ方向の差分
 
-def diff_theta(ies):
+def diff_theta(ies, ies_for_diff=None):                                         # 計算済みのfor_diffの返り値があれば、再計算しない
     
-    ies_for_diff = for_diff(ies)                                                # 差分用のiesを用意、38行 x 39列
+    if ies_for_diff is None:
+        ies_for_diff = for_diff(ies)                                            # 差分用のiesを用意、38行 x 39列
     
-    ies_diff_theta = ies_for_diff.diff(axis=1)                                  # θ方向に差分を取る
+    ies_diff_theta = np.diff(ies_for_diff.values, axis=1)                       # θ方向に差分を取る、最初の列はなくなる
     
-    # 38行 x 39列
-    #      -5   0   5 ... 180 185
-    # -10 NaN   -   -   -   -   -
-    #   0 NaN   -   -   -   -   -
-    #  10 NaN   -   -   -   -   -
-    #   . NaN   -   -   -   -   -
-    #   . NaN   -   -   -   -   -
-    # 350 NaN   -   -   -   -   -
-    # 360 NaN   -   -   -   -   -
+    # 38行 x 38列
+    #       0   5 ... 180 185
+    # -10   -   -   -   -   -
+    #   0   -   -   -   -   -
+    #  10   -   -   -   -   -
+    #   .   -   -   -   -   -
+    #   .   -   -   -   -   -
+    # 350   -   -   -   -   -
+    # 360   -   -   -   -   -
     # -10行は350行、360行は0行と重複
     # 185列は重複してるが、極大の検出のために必要
     
-    ies_diff_theta = ies_diff_theta.dropna(axis=1)                              # 欠損値を削除
-    ies_diff_theta = ies_diff_theta.iloc[1:-1]                                  # 最初と最後の行を削除
+    ies_diff_theta = Photometry(ies_diff_theta[1:-1],                           # 最初と最後の行を削除
+                                ies_for_diff.grid.sub(slice(1, -1), slice(1, None)))
     
     # 36行 x 38列
     #       0   5 ... 180 185
@@ -1493,15 +2231,15 @@ def diff_theta(ies):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # φ方向の差分
 
-def diff_phi(ies):
+def diff_phi(ies, ies_for_diff=None):                                           # 計算済みのfor_diffの返り値があれば、再計算しない
     
-    ies_for_diff = for_diff(ies)                                                # 差分用のiesを用意、38行 x 39列
+    if ies_for_diff is None:
+        ies_for_diff = for_diff(ies)                                            # 差分用のiesを用意、38行 x 39列
     
-    ies_diff_phi = ies_for_diff.diff(axis=0)                                    # φ方向に差分を取る
+    ies_diff_phi = np.diff(ies_for_diff.values, axis=0)                         # φ方向に差分を取る、最初の行はなくなる
     
-    # 38行 x 39列
+    # 37行 x 39列
     #      -5   0   5 ... 180 185
-    # -10 NaN NaN NaN NaN NaN NaN
     #   0   -   -   -   -   -   -
     #  10   -   -   -   -   -   -
     #   .   -   -   -   -   -   -
@@ -1512,8 +2250,8 @@ def diff_phi(ies):
     # -5列は5列、185列は175列（入れ替えあり）と重複
     # 360行は0行と重複してるが、極大の検出のために必要
      
-    ies_diff_phi = ies_diff_phi.dropna(axis=0)                                  # φ方向に差分を取り、欠損値を削除
-    ies_diff_phi = ies_diff_phi.iloc[:, 2:-2]                                   # 最初の2列と最後の2列を削除
+    ies_diff_phi = Photometry(ies_diff_phi[:, 2:-2],                            # 最初の2列と最後の2列を削除
+                              ies_for_diff.grid.sub(slice(1, None), slice(2, -2)))
     
     # 37行 x 35列
     #       5  10 ... 170 175
@@ -1529,9 +2267,10 @@ def diff_phi(ies):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # θ方向の光度のピーク判定の真偽値の算出
 
-def cal_peak_theta_mask(ies):
+def cal_peak_theta_mask(ies, ies_diff_theta=None):
     
-    ies_diff_theta = diff_theta(ies)                                            # θ方向の差分を取る、36行 x 38列
+    if ies_diff_theta is None:
+        ies_diff_theta = diff_theta(ies)                                        # θ方向の差分を取る、36行 x 38列
     theta_interval, phi_interval = theta_phi_interval(ies_diff_theta)           # θ=5度・φ=10度刻みだが、今後の変更のため、変数で
     
     # 36行 x 38列 のデータフレーム
@@ -1543,89 +2282,41 @@ def cal_peak_theta_mask(ies):
     # 340   -   -   -   -   -
     # 350   -   -   -   -   -
     
-    # データフレームの繰り返し処理は遅いので、配列化
-    # 計算速度に約13倍差が出る
-    
     ies_diff_theta_ndarray = ies_diff_theta.values
     
-    # 36行 x 38列 の配列
-    # array([[-, - ... -],
-    #        [-, - ... -],
-    #        ...
-    #        [-, - ... -]])
-    # 行名と列名を失う
-    
-    # 配列の場合、空の配列を用意しても、
-    # 要素数が合わず、繰り返し処理の時に追加できない
-    # 36行あるので、要素数36の配列を作成する
-    # 対応関係が分かりやすいよう、行名にする
-    
-    peak_theta_mask = np.array(range(0, 351, 10))                               # array([0,10...340,350])、36要素の配列
-    
-    for i in range(37):                                                         # θは[0,5...185]の38列
-        
-        # θは38列ある 
-        # iの時、iは37まで、range(38)まで可
-        # i+1の時、iは36まで、range(37)まで可
-        
-        peak_flag = (
-                    
-                    # 単純に正の後が負という条件ではうまくいかない
-                    # 差分=0のピークも存在、0を含める必要も
-                    # 光度が、ほぼ0の時
-                    # 誤差と思われる僅かなピークがある
-                    # このピークを除くため
-                    # 二つの条件式の一方に0を含めた場合
-                    # もう一方は絶対値1以上にする
-                    
-                    (
-                    (ies_diff_theta_ndarray[:, i]   >= 0)                       # i列が0か正
-                  * (ies_diff_theta_ndarray[:, i+1] < -1)                       # i+1列が-1より下
-                    )
-                    
-                    # i列を抽出するが、36要素の配列になる
-                    # array([-, - ... -])
-                    
-                    # i番目が0で、
-                    # i+1番目が負でも、
-                    # i-1番目が負である可能性も
-                    
-                  + (
-                    (ies_diff_theta_ndarray[:, i]   >  1)                       # i列が1より上
-                  * (ies_diff_theta_ndarray[:, i+1] <= 0)                       # i+1列が0か負
-                    )
-                    
-                    # i番目が正で
-                    # i+1番目が0でも、
-                    # i+2番目が正である可能性も
-                    
-                    )
-        peak_theta_mask = np.vstack((peak_theta_mask, peak_flag))               # 列ごと(計算中は行)の真偽値を追加、引数はタプル
-        
-    # 38行 x 36列 の配列
-    # array([[-, - ... -],
-    #        [-, - ... -],
-    #        ...
-    #        [-, - ... -]])
-    # 先頭にダミー行があるので、38行
-    # データフレームと行と列が入れ替わっているので、
-    # 転置する必要がある
-    
-    peak_theta_mask = peak_theta_mask[1:]                                       # ダミー行の削除
-    peak_theta_mask = peak_theta_mask.T                                         # 配列の転置
-    
-    # 36行 x 37列 の配列
-    # array([[-, - ... -],
-    #        [-, - ... -],
-    #        ...
-    #        [-, - ... -]])
-    
-    peak_theta_mask = pd.DataFrame(peak_theta_mask,                             # 繰り返し処理が終わったので、データフレーム化
-                         index   = list(range(0, 351, phi_interval)),
-                         columns = list(range(0, 181, theta_interval)))
+    # i列とi+1列を、全ての列でまとめて比較する
+    diff_i  = ies_diff_theta_ndarray[:, :-1]                                    # i列、36行 x 37列
+    diff_i1 = ies_diff_theta_ndarray[:, 1: ]                                    # i+1列、36行 x 37列
+    
+    peak_theta_mask = (
+                      
+                      # 単純に正の後が負という条件ではうまくいかない
+                      # 差分=0のピークも存在、0を含める必要も
+                      # 光度が、ほぼ0の時
+                      # 誤差と思われる僅かなピークがある
+                      # このピークを除くため
+                      # 二つの条件式の一方に0を含めた場合
+                      # もう一方は絶対値1以上にする
+                      
+                      ((diff_i >= 0) & (diff_i1 < -1))                          # i列が0か正、i+1列が-1より下
+                      
+                      # i番目が0で、
+                      # i+1番目が負でも、
+                      # i-1番目が負である可能性も
+                      
+                    | ((diff_i >  1) & (diff_i1 <= 0))                          # i列が1より上、i+1列が0か負
+                      
+                      # i番目が正で
+                      # i+1番目が0でも、
+                      # i+2番目が正である可能性も
+                      
+                      )
+    
+    peak_theta_mask = Photometry(peak_theta_mask,
+                                 angular_grid(0, 350, phi_interval, 0, 180, theta_interval))
                          
-                         # 変更時は、-5から始まるか、0から始まるか、要確認
-                         # 現状は、0から始まる式
+                                 # 変更時は、-5から始まるか、0から始まるか、要確認
+                                 # 現状は、0から始まる式
     
     # 36行 x 37列
     #       0   5 ... 175 180
@@ -1641,9 +2332,10 @@ def cal_peak_theta_mask(ies):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # φ方向の光度のピーク判定の真偽値の算出
 
-def cal_peak_phi_mask(ies):
+def cal_peak_phi_mask(ies, ies_diff_phi=None):
     
-    ies_diff_phi = diff_phi(ies)                                                # φ方向の差分を取る、37行 x 35列
+    if ies_diff_phi is None:
+        ies_diff_phi = diff_phi(ies)                                            # φ方向の差分を取る、37行 x 35列
     theta_interval, phi_interval = theta_phi_interval(ies_diff_phi)             # θ=5度・φ=10度刻みだが、今後の変更のため、変数で
     
     # 37行 x 35列
@@ -1655,82 +2347,16 @@ def cal_peak_phi_mask(ies):
     # 350   -   -   -   -   -
     # 360   -   -   -   -   -
     
-    # データフレームの繰り返し処理は遅いので、配列化
-    # 計算速度に約6倍差が出る
-    
     ies_diff_phi_np = ies_diff_phi.values
     
-    # 37行 x 35列 の配列
-    # array([[-, - ... -],
-    #        [-, - ... -],
-    #        ...
-    #        [-, - ... -]])
-    # 行名と列名を失う
-    
-    # 配列の場合、空の配列を用意しても、
-    # 要素数が合わず、繰り返し処理の時に追加できない
-    # 35列あるので、要素数35の配列を作成する
-    # 対応関係が分かりやすいよう、列名にする
+    # i行とi+1行を、全ての行でまとめて比較する
+    diff_i  = ies_diff_phi_np[:-1]                                              # i行、36行 x 35列
+    diff_i1 = ies_diff_phi_np[1: ]                                              # i+1行、36行 x 35列
     
-    peak_phi_mask = np.array(range(5, 176, 5))                                  # array([5,10...175])、35要素の配列
-    
-    for i in range(36):                                                         # φは[0,10...340,360]の37行
-        
-        # この処理は時間がかかる
-        # φは37行ある 
-        # iの時、iは36まで、range(37)まで可
-        # i+1の時、iは35まで、range(36)まで可
-        
-        peak_flag = (
-                    
-                    # 単純に正の後が負という条件ではうまくいかない
-                    # 差分=0のピークも存在、0を含める必要も
-                    # 光度が、ほぼ0の時
-                    # 誤差と思われる僅かなピークがある
-                    # このピークを除くため
-                    # 二つの条件式の一方に0を含めた場合
-                    # もう一方は絶対値1以上にする
-                    
-                    (
-                    (ies_diff_phi_np[i]   >= 0)                                 # i行が0か正
-                  * (ies_diff_phi_np[i+1] < -1)                                 # i+1行が-1より下
-                    )
-                    
-                    # i行を抽出する、35要素の配列になる
-                    # θ方向のような、列と行の入れ替わりはない
-                    # array([-, - ... -])
-                    
-                    # i番目が0で、
-                    # i+1番目が負でも、
-                    # i-1番目が負である可能性も
-                    
-                  + (
-                    (ies_diff_phi_np[i]   >  1)                                 # i行が1より上
-                  * (ies_diff_phi_np[i+1] <= 0)                                 # i+1行が0か負
+    peak_phi_mask = (
+                    ((diff_i >= 0) & (diff_i1 < -1))                            # i行が0か正、i+1行が-1より下
+                  | ((diff_i >  1) & (diff_i1 <= 0))                            # i行が1より上、i+1行が0か負
                     )
-                  
-                    # i番目が正で
-                    # i+1番目が0でも、
-                    # i+2番目が正である可能性も
-                    
-                  )
-                  
-        peak_phi_mask = np.vstack((peak_phi_mask, peak_flag))                   # 行ごとの真偽値を追加、引数はタプル
-    
-    # 37行 x 35列 の配列
-    # array([[-, - ... -],
-    #        [-, - ... -],
-    #        ...
-    #        [-, - ... -]])
-    # 先頭にダミー行があるので、37行
-    
-    peak_phi_mask = peak_phi_mask[1:]                                           # ダミー行の削除
-    
-    # 36行 x 35列 の配列
-    # array([[-, - ... -],
-    #        [-, - ... -],
-    #        ...
-    #        [-, - ... -]])
     
     if  peak_phi_mask.sum() == 0:
         
@@ -1740,36 +2366,22 @@ def cal_peak_phi_mask(ies):
         # θ方向でのみ、ピークの検出を行うため、
         # φ方向の真偽値を全て1にする
         
-        peak_phi_mask = pd.DataFrame(1,                                         # 繰り返し処理終了後、データフレーム化、値を全て１に
-                           index   = list(range(0, 351, phi_interval)),
-                           columns = list(range(5, 176, theta_interval)))
-    
-        # 36行 x 35列
-        #       5  10 ... 170 175
-        #   0   1   1   1   1   1
-        #  10   1   1   1   1   1
-        #   .   1   1   1   1   1
-        #   .   1   1   1   1   1
-        # 340   1   1   1   1   1
-        # 350   1   1   1   1   1
+        peak_phi_mask[:] = True
     
-    else:
-        
-        peak_phi_mask = pd.DataFrame(peak_phi_mask,                             # 繰り返し処理終了後、データフレーム化
-                           index   = list(range(0, 351, phi_interval)),
-                           columns = list(range(5, 176, theta_interval)))
+    peak_phi_mask = Photometry(peak_phi_mask,
+                               angular_grid(0, 350, phi_interval, 5, 175, theta_interval))
                          
-                           # 変更時は、-5から始まるか、0から始まるか、要確認
-                           # 現状は、0から始まる式
+                               # 変更時は、-5から始まるか、0から始まるか、要確認
+                               # 現状は、0から始まる式
      
-        # 36行 x 35列
-        #       5  10 ... 170 175
-        #   0   F   F   F   F   F
-        #  10   F   F   F   F   F
-        #   .   F   F   F   F   F
-        #   .   F   F   F   F   F
-        # 340   F   F   F   F   F
-        # 350   F   F   F   F   F
+    # 36行 x 35列
+    #       5  10 ... 170 175
+    #   0   F   F   F   F   F
+    #  10   F   F   F   F   F
+    #   .   F   F   F   F   F
+    #   .   F   F   F   F   F
+    # 340   F   F   F   F   F
+    # 350   F   F   F   F   F
         
     return peak_phi_mask
 
@@ -1777,22 +2389,29 @@ def cal_peak_phi_mask(ies):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 光度のピーク判定の真偽値の算出
 
-def cal_peak_mask(ies):
-    
-    peak_mask = pd.DataFrame(True, index=range(-10,361,10), 
-                                      columns=range(-5,186,5))                  # 代入用に、38行 x 39列のデータフレームを用意
+def cal_peak_mask(ies, peak_theta_mask=None, peak_phi_mask=None):
     
-    peak_theta_mask = cal_peak_theta_mask(ies)                                  # θ方向のピークの真偽値
-    peak_phi_mask   = cal_peak_phi_mask(ies)                                    # φ方向のピークの真偽値
+    if peak_theta_mask is None:
+        peak_theta_mask = cal_peak_theta_mask(ies)                              # θ方向のピークの真偽値、36行 x 37列
+    if peak_phi_mask is None:
+        peak_phi_mask   = cal_peak_phi_mask(ies)                                # φ方向のピークの真偽値、36行 x 35列
+    peak_phi_mask = peak_phi_mask.values
     
     # φ方向の差分の特異点の処理
-    peak_phi_mask.insert(0, 0, False)                                           # 0番目のindexに、列名で0、Falseを代入
-    peak_phi_mask[180] = False                                                  # 列名180で、Falseを代入
-    peak_phi_mask.iloc[0, [0,-1]] = True                                        # φ=0度を、Trueに
+    no_of_phi     = len(peak_phi_mask)
+    peak_phi_mask = np.hstack([np.zeros((no_of_phi, 1), dtype=bool),            # θ=0度と180度の列に、Falseを代入
+                               peak_phi_mask,
+                               np.zeros((no_of_phi, 1), dtype=bool)])
+    peak_phi_mask[0, [0,-1]] = True                                             # φ=0度を、Trueに
     
     # θ・φ方向共にピークかの真偽値
-    peak_mask = peak_mask & peak_theta_mask & peak_phi_mask                     # θ・φ方向共にピークの真偽値、38行 x 39列
-    peak_mask = peak_mask.fillna(False)
+    # 前後に1行、左右に1列ずつ、Falseを加え、38行 x 39列に
+    theta_interval, phi_interval = theta_phi_interval(peak_theta_mask)
+    peak_mask = np.zeros((no_of_phi + 2, peak_phi_mask.shape[1] + 2), dtype=bool)
+    peak_mask[1:-1, 1:-1] = peak_theta_mask.values & peak_phi_mask              # θ・φ方向共にピークの真偽値
+    peak_mask = Photometry(peak_mask,
+                           angular_grid(phi_interval   * -1, 360,                  phi_interval,
+                                        theta_interval * -1, 180 + theta_interval, theta_interval))
     
     # 小さいピークもピークなため
     # 必ずしも最大値と一致しない
@@ -1812,14 +2431,14 @@ def cal_peak_mask(ies):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 光度のピーク座標の算出
 
-def cal_peak_angle(ies):
+def cal_peak_angle(ies, peak_mask=None):
     
-    peak_mask = cal_peak_mask(ies)
+    if peak_mask is None:
+        peak_mask = cal_peak_mask(ies)
     theta_interval, phi_interval = theta_phi_interval(peak_mask)                # θ=5度・φ=10度刻みだが、今後の変更のため、変数で
     
     # ピークのインデックスを取得
-    peak_phi_id   = np.where(peak_mask)[0]                                      # ピークのφのインデックス
-    peak_theta_id = np.where(peak_mask)[1]                                      # ピークのθのインデックス
+    peak_phi_id, peak_theta_id = np.where(peak_mask.values)                     # ピークのφとθのインデックス
     
     # インデックスを角度に変換
     peak_phi_angle   = peak_phi_id   * phi_interval   - phi_interval            # インデックスを角度に変換、-10度始まりに注意
@@ -1841,15 +2460,18 @@ def cal_peak_angle(ies):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 光度のピーク値を算出
 
-def cal_peak_value(ies):
+def cal_peak_value(ies, peak_angle=None):
     
-    peak_phi_angle, peak_theta_angle = cal_peak_angle(ies)
+    ies = as_photometry(ies)
+    if peak_angle is None:
+        peak_angle = cal_peak_angle(ies)
+    peak_phi_angle, peak_theta_angle = peak_angle
     
     peak_values = []
     for i in range(len(peak_phi_angle)):
         phi   = peak_phi_angle[i]
         theta = peak_theta_angle[i]
-        peak_value = ies.loc[phi, theta]                                        # 行と列名を参照、配列化できない
+        peak_value = ies.at(phi, theta)                                         # 行と列名を参照
         peak_values.append(peak_value)
     
     peak_values = np.array(peak_values)                                         # 配列化、速くなるか分からない
@@ -1874,35 +2496,24 @@ def del_small_peak(peak_angle, peak_values):
 
 def get_ies_around_peak(ies):
     
-    peak_mask = cal_peak_mask(ies)
+    peak_mask = cal_peak_mask(ies).values
     
     # Trueの前後左右もTrueに
     # この真偽値で元の光度の値を抽出し
     # どういう状況でピークが発生しているか確認
     
-    bool_of_peak_for_search = peak_mask.copy()
+    # 元の真偽値をずらして重ねるので
+    # 後右の後右の後右...はTrueにならない
+    # 最初と最後の行と列は、常にFalse
     
-    # 検索用のデータフレームを別に用意
-    # 元データフレームの前後左右を
-    # 随時Trueにしていくので
-    # 後右の後右の後右...もTrueに
-    
-    # φ方向
-    for i in range(37):                                                         # i+1があるので、行数は38だが、1を引く
-        for j in range(39):                                                     # jのみなので、列数は39で、そのまま
-            if  bool_of_peak_for_search.iloc[i, j]  == True:                    # i行目がTrueなら、i=0の時False、i-1はエラーではない
-                peak_mask.iloc[i-1, j] = True                                   # i-1行目もTrue
-                peak_mask.iloc[i+1, j] = True                                   # i+1行目もTrue、二行連続でTrueはない
-                
-    # θ方向
-    for m in range(38):                                                         # m+1があるので、列数は39だが、1を引く
-        for n in range(38):                                                     # nのみなので、行数は38で、そのまま
-            if  bool_of_peak_for_search.iloc[n, m]  == True:                    # m列目がTrueなら、m=0の時False、m-1はエラーではない
-                peak_mask.iloc[n, m-1] = True                                   # m-1列目もTrue
-                peak_mask.iloc[n, m+1] = True                                   # m+1列目もTrue、二列連続でTrueはない
+    around_mask = peak_mask.copy()
+    around_mask[:-1]    |= peak_mask[1:]                                        # φ方向、i行目がTrueなら、i-1行目もTrue
+    around_mask[1:]     |= peak_mask[:-1]                                       # i+1行目もTrue
+    around_mask[:, :-1] |= peak_mask[:, 1:]                                     # θ方向、m列目がTrueなら、m-1列目もTrue
+    around_mask[:, 1:]  |= peak_mask[:, :-1]                                    # m+1列目もTrue
     
-    ies_for_diff = for_diff(ies)                                                # 差分用の元データを取得
-    ies_around_peak = ies_for_diff[peak_mask]                                   # ピークの前後左右のデータを抽出
+    ies_for_diff = for_diff(ies).to_df()                                        # 差分用の元データを取得、確認用にデータフレーム化
+    ies_around_peak = ies_for_diff.where(around_mask)                           # ピークの前後左右のデータを抽出
     
     ies_around_peak = ies_around_peak.dropna(axis=0, how='all')                 # 全て欠損値の行を削除
     ies_around_peak = ies_around_peak.dropna(axis=1, how='all')                 # 全て欠損値の列を削除
@@ -1913,7 +2524,7 @@ def get_ies_around_peak(ies):
 # 配光データの差分の差分（θ方向）
 
 def ies_diff_theta2(ies):
-    ies_diff_theta = diff_theta(ies)
+    ies_diff_theta = diff_theta(ies).to_df()
     ies_diff_theta2 = ies_diff_theta.diff(axis=1).fillna(0)                     # θ方向の差分、欠損値に0代入
     ies_diff_theta2[0] = ies_diff_theta2[360]                                   # θ=0度にθ=360度の値を代入
     ies_diff_theta2 = ies_diff_theta2[range(0,361,5)]
@@ -2025,6 +2636,15 @@ def get_table_info():
         
     return tables, nos_of_columns, nos_of_rows, list_of_columns
 
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# テーブルの行数を取得
+
+def count_rows(table):
+    
+    cur.execute('SELECT COUNT (*) FROM ' + table)                               # 主キーのインデックスだけで数える
+    
+    return cur.fetchone()[0]
+
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # テーブル情報を表示
 
@@ -2230,21 +2850,215 @@ cur.execute(' SELECT typeof(min_voltage), '
 # cur.execute('INSERT INTO new SELECT * FROM light_table')
 
 
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 標準化した配光データと特徴量のキャッシュ
+
+# ファイルの中身のハッシュとPIPELINE_VERSIONをキーにする
+# ファイル名や置き場所が変わっても、中身が同じならキャッシュを使う
+# 中身のハッシュは、マニフェストや隔離と同じもの、呼び出し側で一度だけ計算して渡す
+# 6 Cache/ab/abcdef....npz
+
+def cache_file_path(file_path, file_hash=None, data=None):                      # file_hashは中身のハッシュ、dataは読み込み済みのバイト列
+    
+    if file_hash is None:                                                       # 渡されなければ、ここで計算
+        if data is None:
+            data = read_photometric_bytes(file_path)                            # zipやtarの中のファイルにも対応
+        file_hash = hashlib.sha1(data).hexdigest()
+    key = hashlib.sha1((file_hash + str(PIPELINE_VERSION)).encode()).hexdigest()# 中身とバージョンのハッシュ
+    
+    return CACHE_PATH + key[:2] + '/' + key + '.npz'                            # 先頭2文字でフォルダを分ける
+
+def is_cached(file_path, file_hash=None):
+    
+    try:
+        return os.path.exists(cache_file_path(file_path, file_hash))
+    except:                                                                     # ファイルが読めない場合
+        return False
+
+def load_cache(file_path, file_hash=None, data=None):
+    
+    try:
+        npz_path = cache_file_path(file_path, file_hash, data)
+        with np.load(npz_path) as npz:
+            header    = json.loads(str(npz['header']))                          # [メーカー名, 型番, 型名, 光源, 消費電力]
+            ies       = npz['ies']
+            ies_list  = npz['ies_list'].tolist()
+            diff_list = npz['diff_list'].tolist()
+            lumen     = npz['lumen'].item()
+            cd_max    = npz['cd_max'].item()
+            grid      = npz['grid']                                             # 古いキャッシュにはない、KeyErrorで作り直す
+        os.utime(npz_path)                                                      # 使った時刻を更新、古いものから削除するため
+    except:                                                                     # キャッシュがない、あるいは壊れている場合
+        return None
+    
+    ies = Photometry(ies)                                                       # read_iesと同じ整数の角度ラベル
+    
+    return header + [ies, ies_list, diff_list, lumen, cd_max, grid]
+
+def save_cache(file_path, header, ies, ies_list, diff_list, lumen, cd_max, grid, file_hash=None):
+    
+    npz_path = cache_file_path(file_path, file_hash)
+    os.makedirs(os.path.dirname(npz_path), exist_ok=True)
+    
+    # 並列処理で同時に書き込んでも壊れないよう、一時ファイルに書いてから置き換える
+    temp_path = npz_path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez_compressed(f,
+                            header    = np.array(json.dumps(header)),
+                            ies       = np.asarray(ies, dtype=np.float64),      # 361行 x 181列
+                            ies_list  = np.array(ies_list),                     # 1369要素
+                            diff_list = np.array(diff_list),                    # 2663要素
+                            lumen     = np.array(lumen),
+                            cd_max    = np.array(cd_max),
+                            grid      = np.asarray(grid, dtype=np.float64))     # 向きを調整する前、GRID_PATHの配列と同じ
+    os.replace(temp_path, npz_path)
+
+def evict_cache(size_limit=CACHE_SIZE_LIMIT):
+    
+    # 合計がsize_limitを超えたら、使った時刻の古いものから削除
+    npz_paths = glob.glob(CACHE_PATH + '*/*.npz')
+    stats     = []
+    for npz_path in npz_paths:
+        try:
+            stat = os.stat(npz_path)
+            stats.append((stat.st_mtime, stat.st_size, npz_path))
+        except FileNotFoundError:                                               # 他のプロセスが削除した場合
+            continue
+    
+    total_size = sum(size for mtime, size, npz_path in stats)
+    for mtime, size, npz_path in sorted(stats):                                 # 古い順
+        if total_size <= size_limit:
+            break
+        try:
+            os.remove(npz_path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 1照明器具の特徴量の依存関係（途中の計算結果を、特徴量の名前ごとに一度だけ計算）
+
+# 特徴量の関数は、互いの計算をやり直していた
+# 例: cal_peak_zoneは、cal_peak_angleとcal_peak_valueで、for_diffから2回計算
+#     cal_mounting_surfaceとcal_upper_light_ratioは、どちらもcd_to_lmを計算
+# 特徴量の名前をキーに、最初に参照した時に計算して保存し、2回目以降は保存した値を返す
+# 全ての特徴量を計算しても、一番重い特徴量とほぼ同じ時間
+
+FEATURE_NODES = {
+    
+    # 次元の削減と差分
+    'ies_values':             lambda g: g.ies.values,                           # 361行 x 181列の配列、キャッシュ用
+    'ies_small':              lambda g: reduce_dimensions(g.ies, 5, 10, 180, 360),
+    'ies_list':               lambda g: g['ies_small'].values.ravel().tolist(), # 1369要素のリスト
+    'for_diff':               lambda g: for_diff(g['ies_small']),               # 38行 x 39列、ies_smallと同じ次元の削減は省く
+    'diff_theta':             lambda g: diff_theta(g.ies, g['for_diff']),
+    'diff_phi':               lambda g: diff_phi(g.ies, g['for_diff']),
+    'diff_list':              lambda g: (g['diff_theta'].values.ravel().tolist()  # 1368要素と1295要素のリスト
+                                       + g['diff_phi'].values.ravel().tolist()),
+    
+    # ピーク
+    'peak_theta_mask':        lambda g: cal_peak_theta_mask(g.ies, g['diff_theta']),
+    'peak_phi_mask':          lambda g: cal_peak_phi_mask(g.ies, g['diff_phi']),
+    'peak_mask':              lambda g: cal_peak_mask(g.ies, g['peak_theta_mask'], g['peak_phi_mask']),
+    'peak_angle':             lambda g: cal_peak_angle(g.ies, g['peak_mask']),
+    'peak_value':             lambda g: cal_peak_value(g.ies, g['peak_angle']),
+    'peak_zone':              lambda g: cal_peak_zone(g.ies, g['peak_angle'], g['peak_value']),
+    'peaks':                  lambda g: cal_peaks(g.ies, g['peak_angle']),
+    
+    # 光束
+    'ies_lm':                 lambda g: cd_to_lm(g.ies),
+    'lumen':                  lambda g: cal_lm(g.ies, g['ies_lm']),
+    'upper_light_ratio':      lambda g: cal_upper_light_ratio(g.ies, g['ies_lm']),
+    'upper_light_ratio_type': lambda g: cal_upper_light_ratio_type(g.ies, g['upper_light_ratio']),
+    'mounting_surface':       lambda g: cal_mounting_surface(g.ies, g['ies_lm']),
+    
+    # 対称性と最大光度
+    'symmetry':               lambda g: cal_symmetry(g.ies),
+    'cd_max_id':              lambda g: cal_cd_max(g.ies),                      # (最大光度, 最大光度の角度のリスト)
+    'cd_max':                 lambda g: g['cd_max_id'][0],
+    'beam':                   lambda g: cal_beam(g.ies, g['symmetry'], g['peaks'], g['cd_max']),
+    
+    }
+
+# extract_allで、引数を省略した場合に計算する特徴量
+# cal_beamは未完成のため、含めない
+FEATURES = tuple(name for name in FEATURE_NODES if name != 'beam')
+
+# make_lightで、照明器具レコードとキャッシュに使う特徴量
+RECORD_FEATURES = ('ies_values', 'ies_list', 'diff_list', 'lumen', 'cd_max')
+
+class FeatureGraph:
+    
+    __slots__ = ('ies', 'cache')
+    
+    def __init__(self, ies):                                                    # 引数は、照射方向を調整した配光データ
+        self.ies   = as_photometry(ies)
+        self.cache = {}                                                         # 特徴量の名前ごとの計算結果
+    
+    def __getitem__(self, name):                                                # 例: graph['peak_zone']
+        if name not in self.cache:
+            if name not in FEATURE_NODES:
+                raise KeyError('unknown feature: ' + str(name))
+            self.cache[name] = FEATURE_NODES[name](self)                        # 依存する特徴量も、ここで一度だけ計算
+        return self.cache[name]
+    
+    def __contains__(self, name):                                               # 計算済みか
+        return name in self.cache
+    
+    def extract_all(self, names=FEATURES):                                      # 引数は、特徴量の名前のタプル
+        return {name: self[name] for name in names}
+
+def extract_all(ies, names=FEATURES):                                           # 引数は、照射方向を調整した配光データ
+    return FeatureGraph(ies).extract_all(names)
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 標準化した配光データから、照射方向の調整と特徴量の計算
+
+def derive_features(grid):                                                      # 引数は、向きを調整する前の361行 x 181列の配列
+    
+    ies      = orient_ies(grid)                                                 # 水平照射方向の回転
+    features = extract_all(ies, RECORD_FEATURES)                                # 次元の削減、差分、器具光束、器具最大光度
+    
+    return tuple(features[name] for name in RECORD_FEATURES)                    # ies_values, ies_list, diff_list, lumen, cd_max
+
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 照明器具レコードの作成
 
-def make_light(file_path):                                                      # 引数は、iesへのパス
+def make_light(file_path, ies_data=None, cache=True, data=None, file_hash=None,
+               grid_path=None):                                                 # 引数は、iesへのパス、read_ies_batch(orient=False)で読み込み済みのタプル、読み込み済みのバイト列とそのハッシュ、grid_pathは標準化した配列の保存先
     
     file_name = os.path.basename(file_path)[0:-4]                               # ファイル名を取得、拡張子iesを除く
     
-    manufac, lumcat, luminaire, lamp, wattage, ies = read_ies(file_path)        # iesの読み込み
-    ies_small      = reduce_dimensions(ies,5,10,180,360)                        # 次元の削減
-    ies_diff_theta = diff_theta(ies)                                            # θ方向の差分
-    ies_diff_phi   = diff_phi(ies)                                              # φ方向の差分
+    # ファイルの読み込みとハッシュの計算は、一度だけ
+    if (cache or grid_path) and file_hash is None:
+        if data is None:
+            data = read_photometric_bytes(file_path)
+        file_hash = hashlib.sha1(data).hexdigest()
     
-    ies_list       = ies_small.values.ravel().tolist()                          # 配列化、一元化、リスト化、1369要素のリスト
-    diff_list      = ies_diff_theta.values.ravel().tolist()                     # 配列化、一元化、リスト化、1368要素のリスト
-    diff_list     += ies_diff_phi.values.ravel().tolist()                       # 配列化、一元化、リスト化、1295要素のリストを追加
+    # キャッシュがあれば、読み込みと計算を省く
+    cached = load_cache(file_path, file_hash) if cache else None
+    if cached is not None:
+        manufac, lumcat, luminaire, lamp, wattage, ies, ies_list, diff_list, lumen, cd_max, grid = cached
+    else:
+        if ies_data is None:                                                    # 読み込み済みでない場合
+            ies_data = read_ies(file_path, cache=False, data=data, orient=False)# iesの読み込み、照射方向の調整は特徴量の計算で
+        manufac, lumcat, luminaire, lamp, wattage, grid = ies_data
+        ies, ies_list, diff_list, lumen, cd_max = derive_features(grid)
+        if cache:
+            try:
+                save_cache(file_path, [manufac, lumcat, luminaire, lamp, wattage],
+                           ies, ies_list, diff_list, lumen, cd_max, grid, file_hash)
+            except:                                                             # 保存できなくても、レコードは作れている
+                print('cache not saved: ' + file_path)
+                print(traceback.format_exc())
+    
+    # 標準化した配列の保存、特徴量を計算し直す時にファイルを読み直さないため
+    if grid_path is not None:
+        try:
+            write_grid(grid_path, file_hash, grid)
+        except:                                                                 # 保存できなくても、レコードは作れている、make_grid_archivesで作り直せる
+            print('grid not saved: ' + file_path)
+            print(traceback.format_exc())
     
     # 照明器具のデータフレームに列を追加し、値を代入する
     # 要高速化
@@ -2269,9 +3083,9 @@ def make_light(file_path):
                      None,                                                      # 列17: 最小電圧
                      None,                                                      # 列18: 最大電圧
                      wattage,                                                   # 列19: 消費電力
-                     cal_lm(ies),                                               # 列20: 器具光束
+                     lumen,                                                     # 列20: 器具光束
                      None,                                                      # 列21: ビーム角
-                     cal_cd_max(ies)[0],                                        # 列22: 器具最大光度
+                     cd_max,                                                    # 列22: 器具最大光度
                      None,                                                      # 列23: 最低色温度
                      None,                                                      # 列24: 最高色温度
                      None,                                                      # 列25: 測定色温度
@@ -2283,217 +3097,1802 @@ def make_light(file_path):
                      None                                                       # 列31: ダウンロードURL
                      ]
     
-    return light                                                                # 返り値はリスト、リストの方が後の繰り返し追加処理が速い
+    return light                                                                # 返り値はリスト、リストの方が後の繰り返し追加処理が速い
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 照明器具レコーズの作成、子プロセスで実行する単位
+
+def make_lights_worker(items):                                                  # 引数は、(iesへのパス, 計算済みのハッシュかNone)のリスト
+    
+    # 子プロセスから呼ぶため、モジュールの最上位に置く
+    # エラーは子プロセスで文字列にし、親プロセスで表示する
+    
+    # ハッシュが計算済みなら、キャッシュがあるかは読まずに分かる
+    # それ以外は、ファイルごとに一度だけ読み込み、ハッシュを計算
+    # 読めなかったファイルは、エラーを残し、make_lightで読み直さない
+    file_paths = [file_path for file_path, file_hash in items]
+    hashes     = {file_path: file_hash for file_path, file_hash in items if file_hash is not None}
+    datas      = {}
+    errors     = {}                                                             # ファイルパスごとのトレースバック
+    for file_path in file_paths:
+        if file_path in hashes:
+            continue
+        try:
+            datas[file_path]  = data = read_photometric_bytes(file_path)
+            hashes[file_path] = hashlib.sha1(data).hexdigest()
+        except:
+            errors[file_path] = traceback.format_exc()
+    
+    misses = [file_path for file_path in hashes if not is_cached(file_path, hashes[file_path])]
+    for file_path in misses:                                                    # キャッシュのないファイルは、標準化のために読む
+        if file_path not in datas:
+            try:
+                datas[file_path] = read_photometric_bytes(file_path)
+            except:
+                errors[file_path] = traceback.format_exc()
+    misses    = [file_path for file_path in misses if file_path not in errors]
+    ies_batch = read_ies_batch(misses, orient=False, datas=datas, errors=errors)# キャッシュのないファイルのみ、角度ラベルが同じファイルをまとめて標準化
+    
+    results = []
+    for file_path in file_paths:
+        if file_path in errors:                                                 # 読み込みか標準化に失敗したファイル
+            results.append((file_path, None, errors[file_path]))
+            continue
+        try:
+            light = make_light(file_path, ies_batch.get(file_path),
+                               data=datas.get(file_path), file_hash=hashes.get(file_path)) # 照明器具レコードの作成
+            results.append((file_path, light, None))
+        except:                                                                 # iesの読み込みに失敗する可能性も
+            results.append((file_path, None, traceback.format_exc()))
+    
+    return results                                                              # 返り値は、(ファイルパス, 照明器具レコード, エラー)のリスト
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 照明器具レコーズの作成、並列処理
+
+def iter_lights(file_paths, batch_size=256, processes=1, ordered=True,
+                hashes=None):                                                   # processesは、1なら並列処理なし、Noneなら全コア、hashesは計算済みのファイルパスごとのハッシュ
+    
+    # batch_size ごとに区切り、子プロセスに渡す
+    # コア数に対して区切りが少ないと、空いたコアが出るので、小さくする
+    if processes != 1:
+        no_of_processes = processes or multiprocessing.cpu_count()
+        batch_size = max(1, min(batch_size, len(file_paths) // (no_of_processes * 4)))
+    
+    hashes = hashes or {}
+    items  = [(file_path, hashes.get(file_path)) for file_path in file_paths]   # ハッシュも子プロセスに渡し、計算し直さない
+    chunks = [items[i : i+batch_size] for i in range(0, len(items), batch_size)]
+    
+    if processes == 1:                                                          # 並列処理なし
+        for chunk in chunks:
+            for result in make_lights_worker(chunk):
+                yield result
+        return
+    
+    with multiprocessing.Pool(processes) as pool:
+        if ordered:                                                             # ファイルの順番通りに返す
+            results = pool.imap(make_lights_worker, chunks)
+        else:                                                                   # 終わった順に返す、少し速い
+            results = pool.imap_unordered(make_lights_worker, chunks)
+        for chunk_results in results:
+            for result in chunk_results:
+                yield result                                                    # (ファイルパス, 照明器具レコード, エラー)
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 照明器具レコーズの作成
+
+def make_lights_basic(folder_path, batch_size=256, processes=1, ordered=True):  # 引数は、クラスタリング、クエリのフォルダ、batch_sizeはまとめて標準化するファイル数
+    
+    start_time = time.time()
+    
+    file_paths  = list_photometric_files(folder_path)                           # フォルダ内とzipやtarの中のiesとldtファイルを取得、/**/で直下以外も
+    no_of_files = len(file_paths)
+    
+    lights   = []
+    unreadable_files = []
+    results  = iter_lights(file_paths, batch_size, processes, ordered)
+    for i, (file_path, light, error) in enumerate(results):                     # フォルダ内の全ファイルで繰り返す
+        
+        # メーカーにより数千個の照明器具データがある
+        # 繰り返しの途中でエラーが発生することも想定
+        
+        print(i+1, '/', no_of_files, ' ', file_path)
+        file_name = os.path.basename(file_path)
+        
+        if error is not None:                                                   # iesの読み込みに失敗する可能性も
+            print('--------------------'*4)
+            print('error: ')
+            print(error)
+            unreadable_files.append(file_name)
+            
+            continue
+        
+        lights.append(light)
+    
+    evict_cache()                                                               # キャッシュが上限を超えたら、古いものから削除
+    close_archives()                                                            # 開いたアーカイブを閉じる
+    
+    end_time = time.time()
+    elapse_time = round((end_time - start_time), 5)
+    print('make light fixtures:   ', elapse_time, ' sec')
+    print('')
+    
+    return lights                                                               # 返り値はリストのリスト
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 読み込めなかったファイルの書き出し
+
+def write_unreadable_files(folder_path, unreadable_files):
+    
+    error_file_path  = ERROR_PATH + 'Error - make_lights.txt'                   # エラーファイルを書き出すファイルパス
+    no_of_unreadable_files = len(unreadable_files)
+    unreadable_files = '\n'.join(unreadable_files)                              # ['a.ies', 'b.ies']を改行表示のため、'a.ies\nb.ies'に変換
+    with open(error_file_path, 'a') as f:
+        f.write('--------------------'*2)
+        f.write('\n')
+        f.write(folder_path)
+        f.write('\n')
+        f.write('number of unreadable files: ' + str(no_of_unreadable_files))
+        f.write('\n')
+        f.write(unreadable_files)
+        f.write('\n')
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 照明器具レコーズの作成
+
+def make_lights(folder_path, batch_size=256, processes=1, ordered=True,         # 引数は、メーカー、batch_sizeはまとめて標準化するファイル数
+                file_paths=None):                                               # file_pathsは、フォルダ内の一部のファイルのみ作成する場合
+    
+    start_time = time.time()
+    
+    folder_name = os.path.basename(folder_path)                                 # フォルダ名は、メーカー名
+    if file_paths is None:                                                      # 指定がなければ、フォルダ内の全ファイル
+        file_paths = list_photometric_files(folder_path)                        # フォルダ内とzipやtarの中のiesとldtファイルを取得、/**/で再起的に取得
+    no_of_files = len(file_paths)
+    
+    links = read_links(folder_path)                                             # フォルダ内のcsvファイルの読み込み、ファイル名の索引
+    
+    # 隔離したファイルは、ハッシュの確認だけで読み込まない
+    make_quarantine_table()
+    file_paths, hashes = skip_quarantined(file_paths)
+    
+    lights           = []
+    unreadable_files = []
+    results          = iter_lights(file_paths, batch_size, processes, ordered, hashes)
+    for i, (file_path, light, error) in enumerate(results):                     # フォルダ内の全ファイルで繰り返す
+        
+        # メーカーにより数千個の照明器具データがある
+        # 繰り返しの途中でエラーが発生することも想定
+        
+        print(i+1, '/', no_of_files, ' ', file_path)
+        file_name = os.path.basename(file_path)
+        
+        if error is not None:                                                   # 配光データが読めないファイルは隔離、一時的なエラーなどは隔離しない
+            quarantine_file(file_path, hashes.get(file_path), error, folder_name)
+        else:
+            try:
+                link = links[file_name]                                         # 読み込むファイルに該当するデータ、なければKeyError
+                parent_page_url = link['Parent Page']                           # iesファイルのダウンロードリンク
+                
+                # データベースの作成
+                light[MANUFACTURER] = folder_name                               # メーカー名に、フォルダ名を代入
+                light[DOWNLOAD_URL] = parent_page_url
+                lights.append(light)
+            
+            except:                                                             # リンクがないだけなら、隔離しない
+                error = traceback.format_exc()
+        
+        if error is not None:                                                   # iesの読み込みに失敗する可能性も
+            print('--------------------'*4)
+            print('error: ')
+            print(error)
+            unreadable_files.append(file_name)
+    
+    # エラーファイルを書き出す
+    write_unreadable_files(folder_path, unreadable_files)
+    con.commit()                                                                # 隔離したファイルの記録
+    
+    evict_cache()                                                               # キャッシュが上限を超えたら、古いものから削除
+    close_archives()                                                            # 開いたアーカイブを閉じる
+    
+    end_time = time.time()
+    elapse_time = round((end_time - start_time), 5)
+    print('make light fixtures:   ', elapse_time, ' sec')
+    print('')
+    
+    return lights                                                               # 返り値はリストのリスト
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 照明器具レコーズの挿入、コミットはしない
+
+def insert_lights(lights):
+    
+    lights = to_json(lights)
+    
+    cur.executemany( ' INSERT INTO light_table '
+                     ' VALUES      (' + ('?,'*32)[:-1] + ')'                    # ?はプレースホルダー、最後はカンマを削除
+                   # '(?,?,...32個...?)'の文字列
+                     , lights
+                   )
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 照明器具レコーズの追加
+
+def add_lights(lights, bulk=False):                                             # bulkは、一括読み込みモード
+    
+    start_time = time.time()
+    
+    # 全テーブルの全列を読むget_table_infoは使わず、行数だけ数える
+    no_of_rows_before = count_rows('light_table')                               # レコーズ追加前の行数
+    
+    if bulk:
+        begin_bulk_load()
+    
+    # 繰り返し処理
+    # no_of_data = len(lights)
+    # for i in range(no_of_data):
+    # 
+    #     print(str(i+1) +'/'+ str(no_of_data) +' '+ lights[i][0])              # 何番目/全体 ファイル名を表示
+    # 
+    #     cur.execute(  ' INSERT INTO light_table '                             # 予約語の前後の空白が大事
+    #                   ' VALUES ' + str(tuple(lights[i]))
+    #                   )
+    
+    # バッチ処理、
+    # 繰り返し処理より約５倍速いが、メモリ不足の可能性
+    insert_lights(lights)
+    
+    con.commit()
+    if bulk:
+        end_bulk_load()
+    
+    no_of_rows_after = count_rows('light_table')                                # レコーズ追加後の行数
+    
+    # データ追加前後の行数を表示
+    print('--------------------'*4)
+    print('add light fixtures')
+    print('before:     ', no_of_rows_before, ' rows')
+    print('after:      ', no_of_rows_after,  ' rows')
+    print('added:      ', no_of_rows_after
+                        - no_of_rows_before, ' rows')
+    
+    end_time = time.time()
+    elapsed_time = round((end_time - start_time), 5)
+    print('')
+    print(elapsed_time, ' sec')
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 照明器具レコーズの逐次取り込み
+# 読み込みスレッド → 計算の子プロセス → SQLiteへの書き込み(メインスレッド)
+
+# make_lightsは全レコーズをメモリに作ってから、add_lightsで一度に書き込む
+# ここでは、段階の間を上限のあるキューでつなぎ、
+# 読み込み、計算、書き込みを同時に進め、write_sizeごとに書き込み、commit_sizeごとにコミットする
+# 後の段階が詰まると前の段階が待つので、メーカーのファイル数に関わらず、メモリの使用量は一定
+
+def ingest_worker(item):                                                        # 子プロセスで実行、引数は(ファイルパス, バイト列, ハッシュ, 標準化した配列の保存先)
+    
+    file_path, data, file_hash, grid_path = item
+    try:
+        light = make_light(file_path, data=data, file_hash=file_hash,
+                           grid_path=grid_path)                                 # 照明器具レコードの作成、ファイルは再度読まず、ハッシュも再度計算しない
+        return file_path, light, None
+    except:                                                                     # iesの読み込みに失敗する可能性も
+        return file_path, None, traceback.format_exc()
+
+def ingest_reader(path_queue, read_queue, write_queue, quarantine, hashes, grid_path=None): # 読み込みスレッド、hashesにファイルパスごとのハッシュを書く
+    
+    while True:
+        try:
+            file_path = path_queue.get_nowait()
+        except queue.Empty:                                                     # 読むファイルがなくなった
+            break
+        try:
+            data = read_photometric_bytes(file_path)
+            hashes[file_path] = file_hash = hashlib.sha1(data).hexdigest()
+            if file_hash in quarantine:                                         # 隔離したファイルは、計算せず書き込みに渡す
+                write_queue.put((file_path, None, QUARANTINED))
+            else:
+                read_queue.put((file_path, data, file_hash, grid_path))         # キューがいっぱいなら待つ
+        except:                                                                 # 読めないファイルは、書き込みに直接渡す
+            write_queue.put((file_path, None, traceback.format_exc()))
+    
+    read_queue.put(None)                                                        # 終了の合図
+
+def ingest_dispatcher(read_queue, write_queue, no_of_readers, processes, max_in_flight):
+    
+    # 読み込み済みのファイルを子プロセスに渡す
+    # 計算中のファイル数をmax_in_flightまでに抑える
+    
+    if processes == 1:                                                          # 並列処理なし、このスレッドで計算
+        finished = 0
+        while finished < no_of_readers:
+            item = read_queue.get()
+            if item is None:
+                finished += 1
+                continue
+            write_queue.put(ingest_worker(item))
+        write_queue.put(None)                                                   # 終了の合図
+        return
+    
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    
+    def done(result):                                                           # 計算が終わったら、書き込みに渡し、次を受け付ける
+        write_queue.put(result)
+        in_flight.release()
+    
+    with multiprocessing.Pool(processes) as pool:
+        finished = 0
+        while finished < no_of_readers:
+            item = read_queue.get()
+            if item is None:
+                finished += 1
+                continue
+            in_flight.acquire()                                                 # 計算中が多ければ待つ
+            pool.apply_async(ingest_worker, (item,), callback=done,
+                             error_callback=lambda e, file_path=item[0]: done((file_path, None, repr(e))))
+        pool.close()
+        pool.join()                                                             # 計算中のものが全て終わるまで待つ
+    
+    write_queue.put(None)                                                       # 終了の合図
+
+def write_lights(lights, unreadable_files):
+    
+    # write_sizeごとに書き込む、コミットはingest_lightsでcommit_sizeごとに
+    # 主キーの重複があれば、1行ずつ書き込み、重複したものはエラーに
+    # 失敗したexecutemanyの途中までの行は残るので、セーブポイントまで戻してから書き直す
+    
+    if not con.in_transaction:                                                  # トランザクションの外のセーブポイントは、RELEASEでコミットされる
+        cur.execute('BEGIN')
+    cur.execute('SAVEPOINT write_lights')
+    try:
+        insert_lights(lights)
+        file_names = [light[FILE_NAME] for light in lights]
+    except sqlite3.IntegrityError:
+        cur.execute('ROLLBACK TO write_lights')                                 # 未コミットの削除などは戻さない
+        file_names = []
+        for light in lights:
+            try:
+                insert_lights([light])
+                file_names.append(light[FILE_NAME])
+            except sqlite3.IntegrityError:
+                print('duplicated: ' + light[FILE_NAME])
+                unreadable_files.append(light[FILE_NAME])
+    cur.execute('RELEASE write_lights')
+    
+    return file_names
+
+def ingest_lights(folder_path, file_paths=None, processes=None, reader_threads=4,
+                  commit_size=500, queue_size=64, hashes=None, retry=None,
+                  write_size=500, grid_path=None):                              # 引数は、メーカー、queue_sizeは段階の間で待たせる最大ファイル数、hashesとretryは呼び出し側に返す辞書とリスト、write_sizeは一度に書き込む行数、grid_pathは標準化した配列の保存先
+    
+    start_time = time.time()
+    
+    folder_name = os.path.basename(folder_path)                                 # フォルダ名は、メーカー名
+    if file_paths is None:                                                      # 指定がなければ、フォルダ内の全ファイル
+        file_paths = list_photometric_files(folder_path)
+    no_of_files = len(file_paths)
+    
+    links = read_links(folder_path)                                             # フォルダ内のcsvファイルの読み込み、ファイル名の索引
+    
+    make_quarantine_table()
+    quarantine = get_quarantine()                                               # 隔離したファイルのハッシュ
+    if hashes is None:                                                          # 読み込みスレッドが書く
+        hashes = {}
+    if retry is None:                                                           # 隔離せず、次回読み直すファイル
+        retry = []
+    
+    # 段階の間のキュー、上限を超えると前の段階が待つ
+    path_queue  = queue.Queue()
+    for file_path in file_paths:
+        path_queue.put(file_path)
+    read_queue  = queue.Queue(maxsize=queue_size)                               # 読み込み済みのバイト列
+    write_queue = queue.Queue(maxsize=queue_size)                               # 計算済みの照明器具レコード
+    
+    threads  = [threading.Thread(target=ingest_reader, args=(path_queue, read_queue, write_queue, quarantine, hashes, grid_path), daemon=True)
+                for i in range(reader_threads)]
+    threads += [threading.Thread(target=ingest_dispatcher, args=(read_queue, write_queue, reader_threads, processes, queue_size), daemon=True)]
+    for t in threads:
+        t.start()
+    
+    # 書き込み、メインスレッドで行う
+    lights           = []
+    made_names       = []                                                       # 書き込んだファイル名
+    unreadable_files = []
+    write_size       = min(write_size, commit_size)                             # コミットより大きくまとめても意味がない
+    uncommitted      = 0                                                        # 前のコミットから書き込んだ行数
+    i = 0
+    while True:
+        result = write_queue.get()
+        if result is None:                                                      # 全ての計算が終わった
+            break
+        file_path, light, error = result
+        file_name = os.path.basename(file_path)
+        i += 1
+        print(i, '/', no_of_files, ' ', file_path)
+        
+        if error is QUARANTINED:                                                # 隔離したファイル、エラーファイルにも書かない
+            print('quarantined: ' + file_name)
+            continue
+        
+        if error is not None:                                                   # 配光データが読めないファイルは隔離
+            if not quarantine_file(file_path, hashes.get(file_path), error, folder_name):
+                retry.append(file_path)
+        else:
+            try:
+                link = links[file_name]                                         # 読み込むファイルに該当するデータ、なければKeyError
+                parent_page_url = link['Parent Page']                           # iesファイルのダウンロードリンク
+                
+                light[MANUFACTURER] = folder_name                               # メーカー名に、フォルダ名を代入
+                light[DOWNLOAD_URL] = parent_page_url
+                lights.append(light)
+            
+            except:                                                             # リンクがないだけなら、隔離しない
+                error = traceback.format_exc()
+                retry.append(file_path)
+        
+        if error is not None:                                                   # iesの読み込みに失敗する可能性も
+            print('--------------------'*4)
+            print('error: ')
+            print(error)
+            unreadable_files.append(file_name)
+        
+        if len(lights) >= write_size:                                           # write_sizeごとに書き込み
+            made_names  += write_lights(lights, unreadable_files)
+            uncommitted += len(lights)
+            lights = []
+            if uncommitted >= commit_size:                                      # commit_sizeごとにコミット
+                con.commit()
+                uncommitted = 0
+    
+    made_names += write_lights(lights, unreadable_files)                        # 残りを書き込み
+    con.commit()
+    
+    for t in threads:
+        t.join()
+    
+    # エラーファイルを書き出す
+    write_unreadable_files(folder_path, unreadable_files)
+    evict_cache()                                                               # キャッシュが上限を超えたら、古いものから削除
+    
+    end_time = time.time()
+    elapse_time = round((end_time - start_time), 5)
+    print('ingest light fixtures:   ', len(made_names), ' rows, ', elapse_time, ' sec')
+    print('')
+    
+    return made_names                                                           # 返り値は、書き込んだファイル名のリスト
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 全メーカーで照明器具レコーズの作成・追加
+
+def make_add_lights(processes=1, bulk=False):                                   # processesは、1なら並列処理なし、Noneなら全コア、bulkは一括読み込みモード
+    
+    # 取り込み履歴(manifest_table)と比べ、
+    # 追加・変更されたファイルのみ読み込み、削除されたファイルのレコードは削除
+    # 変更のないメーカーは、ファイルの更新時刻とサイズの確認のみ
+    
+    start_time = time.time()
+    
+    make_manifest_table()
+    
+    manufacturers_in_folder   = get_manufacturers_from_folder()
+    manufacturers_in_manifest = get_manufacturers_from_manifest()
+    
+    # フォルダごと削除されたメーカーも、レコードを削除するため含める
+    manufacturers = sorted(set(manufacturers_in_folder) | set(manufacturers_in_manifest))
+    
+    # 一括読み込みモードでは、インデックスを削除し、コミットの間隔を広げる
+    commit_size = 500
+    if bulk:
+        begin_bulk_load()
+        commit_size = BULK_COMMIT_SIZE
+    
+    try:
+        for m in manufacturers:                                                 # 各メーカーのフォルダで繰り返す
+            print('--------------------'*4)
+            print('start: ' + m)
+            
+            update_manufacturer_lights(m, processes, commit_size)               # 照明器具レコーズの作成・追加・削除
+    finally:                                                                    # 途中で止めても、インデックスと設定を戻す
+        if bulk:
+            end_bulk_load()
+    
+    end_time = time.time()
+    elapse_time = round((end_time - start_time), 5)
+    print('make add light fixtures:   ', elapse_time, ' sec')
+    print('')
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 取り込み履歴のテーブルの作成
+
+def make_manifest_table():
+    
+    # ファイルごとに、取り込んだ時のサイズ、更新時刻、中身のハッシュ、PIPELINE_VERSIONを記録
+    # get_table_infoで行数を数えるため、file_name列も持つ
+    
+    cur.execute(
+                'CREATE TABLE IF NOT EXISTS manifest_table' +
+                '''
+                (                                                               -- 各列の最後のカンマ忘れに注意、最後は要らない
+                file_path               TEXT    PRIMARY KEY,                    -- 列0、 zipやtarの中は、アーカイブのパス/中のファイル名
+                file_name               TEXT,                                   -- 列1、 light_tableのfile_name
+                manufacturer            TEXT,                                   -- 列2、 メーカーフォルダ名
+                size                    INTEGER,                                -- 列3、 バイト数
+                mtime                   REAL,                                   -- 列4、 更新時刻
+                hash                    TEXT,                                   -- 列5、 中身のsha1
+                pipeline_version        INTEGER,                                -- 列6、 取り込んだ時のPIPELINE_VERSION
+                status                  TEXT                                    -- 列7、 'ok'か'error'
+                )
+                '''
+               )
+    
+    con.commit()
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 取り込み履歴の取得
+
+def get_manifest(manufacturer):
+    
+    cur.execute( ' SELECT file_path, file_name, size, mtime, hash, pipeline_version, status '
+                 ' FROM   manifest_table '
+                 ' WHERE  manufacturer = ? '                                    # 予約語の前後の空白が大事
+                 , (manufacturer,)
+               )
+    
+    manifest = {r[0]: r[1:] for r in cur.fetchall()}                            # ファイルパスをキーにした辞書
+    
+    return manifest
+
+def get_manufacturers_from_manifest():
+    
+    cur.execute(' SELECT DISTINCT manufacturer FROM manifest_table ')
+    
+    manufacturers = [r[0] for r in cur.fetchall()]
+    manufacturers.sort()
+    
+    return manufacturers
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# ファイルのサイズと更新時刻、中身のハッシュ
+
+def stat_photometric_file(file_path):
+    
+    archive_path, member = split_archive_path(file_path)
+    stat = os.stat(archive_path)
+    
+    if member is None:                                                          # 通常のファイル
+        return stat.st_size, stat.st_mtime
+    
+    # zipやtarの中のファイルは、中のファイルのサイズと、アーカイブの更新時刻
+    with archives_lock:
+        archive = open_archive(archive_path)
+        if isinstance(archive, zipfile.ZipFile):
+            size = archive.getinfo(member).file_size
+        else:
+            size = archive.getmember(member).size
+    
+    return size, stat.st_mtime
+
+def hash_photometric_file(file_path):
+    
+    return hashlib.sha1(read_photometric_bytes(file_path)).hexdigest()
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 読めないファイルの隔離
+
+# 読めないファイルは、毎回読み込みに失敗し、そのたびに時間がかかる
+# 中身のハッシュ、失敗した段階、例外の種類を記録し、中身が変わらなければ読み込まない
+# 読み込みを直したら、PARSER_VERSIONを1つ上げ、revalidate_quarantineで再確認する
+# 隔離するのは、ファイルの中身が原因の読み込み、解析、標準化の段階のエラーのみ
+# 特徴量の計算のエラー、リンクのcsvにないだけのファイルは、コードやcsvを直せば読めるので、隔離せず次回読み直す
+# ディスクの空き不足などのOSError、MemoryError、子プロセスの異常終了(トレースバックのないrepr(e))は一時的なので、隔離せず次回読み直す
+
+QUARANTINED = 'quarantined'                                                     # 隔離したファイルのエラーの代わり
+
+QUARANTINE_STAGES = ('read', 'parse', 'standardize')                            # 隔離する段階
+TRANSIENT_ERRORS  = (OSError, MemoryError)                                      # 隔離しない例外、サブクラスも含む
+
+# 関数名から失敗した段階、トレースバックの深い方から探す
+ERROR_STAGES = {
+                'read_photometric_bytes' : 'read',
+                'open_archive'           : 'read',
+                'read_raw'               : 'parse',
+                'read_ies_raw'           : 'parse',
+                'read_ies_raw_bulk'      : 'parse',
+                'read_ldt_raw'           : 'parse',
+                'read_ldt_raw_bulk'      : 'parse',
+                'parse_ies_keywords'     : 'parse',
+                'ldt_plane_index'        : 'parse',
+                'read_ies'               : 'parse',                             # read_rawの返り値が不正な場合
+                'mirror_labels'          : 'standardize',
+                'select_labels'          : 'standardize',
+                'interp_table'           : 'standardize',
+                'interp_apply'           : 'standardize',
+                'interp_regular'         : 'standardize',
+                'standardize_ies'        : 'standardize',
+                'orient_ies'             : 'features',
+                'derive_features'        : 'features',
+                'make_light'             : 'features',
+               }
+
+def make_quarantine_table():
+    
+    # get_table_infoで行数を数えるため、file_name列も持つ
+    
+    cur.execute(
+                'CREATE TABLE IF NOT EXISTS quarantine_table' +
+                '''
+                (                                                               -- 各列の最後のカンマ忘れに注意、最後は要らない
+                hash                    TEXT    PRIMARY KEY,                    -- 列0、 中身のsha1、manifest_tableのhashと同じ
+                file_name               TEXT,                                   -- 列1、 light_tableのfile_name
+                file_path               TEXT,                                   -- 列2、 最後に失敗したファイルのパス
+                manufacturer            TEXT,                                   -- 列3、 メーカーフォルダ名
+                stage                   TEXT,                                   -- 列4、 'read'、'parse'、'standardize'、'features'
+                error_class             TEXT,                                   -- 列5、 例外の種類、例: 'ValueError'
+                message                 TEXT,                                   -- 列6、 トレースバックの最後の行
+                parser_version          INTEGER                                 -- 列7、 失敗した時のPARSER_VERSION
+                )
+                '''
+               )
+    
+    con.commit()
+
+def get_quarantine():
+    
+    cur.execute(' SELECT hash, stage, error_class FROM quarantine_table ')
+    
+    quarantine = {r[0]: r[1:] for r in cur.fetchall()}                          # ハッシュをキーにした辞書
+    
+    return quarantine
+
+def skip_quarantined(file_paths):
+    
+    # 隔離したファイルを除いたファイルパスのリストと、ファイルパスごとのハッシュ
+    quarantine = get_quarantine()
+    if not quarantine:                                                          # 隔離したファイルがなければ、ハッシュを計算しない
+        return list(file_paths), {}
+    
+    kept   = []
+    hashes = {}
+    for file_path in file_paths:
+        try:
+            hashes[file_path] = hash_photometric_file(file_path)
+        except:                                                                 # 読めないファイルは、読み込みでエラーを表示
+            kept.append(file_path)
+            continue
+        if hashes[file_path] in quarantine:
+            print('quarantined: ' + os.path.basename(file_path))
+            continue
+        kept.append(file_path)
+    
+    return kept, hashes
+
+def classify_error(error):                                                      # 引数は、トレースバックの文字列
+    
+    lines = [l for l in error.strip().splitlines() if l.strip()]
+    error_class = lines[-1].split(':')[0].strip() if lines else ''             # 例: 'ValueError: could not ...'の'ValueError'
+    message     = lines[-1].strip()            if lines else ''
+    
+    stage = 'unknown'
+    for function in reversed(re.findall(r', in (\w+)', error)):                # 深い方から
+        if function in ERROR_STAGES:
+            stage = ERROR_STAGES[function]
+            break
+    
+    return stage, error_class, message
+
+def is_transient_error(error_class):                                            # 引数は、例外の種類名、例: 'OSError'
+    
+    error_class = getattr(builtins, error_class, None)                          # 'zipfile.BadZipFile'などは組み込みでないのでNone
+    
+    return isinstance(error_class, type) and issubclass(error_class, TRANSIENT_ERRORS)
+
+def quarantine_file(file_path, file_hash, error, manufacturer):                 # コミットはしない、返り値は隔離したかどうか
+    
+    stage, error_class, message = classify_error(error)
+    if stage not in QUARANTINE_STAGES or is_transient_error(error_class):       # 次回読み直す
+        return False
+    
+    if file_hash is None:                                                       # 読み込みスレッドでハッシュを計算していない
+        try:
+            file_hash = hash_photometric_file(file_path)
+        except:                                                                 # 読めないファイルは、ハッシュがないので隔離できない
+            return False
+    
+    cur.execute( ' INSERT OR REPLACE INTO quarantine_table '
+                 ' VALUES (?,?,?,?,?,?,?,?) '
+                 , (file_hash, os.path.basename(file_path)[0:-4], file_path, manufacturer,
+                    stage, error_class, message, PARSER_VERSION)
+               )
+    
+    return True
+
+def revalidate_quarantine():
+    
+    # PARSER_VERSIONより前に隔離したファイルを読み直す
+    # 読めたら隔離を解き、取り込み履歴から消すので、次のmake_add_lightsで取り込まれる
+    
+    start_time = time.time()
+    
+    make_quarantine_table()
+    make_manifest_table()
+    cur.execute( ' SELECT hash, file_path FROM quarantine_table '
+                 ' WHERE  parser_version < ? '
+                 , (PARSER_VERSION,)
+               )
+    rows = cur.fetchall()
+    
+    fixed = []
+    for file_hash, file_path in rows:
+        try:
+            data = read_photometric_bytes(file_path)
+        except:                                                                 # ファイルが削除された
+            data = None
+        if data is None or hashlib.sha1(data).hexdigest() != file_hash:         # 中身が変わったファイルは、取り込みで読み直す
+            cur.execute(' DELETE FROM quarantine_table WHERE hash = ? ', (file_hash,))
+            continue
+        
+        try:
+            make_light(file_path, data=data, file_hash=file_hash)               # 読めれば、キャッシュにも保存
+        except:
+            stage, error_class, message = classify_error(traceback.format_exc())
+            cur.execute( ' UPDATE quarantine_table '
+                         ' SET    stage = ?, error_class = ?, message = ?, parser_version = ? '
+                         ' WHERE  hash = ? '
+                         , (stage, error_class, message, PARSER_VERSION, file_hash)
+                       )
+            continue
+        
+        cur.execute(' DELETE FROM quarantine_table WHERE hash = ? ', (file_hash,))
+        cur.execute(' DELETE FROM manifest_table   WHERE hash = ? ', (file_hash,))
+        fixed.append(file_path)
+    
+    con.commit()
+    
+    end_time = time.time()
+    elapse_time = round((end_time - start_time), 5)
+    print('revalidated:  ', len(rows), ' files')
+    print('fixed:        ', len(fixed), ' files')
+    print('revalidate quarantine:   ', elapse_time, ' sec')
+    print('')
+    
+    return fixed                                                                # 返り値は、読めるようになったファイルパスのリスト
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# メーカーごとの照明器具レコーズの差分更新
+
+def update_manufacturer_lights(manufacturer, processes=1, commit_size=500):
+    
+    folder_path = MANUFACTURER_PATH + manufacturer                              # メーカーフォルダへのパスを作成
+    file_paths  = list_photometric_files(folder_path)                           # フォルダがない場合は空のリスト
+    manifest    = get_manifest(manufacturer)
+    
+    # 削除されたファイル
+    in_folder = set(file_paths)                                                 # 一度だけ作る
+    removed   = [p for p in manifest if p not in in_folder]
+    
+    # 追加・変更されたファイル、PIPELINE_VERSIONが古いファイル
+    targets = []
+    touched = []                                                                # 中身は同じで、更新時刻だけ変わったファイル
+    stats   = {}
+    for file_path in file_paths:
+        stats[file_path] = size, mtime = stat_photometric_file(file_path)
+        
+        if file_path in manifest:
+            file_name, size0, mtime0, hash0, version0, status0 = manifest[file_path]
+            if version0 == PIPELINE_VERSION:
+                if size == size0 and mtime == mtime0:                           # 変更なし、読み込まない
+                    continue
+                if size == size0 and hash_photometric_file(file_path) == hash0: # 中身は同じ
+                    touched.append((mtime, file_path))
+                    continue
+        
+        targets.append(file_path)
+    
+    print('added or changed: ', len(targets), ' files')
+    print('removed:          ', len(removed), ' files')
+    
+    # 削除されたファイルと、作り直すファイルのレコードを削除
+    # 他のメーカーの同じファイル名のレコードは消さない、取り込みで重複のエラーに
+    file_names  = [manifest[p][0] for p in removed]
+    file_names += [os.path.basename(p)[0:-4] for p in targets]
+    cur.executemany( ' DELETE FROM light_table '
+                     ' WHERE  file_name = ? AND manufacturer = ? '
+                     , [(n, manufacturer) for n in file_names]
+                   )
+    cur.executemany(' DELETE FROM manifest_table WHERE file_path = ? ', [(p,) for p in removed])
+    
+    # 追加・変更されたファイルのみ、照明器具レコーズを作成・追加
+    # 読み込み、計算、書き込みを同時に進め、少しずつコミットする
+    made_names = set()
+    hashes     = {}                                                             # 読み込みスレッドで計算したハッシュ
+    retry      = []                                                             # 隔離しなかったエラーのファイル
+    if targets:
+        made_names = set(ingest_lights(folder_path, file_paths=targets, processes=processes,
+                                       commit_size=commit_size, hashes=hashes, retry=retry,
+                                       grid_path=grid_archive_path(manufacturer)))
+    
+    # 取り込み履歴を更新、隔離したファイルも、変更されるまで読み込まない
+    # 一時的なエラーなどで隔離しなかったファイルは、履歴に残さず次回読み直す
+    retry = set(retry)
+    rows  = []
+    for file_path in targets:
+        if file_path in retry:
+            continue
+        file_name = os.path.basename(file_path)[0:-4]
+        rows.append((file_path, file_name, manufacturer) + stats[file_path]
+                    + (hashes.get(file_path), PIPELINE_VERSION, 'ok' if file_name in made_names else 'error'))
+    
+    cur.executemany( ' INSERT OR REPLACE INTO manifest_table '
+                     ' VALUES (?,?,?,?,?,?,?,?) '
+                     , rows
+                   )
+    cur.executemany(' UPDATE manifest_table SET mtime = ? WHERE file_path = ? ', touched)
+    
+    con.commit()
+    close_archives()                                                            # このメーカーのアーカイブを閉じる
+    
+    update_grid_archive(manufacturer)                                           # 標準化した配光データの保存も更新
+    update_photometry(manufacturer, targets)                                    # 同じ配光データの照明器具の対応も更新
+    
+    return sorted(made_names)                                                   # 返り値は、追加したファイル名のリスト
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 標準化した配光データの保存、ファイルを読み直さずに特徴量を計算し直すため
+
+# データベースには、次元を削減した光度とその差分しかない
+# 次元の削減、差分、照射方向の計算を変えると、全ファイルの読み込みからやり直しになる
+# メーカーごとのフォルダに、向きを調整する前の361行 x 181列の配列を、ファイルの中身のハッシュごとに.npzで圧縮して保存
+# 7 Grid/ACME/abcdef....npz、どのファイル名の配列かは、取り込み履歴(manifest_table)のハッシュで引く
+# 取り込みの子プロセスが、make_lightで作った配列をそのまま書くので、ファイルを読み直さず、変更のないファイルは書き直さない
+# 読み込みと標準化(read_raw、standardize_ies)を変えた場合は、これまで通りファイルから作り直す
+
+def grid_archive_path(manufacturer):
+    
+    return GRID_PATH + manufacturer + '/'                                       # メーカーごとのフォルダ
+
+def grid_entry_path(grid_path, file_hash):
+    
+    return grid_path + file_hash + '.npz'
+
+def write_grid(grid_path, file_hash, grid):                                     # 引数は、grid_archive_pathのフォルダ、中身のハッシュ、配列
+    
+    # 取り込むのは追加・変更されたファイルのみなので、あっても書き直す、壊れた.npzも直る
+    entry_path = grid_entry_path(grid_path, file_hash)
+    os.makedirs(grid_path, exist_ok=True)
+    
+    # 並列処理で同時に書き込んでも壊れないよう、一時ファイルに書いてから置き換える
+    temp_path = entry_path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez_compressed(f, grid=np.asarray(grid, dtype=np.float64))         # 圧縮しても、小数は丸めない
+    os.replace(temp_path, entry_path)
+
+def read_grid_entry(manufacturer, file_hash):
+    
+    with np.load(grid_entry_path(grid_archive_path(manufacturer), file_hash)) as npz:
+        return npz['grid']                                                      # 361行 x 181列
+
+def read_grid_archive(manufacturer):
+    
+    # 取り込み履歴で'ok'のファイルのうち、配列を保存したもの、ファイル名が重複すれば最初のもの
+    manifest  = get_manifest(manufacturer)
+    grid_path = grid_archive_path(manufacturer)
+    stored    = set(os.listdir(grid_path)) if os.path.isdir(grid_path) else set()
+    
+    entries = []
+    seen    = set()
+    for file_path in sorted(manifest):
+        file_name, size, mtime, file_hash, version, status = manifest[file_path]
+        if status == 'ok' and file_name not in seen and str(file_hash) + '.npz' in stored:
+            seen.add(file_name)
+            entries.append((file_name, file_hash))
+    
+    return entries                                                              # 返り値は、(ファイル名, ハッシュ)のリスト
+
+def read_grid(file_path, file_hash):
+    
+    # 取り込み後にファイルが変更されていれば、次の取り込みで保存するのでNone
+    data = read_photometric_bytes(file_path)
+    if hashlib.sha1(data).hexdigest() != file_hash:
+        return None
+    
+    # make_lightで作ったキャッシュがあれば、読み込みと標準化を省く
+    cached = load_cache(file_path, file_hash)
+    if cached is not None:
+        return cached[-1]
+    
+    return read_ies(file_path, cache=False, data=data, orient=False)[5]
+
+def update_grid_archive(manufacturer):
+    
+    # 追加・変更されたファイルの配列は、取り込みで保存済み
+    # 取り込み履歴で'ok'でなくなったファイル(削除、変更前、読めなくなった)の配列を削除
+    grid_path = grid_archive_path(manufacturer)
+    if not os.path.isdir(grid_path):
+        return
+    
+    manifest = get_manifest(manufacturer)
+    keep     = {str(file_hash) + '.npz' for file_name, size, mtime, file_hash, version, status in manifest.values()
+                if status == 'ok'}
+    for name in os.listdir(grid_path):
+        if name not in keep:                                                    # 途中で止まった一時ファイルも
+            os.remove(grid_path + name)
+    
+    if not os.listdir(grid_path):                                               # メーカーのファイルがなくなった
+        os.rmdir(grid_path)
+
+def make_grid_archives():
+    
+    # 取り込み済みの全メーカーの配列を作る、最初の一度だけ
+    # 以前の.npyと.jsonの配列は削除
+    for m in get_manufacturers_from_manifest():
+        print('grid archive: ' + m)
+        grid_path = grid_archive_path(m)
+        manifest  = get_manifest(m)
+        for file_path in sorted(manifest):
+            file_name, size, mtime, file_hash, version, status = manifest[file_path]
+            if status != 'ok' or os.path.exists(grid_entry_path(grid_path, str(file_hash))):
+                continue
+            try:
+                grid = read_grid(file_path, file_hash)
+                if grid is not None:
+                    write_grid(grid_path, file_hash, grid)
+            except:                                                             # 取り込み後に読めなくなったファイル、作り直しでは除く
+                print(traceback.format_exc())
+        update_grid_archive(m)
+        
+        for extension in ('.npy', '.json'):
+            if os.path.exists(GRID_PATH + m + extension):
+                os.remove(GRID_PATH + m + extension)
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 保存した配光データからの、光度とその差分、光束、最大光度の再計算
+
+# 次元の削減、差分、照射方向の計算を変えたら、PIPELINE_VERSIONを1つ上げてから実行
+# ファイルを読まずに、データベースの照明器具レコーズを更新する
+# 取り込み履歴のPIPELINE_VERSIONも更新するので、make_add_lightsで読み直さない
+
+def rederive_worker(item):                                                      # 子プロセスで実行、引数は(メーカー, (ファイル名, ハッシュ)のリスト)
+    
+    # エラーは子プロセスで文字列にし、親プロセスで表示する
+    # 読めなかった配列は除き、取り込み履歴のPIPELINE_VERSIONを古いままにして、make_add_lightsでファイルから読み直す
+    
+    manufacturer, entries = item
+    
+    rows   = []
+    errors = []
+    for file_name, file_hash in entries:
+        try:
+            grid = read_grid_entry(manufacturer, file_hash)
+            ies, ies_list, diff_list, lumen, cd_max = derive_features(grid)
+        except:                                                                 # 壊れた.npzなど
+            errors.append((file_name, traceback.format_exc()))
+            continue
+        rows.append(encode_photometry(ies_list, diff_list) + (lumen, cd_max, file_name, manufacturer))
+    
+    return manufacturer, rows, errors                                           # 返り値は、(メーカー, 更新する行, (ファイル名, エラー)のリスト)
+
+def iter_rederived(items, processes=None):                                      # processesは、1なら並列処理なし、Noneなら全コア
+    
+    if processes == 1:                                                          # 並列処理なし
+        for item in items:
+            yield rederive_worker(item)
+        return
+    
+    with multiprocessing.Pool(processes) as pool:                               # 途中で止めても、子プロセスを終了する
+        for result in pool.imap_unordered(rederive_worker, items):
+            yield result
+
+def rederive_lights(processes=None, chunk_size=256):                            # processesは、1なら並列処理なし、Noneなら全コア
+    
+    start_time = time.time()
+    
+    # メーカーごとに、chunk_size行ずつ子プロセスに渡す
+    items = []
+    for manufacturer in get_manufacturers_from_manifest():
+        entries = read_grid_archive(manufacturer)                               # 子プロセスではデータベースを使わないため、ここで引く
+        items  += [(manufacturer, entries[k : k+chunk_size]) for k in range(0, len(entries), chunk_size)]
+    
+    no_of_rows   = 0
+    no_of_errors = 0
+    for manufacturer, rows, errors in iter_rederived(items, processes):
+        cur.executemany( ' UPDATE light_table '
+                         ' SET    ies = ?, ies_diff = ?, luminous_flux = ?, max_luminous_intensity = ? '
+                         ' WHERE  file_name = ? AND manufacturer = ? '
+                         , rows
+                       )
+        cur.executemany( ' UPDATE manifest_table '
+                         ' SET    pipeline_version = ? '
+                         ' WHERE  manufacturer = ? AND file_name = ? '
+                         , [(PIPELINE_VERSION, manufacturer, row[-2]) for row in rows]
+                       )
+        con.commit()
+        no_of_rows += len(rows)
+        print('rederived: ', manufacturer, ' ', no_of_rows, ' rows')
+        
+        for file_name, error in errors:                                         # make_add_lightsでファイルから読み直す
+            print('--------------------'*4)
+            print('error: ' + manufacturer + ' ' + file_name)
+            print(error)
+        no_of_errors += len(errors)
+    
+    print('not rederived:   ', no_of_errors, ' rows')
+    end_time = time.time()
+    elapse_time = round((end_time - start_time), 5)
+    print('rederive light fixtures:   ', elapse_time, ' sec')
+    print('')
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 同じ配光データの照明器具の統合
+
+# 塗装色や色温度が異なるだけで、配光データが同じファイルが多い
+# 標準化した配光データ(7 Grid/の配列)のハッシュで、同じ配光データをphotometry_tableの1行にまとめ、
+# light_photometry_tableで、照明器具から配光データへ対応させる(多対一)
+# 完全一致のハッシュの他に、最大光度のPHOTOMETRY_TOLERANCE倍で丸めたハッシュ(fingerprint)も記録し、
+# 測定誤差程度の違いもまとめる場合に使う、丸めの境目をまたぐ違いはまとめられない
+# 類似度の計算(cal_similarities(dedup=True))は、同じ配光データの照明器具を一度だけ計算し、結果を写す
+
+PHOTOMETRY_TOLERANCE = 0.01                                                     # fingerprintの丸め幅、最大光度に対する比
+
+def make_photometry_table():
+    
+    # get_table_infoで行数を数えるため、どちらもfile_name列を持つ
+    
+    cur.execute(
+                'CREATE TABLE IF NOT EXISTS photometry_table' +
+                '''
+                (                                                               -- 各列の最後のカンマ忘れに注意、最後は要らない
+                photometry_hash         TEXT    PRIMARY KEY,                    -- 列0、 標準化した配光データのsha1
+                file_name               TEXT,                                   -- 列1、 代表の照明器具、ファイル名が最小のもの
+                fingerprint             TEXT,                                   -- 列2、 丸めた配光データのsha1
+                no_of_lights            INTEGER                                 -- 列3、 同じ配光データの照明器具数
+                )
+                '''
+               )
+    
+    cur.execute(
+                'CREATE TABLE IF NOT EXISTS light_photometry_table' +
+                '''
+                (                                                               -- 各列の最後のカンマ忘れに注意、最後は要らない
+                file_name               TEXT    PRIMARY KEY,                    -- 列0、 light_tableのfile_name
+                photometry_hash         TEXT,                                   -- 列1、 photometry_tableのphotometry_hash
+                manufacturer            TEXT                                    -- 列2、 メーカーフォルダ名
+                )
+                '''
+               )
+    
+    cur.execute(' CREATE INDEX IF NOT EXISTS photometry_hash_index ON light_photometry_table(photometry_hash) ')
+    
+    con.commit()
+
+def hash_grid(grid, tolerance=PHOTOMETRY_TOLERANCE):                            # 引数は、向きを調整する前の361行 x 181列の配列
+    
+    # 完全一致のハッシュは、配列の値のみ
+    grid = np.ascontiguousarray(grid, dtype=np.float64) + 0.0                   # -0.0を0.0に
+    photometry_hash = hashlib.sha1(grid.tobytes()).hexdigest()
+    
+    # 最大光度に対する比で丸め、最大光度自体も比で丸める
+    cd_max = grid.max()
+    if cd_max > 0:
+        quantized = np.round(grid / (cd_max * tolerance)).astype(np.int32)
+        scale     = int(np.round(np.log(cd_max) / np.log1p(tolerance)))
+    else:                                                                       # 全て0
+        quantized = np.zeros(grid.shape, dtype=np.int32)
+        scale     = 0
+    fingerprint = hashlib.sha1(quantized.tobytes() + str(scale).encode()).hexdigest()
+    
+    return photometry_hash, fingerprint
+
+def count_photometry():                                                         # コミットはしない
+    
+    # 照明器具のなくなった配光データを削除し、代表の照明器具と照明器具数を更新
+    cur.execute( ' DELETE FROM photometry_table '
+                 ' WHERE  photometry_hash NOT IN (SELECT photometry_hash FROM light_photometry_table) '
+               )
+    cur.execute( ' UPDATE photometry_table SET '
+                 ' file_name    = (SELECT MIN(file_name) FROM light_photometry_table l '
+                 '                 WHERE  l.photometry_hash = photometry_table.photometry_hash), '
+                 ' no_of_lights = (SELECT COUNT(*)       FROM light_photometry_table l '
+                 '                 WHERE  l.photometry_hash = photometry_table.photometry_hash) '
+               )
+
+def update_photometry(manufacturer, targets=None):                              # targetsは、追加・変更されたファイルパス、Noneなら全て計算し直す
+    
+    # 保存した配光データ(update_grid_archive)から、ハッシュを計算
+    make_photometry_table()
+    entries    = read_grid_archive(manufacturer)
+    file_names = [file_name for file_name, file_hash in entries]
+    
+    cur.execute(' SELECT file_name FROM light_photometry_table WHERE manufacturer = ? ', (manufacturer,))
+    known   = {r[0] for r in cur.fetchall()}
+    changed = set(file_names) if targets is None else {os.path.basename(p)[0:-4] for p in targets}
+    removed = known - set(file_names)
+    
+    rows         = []
+    photometries = []
+    for file_name, file_hash in entries:
+        if file_name in known and file_name not in changed:                     # 変更なし
+            continue
+        try:
+            grid = read_grid_entry(manufacturer, file_hash)
+        except:                                                                 # 壊れた.npz、対応を消し、取り込み直した時に計算
+            print(traceback.format_exc())
+            removed.add(file_name)
+            continue
+        photometry_hash, fingerprint = hash_grid(grid)
+        rows.append((file_name, photometry_hash, manufacturer))
+        photometries.append((photometry_hash, file_name, fingerprint))
+    
+    cur.executemany( ' DELETE FROM light_photometry_table '
+                     ' WHERE  file_name = ? AND manufacturer = ? '
+                     , [(n, manufacturer) for n in removed]
+                   )
+    cur.executemany(' INSERT OR REPLACE INTO light_photometry_table VALUES (?,?,?) ', rows)
+    cur.executemany( ' INSERT OR IGNORE INTO photometry_table (photometry_hash, file_name, fingerprint) '
+                     ' VALUES (?,?,?) '
+                     , photometries
+                   )
+    count_photometry()
+    
+    con.commit()
+
+def make_photometry():
+    
+    # 取り込み済みの全メーカーで計算する、最初の一度だけ
+    # PHOTOMETRY_TOLERANCEやhash_gridを変えた場合も、ハッシュを計算し直すため実行
+    make_photometry_table()
+    cur.execute(' DELETE FROM light_photometry_table ')
+    cur.execute(' DELETE FROM photometry_table ')
+    for m in get_manufacturers_from_manifest():
+        update_photometry(m)
+    
+    show_photometry_info()
+
+def show_photometry_info():
+    
+    no_of_lights       = count_rows('light_photometry_table')
+    no_of_photometries = count_rows('photometry_table')
+    cur.execute(' SELECT COUNT(DISTINCT fingerprint) FROM photometry_table ')
+    no_of_fingerprints = cur.fetchone()[0]
+    
+    print('--------------------'*4)
+    print('light fixtures:      ', no_of_lights)
+    print('unique photometries: ', no_of_photometries)
+    print('unique fingerprints: ', no_of_fingerprints)
+    print('')
+
+def get_photometry_keys(file_names, tolerant=False):                            # tolerantは、fingerprintでまとめる
+    
+    key  = 'p.fingerprint' if tolerant else 'p.photometry_hash'
+    keys = {}
+    for k in range(0, len(file_names), 900):                                    # SQLiteの変数の上限は999
+        chunk = file_names[k : k+900]
+        try:
+            cur.execute( ' SELECT l.file_name, ' + key +
+                         ' FROM   light_photometry_table l '
+                         ' JOIN   photometry_table p ON l.photometry_hash = p.photometry_hash '
+                         ' WHERE  l.file_name IN (' + ','.join('?' * len(chunk)) + ') '
+                         , chunk
+                       )
+        except sqlite3.OperationalError:                                        # テーブルがまだない
+            return {}
+        keys.update(cur.fetchall())
+    
+    return keys                                                                 # 返り値は、ファイル名から配光データのハッシュの辞書
+
+def dedup_lights(lights, tolerant=False):                                       # 引数は、照明器具レコーズ
+    
+    # 同じ配光データの照明器具は、最初のものだけ残す
+    # 登録されていない照明器具は、それぞれ別の配光データとする
+    file_names = light_column(lights, FILE_NAME).tolist()
+    keys = get_photometry_keys(file_names, tolerant)
+    
+    first   = []                                                                # 残す照明器具の位置
+    inverse = []
+    index   = {}
+    for i, file_name in enumerate(file_names):
+        key = keys.get(file_name, ('file_name', file_name))
+        if key not in index:
+            index[key] = len(first)
+            first.append(i)
+        inverse.append(index[key])
+    
+    if isinstance(lights, LightBatch):                                          # 列形式なら、行の選択
+        unique = lights[np.array(first, dtype=np.intp)]
+    else:
+        unique = [lights[i] for i in first]
+    
+    return unique, np.array(inverse, dtype=np.intp)                             # 返り値は、重複のない照明器具レコーズと、元の各照明器具の位置
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
-# 照明器具レコーズの作成
+# メーカーフォルダの監視、追加・変更されたファイルを自動で取り込む
+
+# 1 Manufacturer/<メーカー>/ にファイルが置かれたら、そのメーカーだけ差分更新し、
+# 追加した照明器具を、最も類似するクラスターに割り当てる
+# inotify_simpleがあれば、Linuxのinotifyでイベントを受け取り、なければinterval秒ごとにフォルダを確認する
+# ダウンロードやコピーの途中で読まないよう、最後の変更からdebounce秒待つ
+
+def snapshot_manufacturer(folder_path):
+    
+    # 配光データとアーカイブのサイズと更新時刻、定期的な確認で使う
+    snapshot = {}
+    for root, dirs, files in os.walk(folder_path):
+        for f in files:
+            if not f.lower().endswith(PHOTOMETRIC_EXTENSIONS + ARCHIVE_EXTENSIONS):
+                continue
+            path = os.path.join(root, f)
+            try:
+                stat = os.stat(path)
+            except OSError:                                                     # 確認中に削除された
+                continue
+            snapshot[path] = (stat.st_size, stat.st_mtime)
+    
+    return snapshot
+
+def poll_manufacturers(interval=1):
+    
+    # interval秒ごとに、変更のあったメーカー名の集合を返す
+    snapshots = {m: snapshot_manufacturer(MANUFACTURER_PATH + m) for m in get_manufacturers_from_folder()}
+    
+    while True:
+        time.sleep(interval)
+        changed = set()
+        manufacturers = set(get_manufacturers_from_folder()) | set(snapshots)   # 削除されたメーカーも含める
+        for m in manufacturers:
+            snapshot = snapshot_manufacturer(MANUFACTURER_PATH + m)
+            if snapshot != snapshots.get(m):
+                changed.add(m)
+            snapshots[m] = snapshot
+        yield changed
+
+def inotify_manufacturers(interval=1):
+    
+    # inotifyのイベントから、変更のあったメーカー名の集合を返す
+    # 新しく作られたフォルダにも監視を追加する
+    flags = inotify_simple.flags
+    mask  = (flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO |
+             flags.MOVED_FROM | flags.DELETE | flags.DELETE_SELF)
+    inotify = inotify_simple.INotify()
+    watches = {}                                                                # 監視番号からフォルダパス
+    
+    def add_watches(folder_path):
+        for root, dirs, files in os.walk(folder_path):
+            try:
+                watches[inotify.add_watch(root, mask)] = root
+            except OSError:                                                     # 監視の追加前に削除された
+                pass
+    
+    add_watches(MANUFACTURER_PATH)
+    
+    while True:
+        changed = set()
+        for event in inotify.read(timeout=int(interval*1000)):                  # ミリ秒
+            folder_path = watches.get(event.wd)
+            if folder_path is None:
+                continue
+            path = os.path.join(folder_path, event.name)
+            if event.mask & flags.ISDIR and event.mask & (flags.CREATE | flags.MOVED_TO):
+                add_watches(path)                                               # 新しいフォルダも監視
+            if event.mask & flags.IGNORED:                                      # フォルダが削除された
+                del watches[event.wd]
+            
+            # MANUFACTURER_PATHの直下のフォルダ名がメーカー名
+            relative_path = os.path.relpath(path, MANUFACTURER_PATH)
+            manufacturer  = relative_path.split(os.sep)[0]
+            if manufacturer not in ('.', '..', ''):
+                changed.add(manufacturer)
+        yield changed
+
+def assign_clusters(file_names, clusters):
+    
+    # 追加した照明器具を、最も類似するクラスターに割り当てる
+    # クラスター平均は更新しない、clustering4などで後からまとめて更新
+    search_condition  = ["'" + f.replace("'", "''") + "'" for f in file_names]  # 文字列内の'は''にする
+    search_condition  = ' file_name IN (' + ','.join(search_condition) + ')'
+    lights = get_lights(search_condition)
+    if lights:
+        update_cluster_no(lights, clusters)
 
-def make_lights_basic(folder_path):                                             # 引数は、クラスタリング、クエリのフォルダ
+def watch_manufacturers(clusters=None, debounce=2, interval=1, processes=1, batch_size=64, retry=60): # retryは、失敗したメーカーを読み直すまでの秒数
     
-    start_time = time.time()
+    # Ctrl+Cで終了
+    # batch_sizeごとに書き込み、コミットするので、途中の照明器具からも検索できる
+    # 1つのメーカーで失敗しても監視は止めず、トレースバックを表示し、retry秒後に読み直す
     
-    file_paths  = glob.glob(folder_path+'/**/*.ies', recursive=True)            # フォルダ内のiesファイルを取得、/**/で直下以外も
-    no_of_files = len(file_paths)
+    if clusters is None:
+        clusters = get_clusters()
+    make_manifest_table()
     
-    lights   = []
-    unreadable_files = []
-    for i in range(0, no_of_files):                                             # フォルダ内の全ファイルで繰り返す
-        
-        # n番目が中断した場合、i=n-1が中断
-        # 0をn-1として、再開 
-        
-        # メーカーにより数千個の照明器具データがある
-        # 繰り返しの途中でエラーが発生することも想定
-        
-        try:
-            print(i+1, '/', no_of_files, ' ', file_paths[i])
-            
-            file_path = file_paths[i]
-            file_name = os.path.basename(file_path)
-            
-            # データベースの作成
-            light = make_light(file_path)                                       # 照明器具レコードの作成
-            lights.append(light)
-            
-        except:                                                                 # iesの読み込みに失敗する可能性も
-            print('--------------------'*4)
-            print('error: ')
-            print(traceback.format_exc())
-            unreadable_files.append(file_name)
+    if inotify_simple is not None:
+        events = inotify_manufacturers(interval)
+        print('watch: ' + MANUFACTURER_PATH + ' (inotify)')
+    else:
+        events = poll_manufacturers(interval)
+        print('watch: ' + MANUFACTURER_PATH + ' (polling)')
+    
+    # 監視していない間の変更も取り込むため、最初に全メーカーを確認
+    pending = {m: 0 for m in get_manufacturers_from_folder()}                   # メーカー名から最後の変更時刻
+    
+    try:
+        while True:
+            now = time.time()
+            ready = [m for m, t in pending.items() if now - t >= debounce]      # 最後の変更からdebounce秒経ったメーカー
+            for m in ready:
+                del pending[m]
+                print('--------------------'*4)
+                print('start: ' + m)
+                try:
+                    made_names = update_manufacturer_lights(m, processes, batch_size)
+                    if made_names:
+                        assign_clusters(made_names, clusters)
+                except Exception:                                               # 例: ディスクの空き不足、リンクのcsvの書き込み途中、Ctrl+Cは止める
+                    print('error: ' + m)
+                    print(traceback.format_exc())
+                    con.rollback()                                              # コミットしていない削除などは戻す
+                    pending[m] = time.time() + retry - debounce                 # retry秒後に読み直す
             
-            continue
-    
-    end_time = time.time()
-    elapse_time = round((end_time - start_time), 5)
-    print('make light fixtures:   ', elapse_time, ' sec')
-    print('')
+            for m in next(events):                                              # interval秒までイベントを待つ
+                pending[m] = time.time()
     
-    return lights                                                               # 返り値はリストのリスト
+    except KeyboardInterrupt:
+        print('stop watching')
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
-# 照明器具レコーズの作成
+# リンクの読み込み
 
-def make_lights(folder_path):                                                   # 引数は、メーカー
-    
-    start_time = time.time()
+link_indices = {}                                                               # リンクのcsvのパスから、(更新時刻, 索引)
+
+def read_links_df(folder_path):
     
     folder_name = os.path.basename(folder_path)                                 # フォルダ名は、メーカー名
-    file_paths  = glob.glob(folder_path+'/**/*.ies', recursive=True)            # フォルダ内のiesファイルを取得、/**/で再起的に取得
-    no_of_files = len(file_paths)
+    file_path   = folder_path +'/'+ folder_name + '.csv'                        # リンクのcsvファイル
+    links_df    = pd.read_csv(file_path, header=0, index_col=0)
     
-    links_df = read_links_df(folder_path)                                       # フォルダ内のcsvファイルの読み込み
+    # フォルダ内のファイルの拡張子を小文字化しているため
+    # リスト内のファイル名の拡張子も小文字化する必要あり
+    # SQlite登録時、ファイルのダウンロードリンクが見つからず、エラーになる
+    # 拡張子の変更により、完全一致検索に影響があるか要確認
     
-    lights           = []
-    unreadable_files = []
-    for i in range(0, no_of_files):                                             # フォルダ内の全ファイルで繰り返す
-        
-        # n番目が中断した場合、i=n-1が中断
-        # 0をn-1として、再開 
-        
-        # メーカーにより数千個の照明器具データがある
-        # 繰り返しの途中でエラーが発生することも想定
-        
-        try:
-            print(i+1, '/', no_of_files, ' ', file_paths[i])
-            
-            file_path = file_paths[i]
-            file_name = os.path.basename(file_path)
-            link_df = links_df[links_df['IES File Name']==file_name]            # 読み込むファイルに該当するデータ
-            parent_page_url = link_df['Parent Page'][0]                         # iesファイルのダウンロードリンク
-            
-            # データベースの作成
-            light = make_light(file_path)                                       # 照明器具レコードの作成
-            light[MANUFACTURER] = folder_name                                   # メーカー名に、フォルダ名を代入
-            light[DOWNLOAD_URL] = parent_page_url
-            lights.append(light)
-            
-        except:                                                                 # iesの読み込みに失敗する可能性も
-            print('--------------------'*4)
-            print('error: ')
-            print(traceback.format_exc())
-            unreadable_files.append(file_name)
-            
-            continue
+    links_df = links_df.replace('\.IES$', {'IES File Name': '.ies'},regex=True) # IESファイルの拡張子、.IESを.iesに変換
     
-    # エラーファイルを書き出す
-    error_file_path  = ERROR_PATH + 'Error - make_lights.txt'                   # エラーファイルを書き出すファイルパス
-    no_of_unreadable_files = len(unreadable_files)
-    unreadable_files = '\n'.join(unreadable_files)                              # ['a.ies', 'b.ies']を改行表示のため、'a.ies\nb.ies'に変換
-    with open(error_file_path, 'a') as f:
-        f.write('--------------------'*2)
-        f.write('\n')
-        f.write(folder_path)
-        f.write('\n')
-        f.write('number of unreadable files: ' + str(no_of_unreadable_files))
-        f.write('\n')
-        f.write(unreadable_files)
-        f.write('\n')
+    return links_df
+
+def read_links(folder_path):
+    
+    # ファイル名から、リンクのcsvの行(辞書)を引く索引
+    # ファイルごとにデータフレームを絞り込むと、ファイル数の2乗の時間がかかる
+    # csvの更新時刻が変わらなければ、作った索引を使い回す
+    
+    folder_name = os.path.basename(folder_path)
+    file_path   = folder_path +'/'+ folder_name + '.csv'
+    mtime       = os.path.getmtime(file_path)
+    
+    if file_path in link_indices and link_indices[file_path][0] == mtime:
+        return link_indices[file_path][1]
+    
+    links_df = read_links_df(folder_path)
+    links_df = links_df[~links_df['IES File Name'].duplicated()]                # 同じファイル名が複数あれば、最初の行
+    links    = dict(zip(links_df['IES File Name'], links_df.to_dict('records')))
+    
+    link_indices[file_path] = (mtime, links)
+    
+    return links                                                                # 返り値は、ファイル名をキー、列名と値の辞書を値とする辞書
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 配光データのダウンロード
+
+# リンクのcsvの'Parent Page'(データベースのdownload_url)のページから、配光データのリンクを探し、
+# 1 Manufacturer/<メーカー>/IES/ にダウンロードする
+# csvに'IES URL'の列があれば、ページを探さずに、そのURLを使う
+# 前回のETagとLast-Modifiedを<メーカー>.download.jsonに記録し、条件付きGETで変更のないファイルは読み込まない
+# 途中で止めても、次回は記録と.partファイルの続きから再開する
+# 接続はセッションで使い回し、同時接続数とホストごとの1秒あたりのリクエスト数を制限する
+
+DOWNLOAD_CONCURRENCY = 8                                                        # 同時接続数
+DOWNLOAD_RATE_LIMIT  = 2                                                        # ホストごとの1秒あたりのリクエスト数
+DOWNLOAD_TIMEOUT     = 30                                                       # 秒
+
+host_schedule = {}                                                              # ホスト名から、次にリクエストしてよい時刻
+host_lock     = threading.Lock()
+
+def make_session(concurrency=DOWNLOAD_CONCURRENCY):
+    
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency,
+                                            pool_maxsize=concurrency,           # スレッド数分の接続を使い回す
+                                            max_retries=2)
+    session.mount('http://',  adapter)
+    session.mount('https://', adapter)
+    
+    return session
+
+def wait_for_host(url, rate_limit=DOWNLOAD_RATE_LIMIT):
+    
+    # 同じホストへのリクエストを、1/rate_limit秒以上あける
+    host = requests.compat.urlparse(url).netloc
+    with host_lock:
+        now  = time.time()
+        slot = max(now, host_schedule.get(host, 0))                             # 予約できる最も早い時刻
+        host_schedule[host] = slot + 1 / rate_limit
+    time.sleep(max(0, slot - now))
+
+def download_state_path(folder_path):
+    
+    folder_name = os.path.basename(folder_path)
+    
+    return folder_path + '/' + folder_name + '.download.json'                   # リンクのcsvの隣
+
+def read_download_state(folder_path):
+    
+    try:
+        with open(download_state_path(folder_path)) as f:
+            return json.load(f)                                                 # ファイル名から、{url, etag, last_modified, size}
+    except FileNotFoundError:
+        return {}
+
+def write_download_state(folder_path, state):
+    
+    state_path = download_state_path(folder_path)
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(state_path + '.tmp', state_path)                                 # 書き込み途中で止めても壊れない
+
+def find_file_url(session, parent_page_url, file_name, pages, pages_lock,
+                  rate_limit=DOWNLOAD_RATE_LIMIT):
+    
+    # 親のページのhrefから、ファイル名が一致するリンクを探す
+    # 同じページに多くのファイルのリンクがあるので、ページは一度だけ読む
+    with pages_lock:
+        page_lock = pages.setdefault(parent_page_url, [threading.Lock(), None])
+    with page_lock[0]:
+        if page_lock[1] is None:
+            wait_for_host(parent_page_url, rate_limit)
+            response = session.get(parent_page_url, timeout=DOWNLOAD_TIMEOUT)
+            response.raise_for_status()
+            hrefs = re.findall(r'''href\s*=\s*["']([^"']+)["']''', response.text, re.I)
+            page_lock[1] = {os.path.basename(requests.compat.urlparse(h).path).lower(): requests.compat.urljoin(parent_page_url, h)
+                            for h in hrefs}                                     # ファイル名(小文字)から、絶対URL
+    
+    return page_lock[1][file_name.lower()]                                      # なければKeyError
+
+def download_file(session, url, file_path, entry, rate_limit=DOWNLOAD_RATE_LIMIT):
+    
+    # 返り値は、('downloaded'か'not modified', 記録)
+    # 続きから読む場合は、途中まで読んだ時のETagをIf-Rangeで送り、
+    # サーバー側のファイルが変わっていれば、200で全体を受け取り、最初から書き直す
+    
+    headers    = {}
+    part_path  = file_path + '.part'
+    etag_path  = part_path + '.etag'                                            # 途中まで読んだファイルのETagかLast-Modified
+    start      = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    validator  = None
+    if start and os.path.exists(etag_path):
+        with open(etag_path) as f:
+            validator = f.read().strip()
+    
+    if start and validator:                                                     # 途中まで読んだファイルの続き
+        headers['Range']    = 'bytes=' + str(start) + '-'
+        headers['If-Range'] = validator                                         # 変わっていれば、サーバーは200で全体を返す
+    elif entry and entry.get('url') == url and os.path.exists(file_path):       # 前回のファイルがあれば、条件付きGET
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    
+    wait_for_host(url, rate_limit)
+    with session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 304:                                         # 変更なし
+            return 'not modified', entry
+        if response.status_code == 416:                                         # 途中まで読んだファイルが、サーバーのファイルより大きい
+            os.remove(part_path)
+            return download_file(session, url, file_path, entry, rate_limit)    # 最初から、Rangeなし
+        response.raise_for_status()
+        
+        # 206で、要求した位置からの続きなら追記、それ以外(Rangeに200を返した場合も)は最初から
+        content_range = response.headers.get('Content-Range', '')
+        if response.status_code == 206 and content_range.startswith('bytes ' + str(start) + '-'):
+            mode = 'ab'
+        else:
+            mode = 'wb'
+            validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+            if validator:                                                       # 途中で止まった場合に、If-Rangeで送る
+                with open(etag_path, 'w') as f:
+                    f.write(validator)
+            elif os.path.exists(etag_path):
+                os.remove(etag_path)
+        
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=65536):
+                f.write(chunk)
+        
+        entry = {
+                 'url'           : url,
+                 'etag'          : response.headers.get('ETag'),
+                 'last_modified' : response.headers.get('Last-Modified'),
+                }
+    
+    os.replace(part_path, file_path)                                            # 読み終えてから置き換える
+    if os.path.exists(etag_path):
+        os.remove(etag_path)
+    entry['size'] = os.path.getsize(file_path)
+    
+    return 'downloaded', entry
+
+def download_catalog(manufacturer, concurrency=DOWNLOAD_CONCURRENCY, rate_limit=DOWNLOAD_RATE_LIMIT,
+                     base_url=None):                                            # base_urlは、ローカルサーバーで確認する場合の置き換え先
+    
+    start_time = time.time()
+    
+    folder_path = MANUFACTURER_PATH + manufacturer                              # メーカーフォルダへのパスを作成
+    ies_path    = folder_path + '/IES/'
+    os.makedirs(ies_path, exist_ok=True)
+    
+    links   = read_links(folder_path)
+    state   = read_download_state(folder_path)
+    session = make_session(concurrency)
+    
+    jobs = queue.Queue()
+    for file_name, link in links.items():
+        jobs.put((file_name, link))
+    
+    pages      = {}                                                             # 親のページごとのリンク
+    pages_lock = threading.Lock()
+    state_lock = threading.Lock()
+    results    = {'downloaded': [], 'not modified': [], 'error': []}
+    
+    def worker():
+        while True:
+            try:
+                file_name, link = jobs.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                url = link.get('IES URL')
+                if not isinstance(url, str):                                    # csvにURLがなければ、親のページから探す
+                    parent_page_url = link['Parent Page']
+                    if base_url is not None:
+                        parent_page_url = requests.compat.urljoin(base_url, requests.compat.urlparse(parent_page_url).path)
+                    url = find_file_url(session, parent_page_url, file_name, pages, pages_lock, rate_limit)
+                
+                status, entry = download_file(session, url, ies_path + file_name, state.get(file_name), rate_limit)
+            except:
+                print('download error: ' + file_name)
+                print(traceback.format_exc())
+                status, entry = 'error', state.get(file_name)
+            
+            with state_lock:
+                results[status].append(file_name)
+                if entry is not None:
+                    state[file_name] = entry
+                if status == 'downloaded' and len(results['downloaded']) % 100 == 0:
+                    write_download_state(folder_path, state)                    # 途中で止めても、ここから再開
+    
+    threads = [threading.Thread(target=worker, daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    
+    write_download_state(folder_path, state)
+    session.close()
     
     end_time = time.time()
     elapse_time = round((end_time - start_time), 5)
-    print('make light fixtures:   ', elapse_time, ' sec')
+    print('--------------------'*4)
+    print('download: ' + manufacturer)
+    print('downloaded:   ', len(results['downloaded']),   ' files')
+    print('not modified: ', len(results['not modified']), ' files')
+    print('error:        ', len(results['error']),        ' files')
+    print('download catalog:   ', elapse_time, ' sec')
     print('')
     
-    return lights                                                               # 返り値はリストのリスト
+    return results                                                              # 返り値は、状態ごとのファイル名のリストの辞書
+
+def download_catalogs(concurrency=DOWNLOAD_CONCURRENCY, rate_limit=DOWNLOAD_RATE_LIMIT):
+    
+    # 全メーカーの配光データを更新、その後make_add_lightsで取り込む
+    for m in get_manufacturers_from_folder():
+        try:
+            download_catalog(m, concurrency, rate_limit)
+        except FileNotFoundError:                                               # リンクのcsvがないメーカー
+            print('no links: ' + m)
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
-# 照明器具レコーズの追加
+# ダウンロードの確認用のローカルサーバー
+
+# ネットワークに接続せずに、download_catalogを確認する
+# folder_pathの中のファイルを、ETag、Last-Modified、Range、If-Rangeに対応して返す
+# 例: server, base_url = serve_catalog('/tmp/catalog')
+#     download_catalog('ACME', base_url=base_url)
+#     server.shutdown()
+
+class CatalogHandler(http.server.SimpleHTTPRequestHandler):
+    
+    def send_head(self):
+        
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):                                            # フォルダやないファイルは、元の処理
+            return super().send_head()
+        
+        stat          = os.stat(path)
+        etag          = '"' + format(stat.st_mtime_ns, 'x') + '-' + format(stat.st_size, 'x') + '"'
+        last_modified = self.date_time_string(int(stat.st_mtime))
+        
+        if (self.headers.get('If-None-Match') == etag or
+            self.headers.get('If-Modified-Since') == last_modified):            # 変更なし
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return None
+        
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        start = int(match.group(1)) if match else 0                             # 続きから
+        
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range not in (etag, last_modified):      # 変わっていれば、Rangeを無視して全体を返す
+            start = 0
+        
+        if start and start >= stat.st_size:                                     # ファイルより後ろからは返せない
+            self.send_response(416)
+            self.send_header('Content-Range',  'bytes */' + str(stat.st_size))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Type',   self.guess_type(path))
+        self.send_header('Content-Length', str(stat.st_size - start))
+        if start:
+            self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(stat.st_size - 1) + '/' + str(stat.st_size))
+        self.send_header('ETag',          etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        
+        return f
+    
+    def log_message(self, *args):                                               # アクセスの表示を省く
+        pass
 
-def add_lights(lights):
+def serve_catalog(folder_path, port=0):                                         # port=0は、空いているポート
     
-    start_time = time.time()
-    
-    lights = to_json(lights)
+    handler = lambda *args, **kwargs: CatalogHandler(*args, directory=folder_path, **kwargs)
+    server  = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
     
-    tables, nos_of_columns, nos_of_rows_before = get_table_info()               # レコーズ追加前にテーブル情報を取得
+    return server, 'http://127.0.0.1:' + str(server.server_address[1]) + '/'    # 返り値は、サーバーとURL
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 配光データの対称性による圧縮（light_tableとcluster_tableの光度と差分の列）
+
+# 多くのダウンライトは点対称で、全てのφが同じ光度なのに、光度1369要素と差分2663要素を保存していた
+# 対称な配光データは、基本領域の光度と対称性の記号だけを保存する
+#   'P':  点対称、φ=0度の断面のみ、         1行 x 37列 =  37要素
+#   'XY': 2軸対称、φ=0 ～ 90度の四半分のみ、10行 x 37列 = 370要素
+#   'X':  1軸対称、φ=0 ～ 180度の半分のみ、 19行 x 37列 = 703要素
+# 4軸対称は、φ=45度が5度刻みの格子にないため、2軸対称として保存する
+# 差分は光度から配列の引き算で計算できるので、圧縮した場合は保存しない
+# 光度と差分が、基本領域から完全に復元できる場合のみ圧縮する、cal_symmetryの分類は誤差を許すため使わない
+# 対称でない配光データとクラスター平均は、これまでと同じリストのjson文字列
+
+SYMMETRY_ROWS = {'P': 1, 'XY': 10, 'X': 19}                                     # 基本領域の行数、φ=0度から、圧縮率の高い順
+
+@functools.lru_cache(maxsize=None)
+def symmetry_index(symmetry):                                                   # 返り値は、光度1369要素の、基本領域での位置
+    
+    r = np.arange(IES_GRID.shape[0])                                            # φ=0, 10, ... 360度の行番号
+    if   symmetry == 'P':
+        r = np.zeros_like(r)
+    elif symmetry == 'X':
+        r = np.minimum(r, 36 - r)                                               # φ=0 ～ 180度に折り返す
+    elif symmetry == 'XY':
+        r = np.minimum(r, 36 - r)
+        r = np.minimum(r, 18 - r)                                               # さらに、φ=0 ～ 90度に折り返す
+    else:
+        raise ValueError('unknown symmetry: ' + str(symmetry))
     
-    # 繰り返し処理
-    # no_of_data = len(lights)
-    # for i in range(no_of_data):
-    # 
-    #     print(str(i+1) +'/'+ str(no_of_data) +' '+ lights[i][0])              # 何番目/全体 ファイル名を表示
-    # 
-    #     cur.execute(  ' INSERT INTO light_table '                             # 予約語の前後の空白が大事
-    #                   ' VALUES ' + str(tuple(lights[i]))
-    #                   )
+    index = (r[:, None] * IES_GRID.shape[1] + np.arange(IES_GRID.shape[1])).ravel()
+    index.setflags(write=False)                                                 # 使い回すので、変更不可に
     
-    # バッチ処理、
-    # 繰り返し処理より約５倍速いが、メモリ不足の可能性
-    cur.executemany( ' INSERT INTO light_table '
-                     ' VALUES      (' + ('?,'*32)[:-1] + ')'                    # ?はプレースホルダー、最後はカンマを削除
-                   # '(?,?,...32個...?)'の文字列
-                     , lights
-                   )
+    return index
+
+@functools.lru_cache(maxsize=None)
+def diff_index():
     
-    tables, nos_of_columns, nos_of_rows_after = get_table_info()                # レコーズ追加後にテーブル情報を取得
+    # 差分 = 光度[前] - 光度[後]、for_diffとdiff_theta、diff_phiと同じ並び
+    # 光度の位置の配列にfor_diffを使い、位置の組を作る
+    position = Photometry(np.arange(IES_GRID.size, dtype=np.float64).reshape(IES_GRID.shape), IES_GRID)
+    position = for_diff(position).values.astype(np.intp)                        # 38行 x 39列
     
-    id = tables.index('light_table')                                            # テーブル情報の返り値がリストのため要インデックス
+    # θ方向の差分1368要素、φ方向の差分1295要素の順
+    index1 = np.concatenate([position[1:-1, 1:].ravel(), position[1:, 2:-2].ravel()])
+    index2 = np.concatenate([position[1:-1, :-1].ravel(), position[:-1, 2:-2].ravel()])
+    index1.setflags(write=False)
+    index2.setflags(write=False)
     
-    # データ追加前後の行数を表示
-    print('--------------------'*4)
-    print('add light fixtures')
-    print('before:     ', nos_of_rows_before[id], ' rows')
-    print('after:      ', nos_of_rows_after[id],  ' rows')
-    print('added:      ', nos_of_rows_after[id]
-                        - nos_of_rows_before[id], ' rows')
+    return index1, index2
+
+def ies_to_diff(lights_ies):                                                    # 引数は、光度の1369要素か、n行 x 1369列の配列
     
-    con.commit()
+    index1, index2 = diff_index()
+    lights_ies = np.asarray(lights_ies, dtype=np.float64)
     
-    end_time = time.time()
-    elapsed_time = round((end_time - start_time), 5)
-    print('')
-    print(elapsed_time, ' sec')
+    # 返り値は、差分の2663要素か、n行 x 2663列の配列
+    return np.take(lights_ies, index1, axis=-1) - np.take(lights_ies, index2, axis=-1)
 
-# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
-# 全メーカーで照明器具レコーズの作成・追加
+def expand_ies(symmetry, ies_compressed):                                       # 引数は、対称性の記号と、基本領域の光度か、同じ対称性のn行の配列
+    
+    ies_compressed = np.asarray(ies_compressed, dtype=np.float64)
+    
+    return np.take(ies_compressed, symmetry_index(symmetry), axis=-1)           # 返り値は、光度の1369要素か、n行 x 1369列の配列
 
-def make_add_lights():
+def compress_ies(ies_list, diff_list):                                          # 引数は、光度と差分のリスト
     
-    manufacturers_in_folder = get_manufacturers_from_folder()
-    manufacturers_in_sql    = get_manufacturers_from_sql()
+    ies  = np.asarray(ies_list,  dtype=np.float64)
+    diff = np.asarray(diff_list, dtype=np.float64)
+    if ies.shape != (IES_GRID.size,) or not np.array_equal(ies_to_diff(ies), diff):
+        return None, ies_list                                                   # 差分を光度から復元できない
     
-    manufacturers = set(manufacturers_in_folder) - set(manufacturers_in_sql)    # フォルダにあるが、データベースにないものを選ぶ
+    for symmetry, no_of_rows in SYMMETRY_ROWS.items():
+        ies_compressed = ies[:no_of_rows * IES_GRID.shape[1]]                   # φ=0度からの行
+        if np.array_equal(expand_ies(symmetry, ies_compressed), ies):
+            return symmetry, ies_compressed.tolist()
     
-    for m in manufacturers:                                                     # 各メーカーのフォルダで繰り返す
-        print('--------------------'*4)
-        print('start: ' + m)
-        
-        cur.execute( ' SELECT manufacturer'
-                     ' FROM   light_table ')
-        
-        folder_path = MANUFACTURER_PATH + m                                     # メーカーフォルダへのパスを作成
-        
-        lights = make_lights(folder_path)                                       # 照明器具レコーズの作成
-        add_lights(lights)                                                      # 照明器具レコーズの追加
+    return None, ies_list                                                       # 返り値は、対称性の記号と基本領域の光度、対称でなければNoneと元の光度
 
-# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
-# リンクの読み込み
+def encode_photometry(ies_list, diff_list):                                     # 返り値は、light_tableのiesとies_diffの列のjson文字列
+    
+    symmetry, ies_compressed = compress_ies(ies_list, diff_list)
+    if symmetry is None:
+        return json.dumps(ies_list), json.dumps(diff_list)
+    
+    return json.dumps({'symmetry': symmetry, 'ies': ies_compressed}), json.dumps(None)
 
-def read_links_df(folder_path):
+def decode_photometry(ies_json, diff_json):                                     # 引数は、iesとies_diffの列のjson文字列
     
-    folder_name = os.path.basename(folder_path)                                 # フォルダ名は、メーカー名
-    file_path   = folder_path +'/'+ folder_name + '.csv'                        # リンクのcsvファイル
-    links_df    = pd.read_csv(file_path, header=0, index_col=0)
+    ies = json.loads(ies_json)
+    if not isinstance(ies, dict):                                               # 圧縮していない
+        return ies, json.loads(diff_json)
     
-    # フォルダ内のファイルの拡張子を小文字化しているため
-    # リスト内のファイル名の拡張子も小文字化する必要あり
-    # SQlite登録時、ファイルのダウンロードリンクが見つからず、エラーになる
-    # 拡張子の変更により、完全一致検索に影響があるか要確認
+    ies = expand_ies(ies['symmetry'], ies['ies'])
     
-    links_df = links_df.replace('\.IES$', {'IES File Name': '.ies'},regex=True) # IESファイルの拡張子、.IESを.iesに変換
+    return ies.tolist(), ies_to_diff(ies).tolist()                              # 返り値は、光度と差分のリスト
+
+def decode_photometries(ies_jsons, diff_jsons, ies, diff):                      # ies、diffは、書き込み先のn行の配列
     
-    return links_df
+    # 圧縮した行は、対称性ごとにまとめて、配列の添字で展開し、差分も一度に計算
+    compressed = {}
+    for i, (ies_json, diff_json) in enumerate(zip(ies_jsons, diff_jsons)):
+        if not isinstance(ies_json, str):                                       # json文字列化する前の照明器具レコード
+            ies[i]  = ies_json
+            diff[i] = diff_json
+            continue
+        value = json.loads(ies_json)
+        if isinstance(value, dict):
+            compressed.setdefault(value['symmetry'], ([], []))
+            compressed[value['symmetry']][0].append(i)
+            compressed[value['symmetry']][1].append(value['ies'])
+        else:
+            ies[i]  = value
+            diff[i] = json.loads(diff_json)
+    
+    for symmetry, (rows, ies_compressed) in compressed.items():
+        rows       = np.array(rows, dtype=np.intp)
+        ies[rows]  = expand_ies(symmetry, ies_compressed)
+        diff[rows] = ies_to_diff(ies[rows])
+    
+    return ies, diff
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 照明器具レコーズの光度とその差分のjson文字列化
 
 def to_json(lights):
     
-    for l in lights:
-        l[IES]  = json.dumps(l[IES])
-        l[DIFF] = json.dumps(l[DIFF])
+    # 元のlightsは書き換えず、新しい行を返す
     
-    return lights
+    return [list(l[:IES]) + list(encode_photometry(l[IES], l[DIFF])) + list(l[DIFF+1:])
+            for l in lights]                                                    # 対称な配光データは、基本領域のみ
 
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # データベース内のメーカー名を取得
@@ -2521,29 +4920,179 @@ def get_manufacturers_from_folder():
 
 def make_indices():
     cur.execute(
-    'CREATE INDEX file_name_id     ON light_table (file_name)    ')
+    'CREATE INDEX IF NOT EXISTS file_name_id     ON light_table (file_name)    ')
     cur.execute(
-    'CREATE INDEX cluster_no_id    ON light_table (cluster_no)   ')
+    'CREATE INDEX IF NOT EXISTS cluster_no_id    ON light_table (cluster_no)   ')
     cur.execute(
-    'CREATE INDEX manufacturer_id  ON light_table (manufacturer) ')
+    'CREATE INDEX IF NOT EXISTS manufacturer_id  ON light_table (manufacturer) ')
     cur.execute(
-    'CREATE INDEX luminous_flux_id ON light_table (luminous_flux)')
+    'CREATE INDEX IF NOT EXISTS luminous_flux_id ON light_table (luminous_flux)')
     con.commit()
     
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # インデックスの削除
 
 def del_indices():
-    cur.execute('DROP INDEX file_name_id    ')
-    cur.execute('DROP INDEX cluster_no_id   ')
-    cur.execute('DROP INDEX manufacturer_id ')
-    cur.execute('DROP INDEX luminous_flux_id')
+    cur.execute('DROP INDEX IF EXISTS file_name_id    ')
+    cur.execute('DROP INDEX IF EXISTS cluster_no_id   ')
+    cur.execute('DROP INDEX IF EXISTS manufacturer_id ')
+    cur.execute('DROP INDEX IF EXISTS luminous_flux_id')
     con.commit()
 
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 一括読み込みモード
+
+# 初めての取り込みや、大量の取り込みでは、
+# インデックスの更新と、コミットごとのディスクへの書き込み完了待ちが、挿入より時間がかかる
+# 取り込み前にインデックスを削除し、安全性を下げた設定で大きなトランザクションにまとめ、
+# 取り込み後にインデックスを作り直し、ANALYZEで統計情報を更新する
+# file_nameは主キーなので、削除してもfile_nameでの検索・削除は遅くならない
+# 途中で停電などがあると、データベースが壊れる可能性がある、事前にバックアップ
+
+BULK_COMMIT_SIZE = 20000                                                        # 一括読み込みモードでのコミットの間隔
+
+def begin_bulk_load():
+    
+    con.commit()                                                                # journal_modeはトランザクション中に変えられない
+    del_indices()
+    cur.execute('PRAGMA synchronous  = OFF    ')                                # ディスクへの書き込み完了を待たない
+    cur.execute('PRAGMA journal_mode = MEMORY ')                                # ロールバック用のジャーナルをメモリに
+    cur.execute('PRAGMA cache_size   = -524288')                                # ページキャッシュ、負の値はKB、512MB
+    cur.execute('PRAGMA temp_store   = MEMORY ')                                # インデックス作成時の一時データをメモリに
+
+def end_bulk_load():
+    
+    start_time = time.time()
+    
+    con.commit()
+    make_indices()
+    cur.execute('ANALYZE')                                                      # 統計情報を更新、検索の実行計画に使われる
+    con.commit()
+    cur.execute('PRAGMA synchronous  = FULL   ')                                # 既定値に戻す
+    cur.execute('PRAGMA journal_mode = DELETE ')
+    cur.execute('PRAGMA cache_size   = -2000  ')                                # 2MB
+    cur.execute('PRAGMA temp_store   = DEFAULT')
+    
+    end_time = time.time()
+    elapse_time = round((end_time - start_time), 5)
+    print('rebuild indices:   ', elapse_time, ' sec')
+    print('')
+
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 照明器具レコーズの列形式のまとまり
+
+# 照明器具レコードは、32要素のリストで、光度と差分は約4000個の小数のリスト
+# 10万照明器具では、Pythonの小数オブジェクトだけで数GBになる
+# LightBatchは、光度をn行 x 1369列、差分をn行 x 2663列の連続した配列に、その他の列を列ごとの配列にまとめる
+# 行番号で取り出すと、これまでと同じ32要素のリスト、スライス・番号の配列・真偽値の配列で取り出すと、LightBatch
+# only_ies、only_diffは、コピーなしで配列を返す
+
+LIGHT_RECORD_SIZE = len(COLUMNS) + 1                                            # 32列、COLUMNSはファイル名を含まない
+LIGHT_CHUNK_SIZE  = 1000                                                        # get_lightsで、まとめて配列に書く行数
+
+class LightBatch:
+    
+    __slots__ = ('ies', 'diff', 'columns')
+    
+    def __init__(self, ies, diff, columns):                                     # 引数は、光度と差分の配列、列番号をキーとする列の配列の辞書
+        self.ies     = np.ascontiguousarray(ies,  dtype=np.float64)
+        self.diff    = np.ascontiguousarray(diff, dtype=np.float64)
+        self.columns = columns
+    
+    def __len__(self):
+        return len(self.ies)
+    
+    def __getitem__(self, key):                                                 # 行番号なら照明器具レコード、それ以外はLightBatch
+        if isinstance(key, (int, np.integer)):
+            return self.row(key)
+        return LightBatch(self.ies[key], self.diff[key],
+                          {c: column[key] for c, column in self.columns.items()})
+    
+    def __iter__(self):                                                         # これまでの照明器具レコーズと同じく、1行ずつリストで
+        for i in range(len(self)):
+            yield self.row(i)
+    
+    def row(self, i):
+        light = [None] * LIGHT_RECORD_SIZE
+        for c, column in self.columns.items():
+            value    = column[i]
+            light[c] = value.item() if isinstance(value, np.generic) else value # Numpyの数値と文字列を、Pythonの型に
+        light[IES]  = self.ies[i].tolist()
+        light[DIFF] = self.diff[i].tolist()
+        return light
+    
+    def column(self, column_no):                                                # 列の配列、光度と差分は2次元の配列、コピーなし
+        if column_no == IES:
+            return self.ies
+        if column_no == DIFF:
+            return self.diff
+        return self.columns[column_no]
+    
+    def __repr__(self):
+        return 'LightBatch(' + str(len(self)) + ' lights)'
+
+def column_array(values):                                                       # 型が揃っていれば、整数、小数、文字列の配列、Noneや混在はobject
+    
+    types = {type(v) for v in values}
+    if types <= {int}:
+        return np.array(values, dtype=np.int64)
+    if types <= {float}:
+        return np.array(values, dtype=np.float64)
+    if types <= {str}:
+        return np.array(values, dtype=str)
+    
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    
+    return column
+
+def as_light_batch(lights):                                                     # 引数は、LightBatch、照明器具レコーズ、光度と差分はリストかjson文字列
+    
+    if isinstance(lights, LightBatch):
+        return lights
+    
+    n    = len(lights)
+    ies  = np.empty((n, IES_GRID.size))
+    diff = np.empty((n, DIFF_THETA_GRID.size + DIFF_PHI_GRID.size))
+    # 1行ずつ配列に書き、小数のリストは残さない
+    decode_photometries([l[IES] for l in lights], [l[DIFF] for l in lights], ies, diff)
+    
+    columns = {c: column_array([l[c] for l in lights])
+               for c in range(LIGHT_RECORD_SIZE) if c not in (IES, DIFF)}
+    
+    return LightBatch(ies, diff, columns)
+
+def concat_columns(columns):                                                    # 引数は、同じ列の配列のリスト
+    
+    # 塊ごとに型の種類が違えば(例: 整数とNoneを含むobject、文字列とobject)、column_arrayと同じくobjectにまとめる
+    # 型の違う配列を、NumPyの型の昇格に任せて連結すると、エラーや値の変換が起きる
+    # 文字列の長さの違い('<U3'と'<U5')は、同じ種類なのでそのまま連結
+    if len({column.dtype.kind for column in columns}) > 1:
+        columns = [column.astype(object) for column in columns]
+    
+    return np.concatenate(columns)
+
+def concat_light_batches(batches):                                              # 引数は、LightBatchのリスト
+    
+    if not batches:
+        return as_light_batch([])
+    
+    columns = {c: concat_columns([b.columns[c] for b in batches]) for c in batches[0].columns}
+    
+    return LightBatch(np.concatenate([b.ies  for b in batches]),
+                      np.concatenate([b.diff for b in batches]), columns)
+
+def light_column(lights, column_no):                                            # 引数は、照明器具レコーズかLightBatch、返り値は配列
+    
+    if isinstance(lights, LightBatch):
+        return lights.column(column_no)
+    
+    return np.array([l[column_no] for l in lights])
+
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 照明器具レコーズの抽出
 
-def get_lights(search_condition, record_limit=100000):                          # 条件式は文字列で与える、レコード数上限の初期値は10万
+def get_lights(search_condition, record_limit=100000, batch=False):             # 条件式は文字列で与える、レコード数上限の初期値は10万、batchはLightBatchで返す
     
     start_time = time.time()
     
@@ -2560,6 +5109,9 @@ def get_lights(search_condition, record_limit=100000):
                  ' LIMIT ' + str(record_limit)
                )
     
+    if batch:
+        return fetch_light_batch('search by:    ', search_condition, start_time)
+    
     lights = cur.fetchall()                                                     # 照明器具レコーズを取得
     
     # [(ファイル名, ... 配光文字列, 差分文字列, ...),
@@ -2587,8 +5139,7 @@ def get_lights(search_condition, record_limit=100000):
     ls = []
     for l in lights:
         l1 = l[:IES]                                                            # 配光より前の部分
-        l2 = json.loads(l[IES])                                                 # 配光のjson文字列をリスト化
-        l3 = json.loads(l[DIFF])                                                # 差分のjson文字列をリスト化
+        l2, l3 = decode_photometry(l[IES], l[DIFF])                             # 配光と差分のjson文字列をリスト化、圧縮した配光は展開
         l4 = l[DIFF+1:]                                                         # 差分より後の部分
         l1.append(l2)                                                           # リストを要素として追加なので、append
         l1.append(l3)                                                           # リストを要素として追加なので、append
@@ -2619,6 +5170,32 @@ def get_lights(search_condition, record_limit=100000):
     
     return lights                                                               # 返り値は、リストのリスト
 
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# 照明器具レコーズの列形式での取得
+
+def fetch_light_batch(label, search_condition, start_time):                     # 実行済みのSELECTの結果を、LightBatchにする
+    
+    # LIGHT_CHUNK_SIZEごとに取得して配列に書き、最後に連結
+    # 全行のjson文字列やリストを、同時に持たない
+    batches = []
+    while True:
+        rows = cur.fetchmany(LIGHT_CHUNK_SIZE)
+        if not rows:
+            break
+        batches.append(as_light_batch(rows))
+    lights = concat_light_batches(batches)
+    
+    end_time = time.time()
+    elapsed_time = round((end_time - start_time), 5)
+    
+    print('get light fixtures')
+    print(label, search_condition)
+    print('found:        ', len(lights),    ' lights')
+    print('elapsed time: ', elapsed_time, ' sec'   )
+    print('')
+    
+    return lights                                                               # 返り値は、LightBatch
+
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 照明器具レコーズの削除
 
@@ -2634,7 +5211,7 @@ def del_lights(search_condition):                                       # 条件
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # クラスターレコーズの抽出
 
-def get_clusters():                                                             # 条件式は文字列で与える
+def get_clusters(batch=False):                                                  # batchはLightBatchで返す
     
     start_time = time.time()
     
@@ -2650,6 +5227,9 @@ def get_clusters():
                  ' FROM   cluster_table '
                )
     
+    if batch:
+        return fetch_light_batch('search by:    ', 'clusters', start_time)
+    
     lights = cur.fetchall()                                                     # 照明器具レコーズを取得
     
     # [(ファイル名, ... 配光文字列, 差分文字列, ...),
@@ -2677,8 +5257,7 @@ def get_clusters():
     ls = []
     for l in lights:
         l1 = l[:IES]                                                           # 配光より前の部分
-        l2 = json.loads(l[IES])                                                # 配光のjson文字列をリスト化
-        l3 = json.loads(l[DIFF])                                               # 差分のjson文字列をリスト化
+        l2, l3 = decode_photometry(l[IES], l[DIFF])                            # 配光と差分のjson文字列をリスト化、圧縮した配光は展開
         l4 = l[DIFF+1:]                                                        # 差分より後の部分
         l1.append(l2)                                                         # リストを要素として追加なので、append
         l1.append(l3)                                                         # リストを要素として追加なので、append
@@ -2727,10 +5306,10 @@ def to_df(lights):
 
 def to_df_ies(lights):                                                          # 引数は、lightsとclusters
     
-    file_names = [l[FILE_NAME] for l in lights]
-    data       = [l[IES]       for l in lights]
+    file_names = light_column(lights, FILE_NAME)
+    data       = only_ies(lights)
     
-    lights_ies_df = pd.DataFrame(data, index=file_names, columns=IES_COLUMNS)   # θ=5度、φ=10度刻みである前提
+    lights_ies_df = pd.DataFrame(data, index=file_names, columns=grid_labels(IES_GRID)) # θ=5度、φ=10度刻みである前提
     
     return lights_ies_df
 
@@ -2739,10 +5318,11 @@ def to_df_ies(lights):
 
 def to_df_diff(lights):                                                         # 引数は、lightsとclusters
     
-    file_names = [l[FILE_NAME] for l in lights]
-    data       = [l[DIFF]      for l in lights]
+    file_names = light_column(lights, FILE_NAME)
+    data       = only_diff(lights)
     
-    lights_diff_df = pd.DataFrame(data, index=file_names, columns=DIFF_COLUMNS) # θ=5度、φ=10度刻みである前提
+    lights_diff_df = pd.DataFrame(data, index=file_names,                       # θ=5度、φ=10度刻みである前提
+                                  columns=grid_labels(DIFF_THETA_GRID, 'theta_') + grid_labels(DIFF_PHI_GRID, 'phi_'))
     
     return lights_diff_df
 
@@ -2751,6 +5331,9 @@ def to_df_diff(lights):
 
 def only_ies(lights):                                                           # 引数は、リスト
     
+    if isinstance(lights, LightBatch):                                          # 列形式なら、コピーなし
+        return lights.ies
+    
     lights_ies = [l[IES] for l in lights]                                       # n行 x 1369列のリスト
     # [[配光リスト], ... , [配光リスト]]
         
@@ -2768,6 +5351,9 @@ def only_ies(lights):
 
 def only_diff(lights):                                                          # 引数は、リスト
     
+    if isinstance(lights, LightBatch):                                          # 列形式なら、コピーなし
+        return lights.diff
+    
     lights_diff = [l[DIFF] for l in lights]                                     # n行 x 2663列のリスト
     # [[差分リスト], ... , [差分リスト]]
     
@@ -2821,6 +5407,9 @@ def norm_lights_ies(lights_ies):
 
 def norm_lights(lights):                                                        # 引数は、照明器具レコーズ
     
+    if isinstance(lights, LightBatch):                                          # 列形式なら、光度と差分の配列のみ入れ替える
+        return LightBatch(norm_lights_ies(lights.ies), norm_lights_ies(lights.diff), lights.columns)
+    
     lights_ies        = only_ies(lights)                                        # 照明器具レコーズからiesを抽出
     lights_ies_normd  = norm_lights_ies(lights_ies)                             # 配光行列の正規化
     lights_ies_normd  = lights_ies_normd.tolist()                               # リスト化
@@ -3160,7 +5749,14 @@ def plot_scatter(ies1, ies2):
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 配光行列間の類似度行列の算出
 
-def cal_similarities(lights1, lights2):                                         # 引数は、lightsとそのjson文字列を展開したもの
+def cal_similarities(lights1, lights2, dedup=False):                            # 引数は、lightsとそのjson文字列を展開したもの、dedupはlights1の同じ配光データを一度だけ計算
+    
+    # lights1はデータベースの照明器具レコーズ、クラスター平均などは配光データが変わるので不可
+    if dedup:
+        unique1, inverse1 = dedup_lights(lights1)
+        if lights2 is lights1:                                                  # 同じ照明器具レコーズどうしは、列も統合
+            return cal_similarities(unique1, unique1)[np.ix_(inverse1, inverse1)]
+        return cal_similarities(unique1, lights2)[inverse1]
     
     # 類似度の比較に使用するデータベースの列
     # コサイン類似度: 光度とその差分 
@@ -3214,8 +5810,7 @@ def make_constraint_mask(lights1, lights2, column_no):
     # 'Upper Light Ratio' 上方光束比
     # 'Symmetry'          対称性
     
-    lights1_type = [d[column_no] for d in lights1]                              # 指定した列を抽出、リスト
-    lights1_type = np.array(lights1_type)                                       # 配列化
+    lights1_type = light_column(lights1, column_no)                             # 指定した列を抽出、配列化
      
     # 要素数nの配列
     # array ([x1, x2 ... xn])
@@ -3228,8 +5823,7 @@ def make_constraint_mask(lights1, lights2, column_no):
     #        ...
     #        [xn]])
     
-    lights2_type = [d[column_no] for d in lights2]                              # 指定した列を抽出、リスト
-    lights2_type = np.array(lights2_type)                                       # 配列化
+    lights2_type = light_column(lights2, column_no)                             # 指定した列を抽出、配列化
     
     # 要素数kの配列
     # array ([y1, y2 ... yk])
@@ -3257,8 +5851,7 @@ def make_lumen_ratio_mask(lights1,lights2, minus_tol,plus_tol):
     # 正の許容比は、若干明るくても許容する時に設定、
     # あるいは、調光できる時に設定、値は0.5までが現実的
     
-    lumen1 = [l1[LUMEN] for l1 in lights1]                                      # 光束の列をテーブルから抽出、リスト
-    lumen1 = np.array(lumen1)                                                   # 配列化
+    lumen1 = light_column(lights1, LUMEN)                                       # 光束の列をテーブルから抽出、配列化
     
     # m個の照明器具: L1, L2 ... Lm
     # m個の要素の配列
@@ -3273,8 +5866,7 @@ def make_lumen_ratio_mask(lights1,lights2, minus_tol,plus_tol):
     #       [-])
     # テストデータ、lumen1 = np.array([10,25,50,75,100]).reshape(-1,1)
     
-    lumen2 = [l2[LUMEN] for l2 in lights2]                                      # 指定した列のリスト
-    lumen2 = np.array(lumen2)                                                   # 配列化
+    lumen2 = light_column(lights2, LUMEN)                                       # 指定した列を抽出、配列化
     
     # n個の照明器具: L1, L2 ... Ln
     # n個の要素の配列
@@ -3418,9 +6010,10 @@ search_condition  += ' manufacturer = "' + manufacturer + '"'
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 配光データの検索
 
-def search_ies(clusters, file_path):
+def search_ies(clusters, file_path, lights=None):                               # lightsは、読み込み済みの照明器具レコーズ、LightBatchが速い
     
     # 事前にクラスターのレコーズを読み込んでおく
+    # lightsを与えると、SQLiteを使わずに絞り込む
     
     # 引数はファイルパス
     # フォルダパスのファイル数で検索か比較かを事前に場合分けしてるため
@@ -3429,8 +6022,8 @@ def search_ies(clusters, file_path):
     
     # クエリの取得
     print('--------------------'*4)
-    query = [make_light(file_path)]                                             # 照明器具レコードの作成、配列
-    file_name = query[0][0]
+    query = as_light_batch([make_light(file_path)])                             # 照明器具レコードの作成、列形式
+    file_name = str(query.column(FILE_NAME)[0])
     print('search query  ', file_name)
     
     # 類似するクラスターの特定
@@ -3498,7 +6091,7 @@ def search_ies(clusters, file_path):
     search_condition  = ' OR '.join(search_condition)                           # リストを文字列化、間に' OR 'を挟む、'cluster_no=i OR cluster_no=j'
     search_condition  = ' (' + search_condition + ')'
     
-    lumen = query[0][LUMEN]
+    lumen = query.column(LUMEN)[0]
     lower_lumen_limit, upper_lumen_limit = \
     cal_lumen_range(lumen, minus_tol, plus_tol, 0.85)
     search_condition += ' AND (luminous_flux > ' + str(lower_lumen_limit)
@@ -3507,10 +6100,18 @@ def search_ies(clusters, file_path):
     time31 = time.time()
     print('time3.5', time31 - time3)
     
-    search_result = get_lights(search_condition)
+    if lights is None:
+        search_result = get_lights(search_condition, batch=True)
+    else:                                                                       # 読み込み済みの照明器具レコーズから絞り込む
+        lights = as_light_batch(lights)                                         # リストの場合は、毎回列形式にするので、LightBatchで渡す
+        lumens = lights.column(LUMEN).astype(np.float64)                        # Noneは欠損に
+        search_result = lights[np.isin(lights.column(CLUSTER_NO), similar_clusters)
+                               & (lower_lumen_limit < lumens) & (lumens < upper_lumen_limit)]
     
-    if search_result == []:                                                     # 絞り込み検索で、該当する照明器具がない場合
+    if len(search_result) == 0:                                                 # 絞り込み検索で、該当する照明器具がない場合
+        search_result = []
         print('no lights found')
+        time6 = time.time()
     
     else:                                                                       # 該当する照明器具がある場合
         
@@ -3525,7 +6126,7 @@ def search_ies(clusters, file_path):
         
         print('--------------------'*4)                                         # 秒数が表示される類似度計算の前に区切り
         print('find similar light fixtures \n')                                 # 何との類似度の計算かを表示
-        similarities = cal_similarities(search_result, query)                   # 類似度行列の算出、引数は、クラスターが先、クエリが後
+        similarities = cal_similarities(search_result, query, dedup=True)       # 類似度行列の算出、引数は、クラスターが先、クエリが後
         lumen_ratio_mask = \
         make_lumen_ratio_mask(search_result, query, minus_tol, plus_tol)
         overall_similarities = similarities * lumen_ratio_mask
@@ -3542,19 +6143,15 @@ def search_ies(clusters, file_path):
         #        [-]])
         
         
-        # 下記の処理は
-        # 要素にリストがあるので
-        # numpyでは推奨されておらず
-        # 処理も遅い
+        # 類似度の降順の並びは、配列で求める
+        # 同じ類似度は、元の順番のまま、list.sort(reverse=True)と同じ
+        # 照明器具レコードのリストは、結果の行を作る時にのみ取り出す
         
-        search_result_temp=[]
-        for i in range(len(search_result)):
-            search_result_temp.append(overall_similarities[i].tolist()
-                                    + similarities[i].tolist()
-                                    + lumen_ratio_mask[i].tolist()
-                                    + search_result[i])                         # 検索結果の先頭列に類似度を追加
-        search_result = search_result_temp
-        search_result.sort(key=lambda x: x[0], reverse=True)                    # 検索結果を類似度の降順で並べ替え
+        order = np.argsort(-overall_similarities[:, 0], kind='stable')          # 検索結果を類似度の降順で並べ替え
+        search_result = [overall_similarities[i].tolist()
+                       + similarities[i].tolist()
+                       + lumen_ratio_mask[i].tolist()
+                       + search_result[i] for i in order]                       # 検索結果の先頭列に類似度を追加
         
         time5 = time.time()
         print('time5', time5 - time4)
@@ -3635,16 +6232,16 @@ def search_ies_full(clusters):
         print('--------------------'*4)
         print('cluster ', i)
         
-        cluster_k = get_lights('cluster_no = ' + str(i))
+        cluster_k = get_lights('cluster_no = ' + str(i), batch=True)
         
-        if cluster_k != []:
+        if len(cluster_k) > 0:
         
             # クラスター内での類似度を計算
-            similarities        = cal_similarities(cluster_k, query)
+            similarities        = cal_similarities(cluster_k, query, dedup=True)
             similarities        = similarities.ravel()
             max_similarity      = similarities.max()
             max_similarity_id   = similarities.argmax()
-            max_similarity_name = cluster_k[max_similarity_id][0]
+            max_similarity_name = cluster_k.column(FILE_NAME)[max_similarity_id]
             
             # 各クラスターごとに最類似照明器具を表示
             print('max similarity:     ', round(max_similarity, 5), '/ ',
@@ -3730,6 +6327,111 @@ def compare_ies(file_paths):
     
     return similarities
 
+# """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# クエリフォルダの監視、置かれた配光データを検索・比較し、結果を隣に書き出す
+
+# 3 Query/ に置かれたファイルは検索、3 Query/<フォルダ>/ に置かれた2つのファイルは比較
+# クラスターと照明器具レコーズは最初に一度だけ読み込み、クエリごとに読み直さない
+# 結果は、クエリのパスに.csvと.jsonを付けたファイル、例: Query.ies.csv、Query.ies.json
+# 結果がクエリより新しければ、処理済み
+
+RESULT_COLUMNS = ['Similarity', 'Cos Similarity', 'Lumen Ratio', 'File Name'] + COLUMNS
+
+def write_result(result_path, result_df):
+    
+    # 書き出し途中のファイルを読まれないよう、一時ファイルから置き換える
+    # jsonを最後に書き、処理済みの目印にする
+    result_df.to_csv(result_path + '.csv.tmp', index=False)
+    os.replace(result_path + '.csv.tmp', result_path + '.csv')
+    result_df.to_json(result_path + '.json.tmp', orient='records', force_ascii=False)
+    os.replace(result_path + '.json.tmp', result_path + '.json')
+
+def write_search_result(file_path, search_result):
+    
+    # 類似度、コサイン類似度、光束比、照明器具レコード、光度とその差分は除く
+    rows = [s[:3] + s[3:3+IES] + s[3+DIFF+1:] for s in search_result]
+    columns = [c for i, c in enumerate(RESULT_COLUMNS) if i-3 not in (IES, DIFF)]
+    write_result(file_path, pd.DataFrame(rows, columns=columns))
+
+def write_compare_result(folder_path, file_paths, similarities):
+    
+    result_df = pd.DataFrame([[os.path.basename(file_paths[0]),
+                               os.path.basename(file_paths[1]),
+                               float(similarities[0][0])]],
+                             columns=['File Name 1', 'File Name 2', 'Similarity'])
+    write_result(folder_path.rstrip('/') + '/compare', result_df)
+
+def is_query_done(query_path, result_path):
+    
+    try:
+        return os.path.getmtime(result_path + '.json') >= os.path.getmtime(query_path)
+    except OSError:                                                             # 結果がまだない
+        return False
+
+def find_queries(debounce=0.5):
+    
+    # 未処理のクエリ、最後の変更からdebounce秒経ったもののみ
+    searches = []
+    compares = []
+    now = time.time()
+    
+    for path in sorted(glob.glob(QUERY_PATH + '*')):
+        if os.path.isdir(path):                                                 # フォルダは比較
+            file_paths = [p for p in sorted(glob.glob(path + '/*'))
+                          if p.lower().endswith(PHOTOMETRIC_EXTENSIONS)]
+            if len(file_paths) != 2:                                            # 2つ揃うまで待つ
+                continue
+            if max(os.path.getmtime(p) for p in file_paths) > now - debounce:
+                continue
+            if all(is_query_done(p, path + '/compare') for p in file_paths):
+                continue
+            compares.append((path, file_paths))
+        
+        elif path.lower().endswith(PHOTOMETRIC_EXTENSIONS):                     # ファイルは検索
+            if os.path.getmtime(path) > now - debounce:
+                continue
+            if is_query_done(path, path):
+                continue
+            searches.append(path)
+    
+    return searches, compares
+
+def watch_queries(clusters=None, lights=None, interval=0.2, debounce=0.5):
+    
+    # Ctrl+Cで終了
+    
+    if clusters is None:
+        clusters = get_clusters(batch=True)
+    if lights is None:
+        lights = get_lights('1 = 1', record_limit=-1, batch=True)               # 全照明器具レコーズ、-1は上限なし、列形式で
+    
+    print('watch: ' + QUERY_PATH)
+    
+    try:
+        while True:
+            searches, compares = find_queries(debounce)
+            
+            for file_path in searches:
+                try:
+                    search_result = search_ies(clusters, file_path, lights)
+                    write_search_result(file_path, search_result)
+                except:                                                         # 読めないクエリも、結果を書いて繰り返さない
+                    print(traceback.format_exc())
+                    write_search_result(file_path, [])
+            
+            for folder_path, file_paths in compares:
+                try:
+                    similarities = compare_ies(file_paths)
+                    write_compare_result(folder_path, file_paths, similarities)
+                except:
+                    print(traceback.format_exc())
+                    write_compare_result(folder_path, file_paths, [[np.nan]])
+            
+            time.sleep(interval)
+    
+    except KeyboardInterrupt:
+        print('stop watching')
+
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 初期クラスターの作成
 
@@ -3842,7 +6544,7 @@ def clustering2(clusters):
         
         while no_of_cluster_members >= 500:                                     # 要素数が500以上の場合
             
-            similarities = cal_similarities(cluster_k, clusters)                # クラスターkに属する照明器具と全クラスターとの類似度行列
+            similarities = cal_similarities(cluster_k, clusters, dedup=True)    # クラスターkに属する照明器具と全クラスターとの類似度行列
             
             # n個の照明器具: L1, L2 ... Ln
             # n行 x k列の類似度行列
@@ -3952,7 +6654,7 @@ def clustering3(clusters):
             
             cluster_k = get_lights('cluster_no = ' + str(i))                    # クラスターkに属する照明器具レコーズの取得
             
-            similarities = cal_similarities(cluster_k, cluster_k)               # クラスターkに属する照明器具どうしの類似度行列
+            similarities = cal_similarities(cluster_k, cluster_k, dedup=True)   # クラスターkに属する照明器具どうしの類似度行列
             
             # n個の照明器具: L1, L2 ... Ln
             # n行 x n列の類似度行列
@@ -3989,7 +6691,7 @@ def clustering3(clusters):
         # クラスター種かどうか確認し
         # クラスター種の場合、次の最小値を選択する必要がある
         
-        sim = cal_similarities(cluster_k, clusters)
+        sim = cal_similarities(cluster_k, clusters, dedup=True)
         sorted_sim_mean_min_list_id = sim_mean_min_list.argsort()               # 類似度を昇順に並び替えたインデックス
         
         j=0                                                                     # j=0で、類似度の最小値
@@ -4098,7 +6800,7 @@ def add_clusters(lights, clusters):
     condition = True
     while condition:
         
-        similarities = cal_similarities(lights, clusters)                       # 類似度、引数は、照明器具が先、クラスターが後
+        similarities = cal_similarities(lights, clusters, dedup=True)           # 類似度、引数は、照明器具が先、クラスターが後
         
         # n個の照明器具: L1, L2 ... Ln
         # k個のクラスター: C1, C2 ... Ck
@@ -4179,7 +6881,7 @@ def update_cluster_no(lights, clusters):
     # クラスターテーブルは更新されない
     
     # 類似度を計算
-    similarities = cal_similarities(lights, clusters)                           # 類似度、引数は、各クラスターの照明器具が先、クラスターが後
+    similarities = cal_similarities(lights, clusters, dedup=True)               # 類似度、引数は、各クラスターの照明器具が先、クラスターが後
     
     # n個の照明器具: L1, L2 ... Ln
     # k個のクラスター: C1, C2 ... Ck
@@ -4248,7 +6950,7 @@ def cal_cluster_mean(clusters):
         
         start_time = time.time()
         
-        cluster_k = get_lights('cluster_no=' + str(k))                          # クラスター番号=kの照明器具レコーズを取得
+        cluster_k = get_lights('cluster_no=' + str(k), batch=True)              # クラスター番号=kの照明器具レコーズを取得、列形式
         
         # クラスターkに分類されている
         # n個の照明器具: L1, L2 ... Ln
@@ -4258,7 +6960,7 @@ def cal_cluster_mean(clusters):
         #   ...
         #  [ファイル名, ...配光リスト,差分リスト...]]
         
-        if cluster_k == []:                                                     # 空クラスターの場合、再計算なし
+        if len(cluster_k) == 0:                                                 # 空クラスターの場合、再計算なし
             
             print('cluster is empty')
         
@@ -4277,7 +6979,6 @@ def cal_cluster_mean(clusters):
             
             cluster_k_normd = norm_lights(cluster_k)
             cluster_k_normd_ies = only_ies(cluster_k_normd)
-            to_df(cluster_k_normd)
             # n行 x 1369列 の配列
             # array([[-, - ... -],
             #        [-, - ... -],
@@ -4286,18 +6987,18 @@ def cal_cluster_mean(clusters):
             
             # 光度
             cluster_k_normd_ies_mean = cluster_k_normd_ies.mean(axis=0).tolist()# クラスターkの配光データの平均を計算し、リスト化
-            cluster_k_normd_ies_mean_ser = \
-            pd.Series(cluster_k_normd_ies_mean, index=IES_COLUMNS)              # 差分や光束の再計算のため、シリーズ化
+            cluster_k_normd_ies_mean_1D = \
+            PhotometryVector(cluster_k_normd_ies_mean, IES_GRID)                # 差分や光束の再計算のため、角度の格子を付ける
             # このベクトルの大きさは、1ではない可能性も
             
             # 光度の差分
             cluster_k_diff_theta = \
             two_to_one(diff_theta(one_to_two(
-            cluster_k_normd_ies_mean_ser))).values.ravel()                      # θ方向の差分の再計算、配列化、一元化、1368要素の配列
+            cluster_k_normd_ies_mean_1D))).values                               # θ方向の差分の再計算、一元化、1368要素の配列
             
             cluster_k_diff_phi   = \
             two_to_one(diff_phi(one_to_two(
-            cluster_k_normd_ies_mean_ser))).values.ravel()                      # φ方向の差分の再計算、配列化、一元化、1295要素の配列
+            cluster_k_normd_ies_mean_1D))).values                               # φ方向の差分の再計算、一元化、1295要素の配列
             
             cluster_k_diff = \
             np.hstack([cluster_k_diff_theta, cluster_k_diff_phi])               # θとφ方向の差分を横に連結、2663要素の配列
@@ -4305,7 +7006,7 @@ def cal_cluster_mean(clusters):
             cluster_k_diff = cluster_k_diff.tolist()
             
             # 光束
-            cluster_k_lumen = cal_lm(one_to_two(cluster_k_normd_ies_mean_ser)) 
+            cluster_k_lumen = cal_lm(one_to_two(cluster_k_normd_ies_mean_1D))
             
             # 更新
             clusters[k][IES]   = cluster_k_normd_ies_mean                       # 光度の更新
@@ -4350,7 +7051,7 @@ def update_cluster_table(clusters):
 x_cov = np.cov(x, rowvar=False, bias=True)
 x_vals, x_vecs = np.linalg.eig(x_cov)
 sort_index = x_vals.argsort()[::-1].tolist()
-ies_column_names = np.array(IES_COLUMNS)
+ies_column_names = np.array(grid_labels(IES_GRID))
 ies_column_names[sort_index]
 # """"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # 各クラスターの配光分布図の描画
@@ -4424,7 +7125,7 @@ def plot_clusters(clusters):
                 lights_normd = norm_lights(lights)                              # 照明器具レコーズの正規化
                 lights_normd_ies_df = to_df_ies(lights_normd)                   # データフレーム化
                 
-                similarities = cal_similarities(lights, lights)
+                similarities = cal_similarities(lights, lights, dedup=True)
                 similarities_mean = (similarities.sum()-n) / max((n**2 - n), 1) # 要素=1で分母0ではなく1にする
                 
                 for i in range(len(lights)):                                    # 各照明器具で繰り返す
@@ -4647,10 +7348,10 @@ def cal_r(ies_1D):
     # θ方向
     r_list = []                                                                 # 空のリストを作成
     for i, j in [[0,180],[90,270]]:                                             # 水平角度0度と180度のペア、90度と270度のペアで、繰り返す
-        r_i  = ies.loc[i,:]                                                     # 光度のシリーズ、1回目は水平角度0度、2回目は水平角度90度
-        r_j  = ies.loc[j,:]                                                     # 光度のシリーズ、1回目は水平角度180度、2回目は水平角度270度
+        r_i  = ies.values[ies.phi.index(i)]                                     # 光度の配列、1回目は水平角度0度、2回目は水平角度90度
+        r_j  = ies.values[ies.phi.index(j)]                                     # 光度の配列、1回目は水平角度180度、2回目は水平角度270度
         r_j  = r_j[::-1]                                                        # グラフの線をつなげるため、逆順
-        r    = r_i.append(r_j).values                                           # 一つの光度シリーズにし、配列化
+        r    = np.append(r_i, r_j)                                              # 一つの光度の配列に
         r_list.append(r)                                                        # 半径の配列をリストに追加
     r_0_180  = r_list[0]                                                        # 362要素の配列、[0,1,2,...180,180,...360]
     r_90_270 = r_list[1]                                                        # 362要素の配列、[0,1,2,...180,180,...360]
@@ -4658,7 +7359,7 @@ def cal_r(ies_1D):
     # φ方向
     r_list = []                                                                 # 空のリストを作成
     for i in [30,150]:                                                          # 抽出する鉛直角度をリストで指定し、繰り返す
-        r = (ies.loc[:,i] * np.sin(i /180 * np.pi)).values                      # 鉛直角度i度方向を抽出し、水平方向成分を計算し、配列化
+        r = ies.values[:, ies.theta.index(i)] * np.sin(i /180 * np.pi)          # 鉛直角度i度方向を抽出し、水平方向成分を計算
         r_list.append(r)                                                        # 半径の配列をリストに追加
     r_30  = r_list[0]                                                           # 361要素の配列、[0,1,2,...180,...360]
     r_150 = r_list[1]                                                           # 361要素の配列、[0,1,2,...180,...360]